@@ -0,0 +1,35 @@
+"""
+Gunicorn configuration, read from the working directory
+
+The application is loaded once in the master process (preload_app) and the
+workers are forked from it, sharing its memory; see trip_planner.preload.
+Set GUNICORN_PRELOAD=0 to have every worker load the application itself,
+and WEB_CONCURRENCY for the number of workers.
+"""
+import glob
+import multiprocessing
+import os
+
+wsgi_app = 'trip_planner.asgi:application'
+# Progress streams need an ASGI worker
+worker_class = 'uvicorn.workers.UvicornWorker'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def on_starting(server):
+    # Workers' metrics files (METRICS_DIR) count from this server's start
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, '*.json*')):
+            os.remove(path)
+
+
+def when_ready(server):
+    # The application is loaded by now; load what it would load lazily too
+    # before the workers are forked
+    if server.cfg.preload_app:
+        from trip_planner.preload import preload
+        preload()
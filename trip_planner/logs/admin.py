@@ -1,8 +1,26 @@
 from django.contrib import admin
+from trip_planner.response_cache import bump_versions
 from .models import *
 
 
 # Register your models here.
 admin.site.register(DailyLog)
-admin.site.register(LogEntry)
+
+class LogEntryAdmin(admin.ModelAdmin):
+    list_display = ('daily_log', 'version', 'start_time', 'end_time', 'status', 'location')
+    list_filter = ('status',)
+    list_select_related = ('daily_log', 'location_text')
+
+    # Entry deletes send no cache signals
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_versions('daily_log', [obj.daily_log_id])
+
+    def delete_queryset(self, request, queryset):
+        daily_log_ids = set(queryset.values_list('daily_log_id', flat=True))
+        super().delete_queryset(request, queryset)
+        bump_versions('daily_log', daily_log_ids)
+
+admin.site.register(LogEntry, LogEntryAdmin)
+admin.site.register(LogText)
 
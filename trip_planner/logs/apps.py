@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class LogsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'logs'
+
+    def ready(self):
+        # Invalidate cached API responses when models change
+        from . import signals  # noqa: F401
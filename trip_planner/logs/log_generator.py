@@ -1,5 +1,14 @@
 import datetime
-import pytz
+import zoneinfo
+from django.db import transaction
+from django.db.models import F
+from trip_planner.db import insert_all
+from trip_planner.response_cache import bump_versions
+
+# Duty status of the time spent at a stop, by stop type; the time between
+# stops is driving
+STOP_STATUSES = {'rest': 'off_duty', 'sleep': 'sleeper'}
+CONTINUED_REMARK = " (continued from previous day)"
 
 
 def generate_log_image(daily_log):
@@ -8,174 +17,131 @@ def generate_log_image(daily_log):
     Actual image generation now happens client-side in React.
     """
     return None
-   
 
+
+def duty_intervals(stops):
+    """
+    The trip's duty status as contiguous (start, end, status, location,
+    remarks) intervals: the time at each stop and the driving between stops,
+    up to the dropoff
+
+    stops must be ordered by arrival time. A stop that starts before the
+    previous interval ends (e.g. a pickup during a break) is counted from the
+    end of it, so intervals never overlap.
+    """
+    intervals = []
+    covered = None
+    for stop in stops:
+        if covered is not None and stop.arrival_time > covered:
+            intervals.append((
+                covered, stop.arrival_time, 'driving',
+                f"En route to {stop.location.name}", f"Driving to {stop.get_stop_type_display()}"
+            ))
+        start = stop.arrival_time if covered is None else max(stop.arrival_time, covered)
+        if stop.departure_time > start:
+            intervals.append((
+                start, stop.departure_time, STOP_STATUSES.get(stop.stop_type, 'on_duty'),
+                stop.location.name, stop.notes
+            ))
+        covered = stop.departure_time if covered is None else max(covered, stop.departure_time)
+        if stop.stop_type == 'dropoff':
+            break
+    return intervals
+
+
+def split_days(intervals, timezone):
+    """
+    Split contiguous intervals at midnight in timezone (a tzinfo), in one pass
+
+    Returns [(local date, intervals of that day)] in date order. Times stay
+    in UTC; the parts of an interval after the first have CONTINUED_REMARK
+    added to their remarks.
+    """
+    days = []
+    day_end = None
+    for start, end, status, location, remarks in intervals:
+        part_remarks = remarks
+        while start < end:
+            if day_end is None or start >= day_end:
+                local_date = start.astimezone(timezone).date()
+                # Midnights exist in every zone but a handful, where they
+                # resolve to the start of the day's first hour
+                day_end = datetime.datetime.combine(
+                    local_date + datetime.timedelta(days=1), datetime.time(), tzinfo=timezone
+                ).astimezone(datetime.timezone.utc)
+                days.append((local_date, []))
+            part_end = min(end, day_end)
+            days[-1][1].append((start, part_end, status, location, part_remarks))
+            part_remarks = f"{remarks or ''}{CONTINUED_REMARK}"
+            start = part_end
+    return days
+
+
+@transaction.atomic
 def generate_daily_logs_for_trip(trip):
     """
     Generate daily logs for entire trip based on route stops
     This function creates a DailyLog entry for each day of the trip
     and populates it with LogEntry objects based on the schedule
-    
+
+    The trip's duty status is split at midnight in the trip's timezone, so
+    each day's entries cover it without gaps, DST transition days included.
+
+    Logs are append-only: regenerating an existing log bumps its version and
+    writes a new set of entries, leaving the previous ones in place. Entries
+    are built in memory and inserted together at the end. Logs of dates the
+    new plan no longer covers are deleted with their entries.
+
     Parameters:
     trip - The Trip model instance
     """
-    stops = trip.stops.all().order_by('arrival_time')
-    client_tz = pytz.timezone(trip.client_timezone if trip.client_timezone else 'UTC')
-    
+    stops = list(trip.stops.select_related('location').order_by('arrival_time', 'id'))
     if not stops:
         return []
-    
-    # Initialize tracking variables
-    current_date = stops.first().arrival_time.astimezone(client_tz).date()
-    end_date = stops.last().departure_time.astimezone(client_tz).date()
+    client_tz = zoneinfo.ZoneInfo(trip.client_timezone or 'UTC')
+    days = split_days(duty_intervals(stops), client_tz)
+
+    dates = [date for date, _ in days]
+    # A replan that moves or shortens the trip leaves days it no longer covers
+    dropped = list(DailyLog.objects.filter(trip=trip).exclude(date__in=dates).values_list('id', flat=True))
+    if dropped:
+        bump_versions('daily_log', dropped)
+        DailyLog.objects.filter(id__in=dropped).delete()
+
+    # Create the missing logs and bump the versions of the existing ones
+    existing = {daily_log.date: daily_log for daily_log in DailyLog.objects.filter(trip=trip, date__in=dates)}
+    if existing:
+        DailyLog.objects.filter(id__in=[daily_log.id for daily_log in existing.values()]).update(version=F('version') + 1)
+        for daily_log in existing.values():
+            daily_log.version += 1
+        bump_versions('daily_log', [daily_log.id for daily_log in existing.values()])
+    created = [DailyLog(trip=trip, date=date, json_data={}) for date, _ in days if date not in existing]
+    insert_all(created)
+    logs_by_date = {**existing, **{daily_log.date: daily_log for daily_log in created}}
+
     daily_logs = []
-    
-    first_stop = stops.first()
-    current_status = 'driving'
-    status_start_time = first_stop.arrival_time.astimezone(client_tz)
-    
-   
-    # Track the pending status to carry over at midnight
-    pending_midnight_status = None
-    pending_midnight_location = None
-    pending_midnight_remarks = None
-    pending_midnight_status_end = None
-
-    # Process each day
-    while current_date <= end_date:
-        # Create or get daily log for this date
-        daily_log, created = DailyLog.objects.get_or_create(
-            trip=trip,
-            date=current_date,
-            defaults={'json_data': {}}
-        )
-        
-        # Clear existing entries if we're regenerating
-        if not created:
-            daily_log.entries.all().delete()
-        
-        # Check if there's a status carried over from the previous day
-        if pending_midnight_status:
-            # Create an entry from midnight to either the first stop of the day or when the status changes
-            midnight_start = datetime.datetime.combine(
-                current_date,
-                datetime.time(0, 0, 0)
-            ).replace(tzinfo=status_start_time.tzinfo)
-            
-            # Find the first stop of the day (if any)
-            day_stops = [stop for stop in stops if stop.arrival_time.astimezone(client_tz).date() == current_date]
-            day_stops = sorted(day_stops, key = lambda stop: stop.arrival_time)
-            if day_stops:
-                # The continued status ends at the first stop of the day
-                first_stop_of_day = day_stops[0]
-                
-                if midnight_start < first_stop_of_day.arrival_time.astimezone(client_tz):
-                    LogEntry.objects.create(
-                        daily_log=daily_log,
-                        start_time=midnight_start,
-                        end_time=pending_midnight_status_end,
-                        status=pending_midnight_status,
-                        location=pending_midnight_location,
-                        remarks=pending_midnight_remarks + " (continued from previous day)"
-                    )
-                    
-                    # Update tracking variables to process remaining stops
-                    status_start_time = pending_midnight_status_end
-                    current_status = 'driving'
-                    
-            
-            # Reset pending status as it's been handled
-            pending_midnight_status = None
-            pending_midnight_location = None
-            pending_midnight_remarks = None
-        
-        # Process stops for this day
-        day_stops = [stop for stop in stops if stop.arrival_time.astimezone(client_tz).date() == current_date]
-        day_end = datetime.datetime.combine(current_date, datetime.time(23, 59, 59)).replace(tzinfo=status_start_time.tzinfo)
-        for ind, stop in enumerate(day_stops):
-            # Create log entry for driving/on-duty to this stop if coming from previous status
-            if stop.arrival_time.astimezone(client_tz) > status_start_time and current_status == 'driving':
-                # Driving to this stop
-                driving_entry = LogEntry.objects.create(
-                    daily_log=daily_log,
-                    start_time=status_start_time,
-                    end_time=stop.arrival_time,
-                    status='driving',
-                    location=f"En route to {stop.location.name}",
-                    remarks=f"Driving to {stop.get_stop_type_display()}"
-                )
-                
-                entry_end_time = driving_entry.end_time.astimezone(client_tz) 
-                if entry_end_time.date() > current_date:
-                    last_entry = driving_entry
-                    status_start_time = entry_end_time
-                    current_status = 'driving'
-                    continue
-                          
-            # Determine status at stop
-            if stop.stop_type == 'rest':
-                new_status = 'off_duty'
-            elif stop.stop_type == 'sleep':
-                new_status = 'sleeper'
-            elif stop.stop_type in ['pickup', 'dropoff', 'fuel']:
-                new_status = 'on_duty'
-            else:
-                new_status = 'on_duty'
-            
-            # Create log entry for time at the stop
-            last_entry = LogEntry.objects.create(
-                daily_log=daily_log,
-                start_time=stop.arrival_time,
-                end_time=stop.departure_time,
-                status=new_status,
-                location=stop.location.name,
-                remarks=stop.notes
+    entries = []
+    for date, day_intervals in days:
+        daily_log = logs_by_date[date]
+        daily_log._current_entries = [
+            LogEntry(
+                daily_log=daily_log, log_date=date, version=daily_log.version,
+                start_time=start, end_time=end, status=status, location=location, remarks=remarks
             )
-            
-            if stop.stop_type == "dropoff":
-                daily_logs.append(daily_log)
-                return daily_logs
-            
-            if ind == len(day_stops)- 1 and last_entry.end_time.astimezone(client_tz) < day_end:
-                last_entry = LogEntry.objects.create(
-                    daily_log=daily_log,
-                    start_time=stop.departure_time,
-                    end_time=day_end,
-                    status='driving',
-                    location=f"En route",
-                    remarks=f"Driving"
-                )
-                
-                status_start_time = day_end +  datetime.timedelta(seconds=1)
-                current_status = 'driving'
-                continue
-                
-                
-            
-                
-            # Update tracking variables
-            status_start_time = stop.departure_time.astimezone(client_tz)
-            current_status = 'driving'  # Assume driving after each stop unless it's the end of day
-            current_remarks = f"Driving after {stop.get_stop_type_display()}"
-    
-        if status_start_time.date() > current_date:
-            # Limit entry to midnight.
-            last_entry.end_time = day_end
-            last_entry.save()
-            
-            # If not the last day and we're still active, set pending status for next day
-            if current_date < end_date:
-                pending_midnight_status = last_entry.status
-                pending_midnight_location = last_entry.location
-                pending_midnight_remarks = last_entry.remarks
-                pending_midnight_status_end = status_start_time
-                
+            for start, end, status, location, remarks in day_intervals
+        ]
+        entries.extend(daily_log._current_entries)
         daily_logs.append(daily_log)
-        
-        # Move to the next day
-        current_date += datetime.timedelta(days=1)
-    
+
+    _write_entries(entries)
     return daily_logs
 
+def _write_entries(entries):
+    """Insert log entries, storing their location and remark strings once in LogText"""
+    text_ids = LogText.ids_for(text for entry in entries for text in entry.pending_texts())
+    for entry in entries:
+        entry.resolve_texts(text_ids)
+    insert_all(entries)
+
 # Import models at the end to avoid circular imports
-from .models import DailyLog, LogEntry
\ No newline at end of file
+from .models import DailyLog, LogEntry, LogText
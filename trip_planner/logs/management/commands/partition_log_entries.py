@@ -0,0 +1,220 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from logs.models import LogEntry
+
+PARTITION_SUFFIX = '_y%Ym%m'
+
+
+def month_start(date):
+    return date.replace(day=1)
+
+
+def next_month(date):
+    return (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def add_months(date, months):
+    index = date.year * 12 + date.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage monthly range partitions of the log entry table on log_date (PostgreSQL only). "
+        "'convert' turns the existing table into a partitioned one; "
+        "'extend' creates partitions for the coming months, moving their rows out of the default "
+        "partition, and optionally drops old ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', choices=['extend', 'convert'], default='extend')
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help="Months after the current one to create partitions for (default: 3)")
+        parser.add_argument('--retain-months', type=int,
+                            help="Drop partitions that ended more than this many months ago")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Print the SQL instead of running it")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Log entry partitioning requires PostgreSQL")
+        if options['months_ahead'] < 0:
+            raise CommandError("--months-ahead must not be negative")
+        if options['retain_months'] is not None and options['retain_months'] < 1:
+            raise CommandError("--retain-months must be at least 1")
+
+        self.table = LogEntry._meta.db_table
+        self.dry_run = options['dry_run']
+        partitioned = self.is_partitioned()
+        this_month = month_start(timezone.localdate())
+        last_month = add_months(this_month, options['months_ahead'])
+
+        with transaction.atomic():
+            if options['action'] == 'convert':
+                if partitioned:
+                    raise CommandError(f"{self.table} is already partitioned")
+                self.convert(this_month, last_month)
+            else:
+                if not partitioned:
+                    raise CommandError(f"{self.table} is not partitioned; run 'convert' first")
+                created = self.create_partitions(self.table, this_month, last_month, if_not_exists=True)
+                self.stdout.write(f"Ensured {created} monthly partitions up to {last_month:%Y-%m}")
+
+            if options['retain_months'] is not None:
+                dropped = self.drop_partitions_before(add_months(this_month, -options['retain_months']))
+                self.stdout.write(f"Dropped {dropped} partitions")
+
+        if not self.dry_run:
+            self.stdout.write(self.style.SUCCESS("Done"))
+
+    def execute_sql(self, sql, params=None):
+        if self.dry_run:
+            self.stdout.write((sql % tuple(params) if params else sql) + ';')
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def is_partitioned(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [self.table])
+            row = cursor.fetchone()
+        if row is None:
+            raise CommandError(f"Table {self.table} does not exist; run migrate first")
+        return row[0] == 'p'
+
+    def create_partitions(self, parent, first_month, last_month, if_not_exists=False):
+        """
+        Create one partition per month from first_month to last_month
+        inclusive. With if_not_exists, existing partitions are skipped and
+        rows the default partition holds for a new month are moved into it.
+        """
+        qn = connection.ops.quote_name
+        month = first_month
+        count = 0
+        while month <= last_month:
+            name = self.table + month.strftime(PARTITION_SUFFIX)
+            bounds = f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+            if not if_not_exists:
+                self.execute_sql(f"CREATE TABLE {qn(name)} PARTITION OF {qn(parent)} {bounds}")
+            elif not self.table_exists(name):
+                moved = self.default_rows(month)
+                if moved:
+                    self.move_out_of_default(name, month, bounds)
+                    self.stdout.write(f"Moving {moved} rows of {month:%Y-%m} out of the default partition")
+                else:
+                    self.execute_sql(f"CREATE TABLE {qn(name)} PARTITION OF {qn(parent)} {bounds}")
+            month = next_month(month)
+            count += 1
+        return count
+
+    def table_exists(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [connection.ops.quote_name(name)])
+            return cursor.fetchone()[0]
+
+    def default_rows(self, month):
+        """Number of rows of a month in the default partition"""
+        default = self.table + '_default'
+        if not self.table_exists(default):
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {connection.ops.quote_name(default)} "
+                f"WHERE {connection.ops.quote_name('log_date')} >= %s AND {connection.ops.quote_name('log_date')} < %s",
+                [month, next_month(month)],
+            )
+            return cursor.fetchone()[0]
+
+    def move_out_of_default(self, name, month, bounds):
+        """
+        Create a month's partition holding the rows the default partition
+        has for it: PostgreSQL refuses a new partition while the default one
+        holds rows in its range. Plans far in the future put rows there.
+        """
+        qn = connection.ops.quote_name
+        default = self.table + '_default'
+        in_month = f"{qn('log_date')} >= '{month.isoformat()}' AND {qn('log_date')} < '{next_month(month).isoformat()}'"
+        # Filled as a plain table, then attached: attaching creates its
+        # indexes and checks no default partition row is left in range
+        self.execute_sql(f"CREATE TABLE {qn(name)} (LIKE {qn(self.table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        self.execute_sql(f"INSERT INTO {qn(name)} SELECT * FROM {qn(default)} WHERE {in_month}")
+        self.execute_sql(f"DELETE FROM {qn(default)} WHERE {in_month}")
+        self.execute_sql(f"ALTER TABLE {qn(self.table)} ATTACH PARTITION {qn(name)} {bounds}")
+
+    def convert(self, this_month, last_month):
+        """
+        Rebuild the table partitioned by log_date. The primary key becomes
+        (id, log_date), as PostgreSQL requires the partition key in unique
+        constraints; ids keep coming from the existing sequence.
+        """
+        qn = connection.ops.quote_name
+        table = self.table
+        new_table = f'{table}_partitioned'
+        bounds = LogEntry.objects.aggregate(first=Min('log_date'), last=Max('log_date'))
+        first_month = min(month_start(bounds['first']), this_month) if bounds['first'] else this_month
+        last_month = max(month_start(bounds['last']), last_month) if bounds['last'] else last_month
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+
+        self.execute_sql(f"LOCK TABLE {qn(table)} IN ACCESS EXCLUSIVE MODE")
+        # LIKE copies columns, NOT NULL and CHECK constraints, and the id default
+        self.execute_sql(
+            f"CREATE TABLE {qn(new_table)} (LIKE {qn(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({qn('log_date')})"
+        )
+        self.execute_sql(f"ALTER TABLE {qn(new_table)} ADD PRIMARY KEY ({qn('id')}, {qn('log_date')})")
+        count = self.create_partitions(new_table, first_month, last_month)
+        self.execute_sql(f"CREATE TABLE {qn(table + '_default')} PARTITION OF {qn(new_table)} DEFAULT")
+        self.execute_sql(f"INSERT INTO {qn(new_table)} SELECT * FROM {qn(table)}")
+
+        if sequence:
+            self.execute_sql(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        self.execute_sql(f"DROP TABLE {qn(table)}")
+        self.execute_sql(f"ALTER TABLE {qn(new_table)} RENAME TO {qn(table)}")
+        if sequence:
+            self.execute_sql(f"ALTER SEQUENCE {sequence} OWNED BY {qn(table)}.{qn('id')}")
+
+        # Foreign keys and indexes, under the names Django gives them
+        with connection.schema_editor(collect_sql=True) as editor:
+            for field in LogEntry._meta.local_fields:
+                if field.remote_field and field.db_constraint:
+                    editor.execute(editor._create_fk_sql(LogEntry, field, '_fk_%(to_table)s_%(to_column)s'))
+            for statement in editor._model_indexes_sql(LogEntry):
+                editor.execute(statement)
+        for sql in editor.collected_sql:
+            self.execute_sql(sql.rstrip(';'))
+
+        self.stdout.write(
+            f"Converted {table} to {count} monthly partitions from {first_month:%Y-%m} "
+            f"to {last_month:%Y-%m} plus a default partition"
+        )
+
+    def drop_partitions_before(self, cutoff):
+        """Drop the monthly partitions whose month ends on or before cutoff"""
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(%s)",
+                [self.table],
+            )
+            names = [row[0] for row in cursor.fetchall()]
+
+        dropped = 0
+        for name in sorted(names):
+            try:
+                month = datetime.datetime.strptime(name[len(self.table):], PARTITION_SUFFIX).date()
+            except ValueError:
+                continue
+            if next_month(month) <= cutoff:
+                self.execute_sql(f"ALTER TABLE {qn(self.table)} DETACH PARTITION {qn(name)}")
+                self.execute_sql(f"DROP TABLE {qn(name)}")
+                dropped += 1
+        return dropped
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from logs.models import DailyLog, LogEntry
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the entries of superseded daily log versions. Regenerating a log keeps "
+        "its earlier entries for audit; this keeps only the latest versions of each log."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-versions', type=int, default=1,
+                            help="Versions kept per daily log, the current one included (default: 1)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count the entries that would be deleted without deleting them")
+
+    def handle(self, *args, **options):
+        keep = options['keep_versions']
+        if keep < 1:
+            raise CommandError("--keep-versions must be at least 1")
+
+        daily_log_ids = list(DailyLog.objects.filter(version__gt=keep).order_by('id').values_list('id', flat=True))
+        pruned = 0
+        for start in range(0, len(daily_log_ids), BATCH_SIZE):
+            superseded = LogEntry.objects.filter(
+                daily_log_id__in=daily_log_ids[start:start + BATCH_SIZE],
+                version__lte=F('daily_log__version') - keep,
+            )
+            # A transaction per batch, so pruning a large table doesn't hold locks throughout
+            with transaction.atomic():
+                if options['dry_run']:
+                    pruned += superseded.count()
+                else:
+                    pruned += superseded.delete()[0]
+
+        if options['dry_run']:
+            self.stdout.write(f"Would delete {pruned} superseded log entries; dry run, nothing deleted")
+        else:
+            # Only current versions are served, so no cached response changes
+            self.stdout.write(self.style.SUCCESS(
+                f"Deleted {pruned} log entries of versions older than the latest {keep} of each daily log"
+            ))
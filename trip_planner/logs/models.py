@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import F
 from routes.models import Trip
 
 class DailyLog(models.Model):
@@ -6,13 +7,75 @@ class DailyLog(models.Model):
     date = models.DateField()
     log_image = models.ImageField(upload_to='eld_logs/', null=True, blank=True)
     json_data = models.JSONField(default=dict)
-    
+    # Entries are never deleted; regenerating a log appends a new version
+    version = models.PositiveIntegerField(default=1)
+
     class Meta:
         unique_together = ('trip', 'date')
-    
+
     def __str__(self):
         return f"Log for {self.trip} on {self.date}"
 
+    @property
+    def current_entries(self):
+        """Entries of the current version, in the order they were written"""
+        if hasattr(self, '_current_entries'):
+            return self._current_entries
+        return list(
+            self.entries.filter(version=self.version)
+            .select_related('location_text', 'remarks_text')
+            .order_by('id')
+        )
+
+class LogText(models.Model):
+    """A location or remark string of log entries, stored once however often it is used"""
+    text = models.TextField(unique=True)
+
+    def __str__(self):
+        return self.text
+
+    @classmethod
+    def ids_for(cls, texts):
+        """Return {text: id} for a collection of strings, inserting the missing ones"""
+        texts = set(texts)
+        ids = dict(cls.objects.filter(text__in=texts).values_list('text', 'id'))
+        missing = texts - ids.keys()
+        if missing:
+            # Concurrent writers may insert the same strings
+            cls.objects.bulk_create([cls(text=text) for text in missing], ignore_conflicts=True)
+            ids.update(cls.objects.filter(text__in=missing).values_list('text', 'id'))
+        return ids
+
+class StatusField(models.Field):
+    """Duty status stored as a small integer code, read and written by name"""
+    CODES = {'off_duty': 1, 'sleeper': 2, 'driving': 3, 'on_duty': 4}
+    NAMES = {code: name for name, code in CODES.items()}
+
+    def get_internal_type(self):
+        return 'PositiveSmallIntegerField'
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return self.NAMES[value]
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None or isinstance(value, int):
+            return value
+        try:
+            return self.CODES[value]
+        except KeyError:
+            raise ValueError(f"Unknown duty status {value!r}")
+
+class LogEntryQuerySet(models.QuerySet):
+    def current(self):
+        """Entries of their daily log's current version"""
+        return self.filter(version=F('daily_log__version'))
+
 class LogEntry(models.Model):
     STATUS_CHOICES = (
         ('off_duty', 'Off Duty'),
@@ -20,15 +83,70 @@ class LogEntry(models.Model):
         ('driving', 'Driving'),
         ('on_duty', 'On Duty Not Driving'),
     )
-    
+
     daily_log = models.ForeignKey(DailyLog, on_delete=models.CASCADE, related_name='entries')
+    # Copied from the daily log; the table is partitioned on it
+    log_date = models.DateField(editable=False)
+    version = models.PositiveIntegerField(editable=False)
     start_time = models.DateTimeField()
     end_time = models.DateTimeField(null=True, blank=True)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
-    location = models.CharField(max_length=255, blank=True, null=True)
-    remarks = models.TextField(blank=True, null=True)
-    
+    status = StatusField(choices=STATUS_CHOICES)
+    location_text = models.ForeignKey(LogText, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
+    remarks_text = models.ForeignKey(LogText, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
+
+    objects = LogEntryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['daily_log', 'version'])]
+
     def __str__(self):
         return f"{self.get_status_display()} from {self.start_time} to {self.end_time}"
-    
-    
+
+    # location and remarks read and write strings; they are stored in LogText
+    # when the entry is saved (or by the caller, for bulk inserts)
+
+    def _get_text(self, name):
+        texts = getattr(self, '_texts', {})
+        if name in texts:
+            return texts[name]
+        text = getattr(self, f'{name}_text')
+        return text.text if text is not None else None
+
+    def _set_text(self, name, value):
+        if not hasattr(self, '_texts'):
+            self._texts = {}
+        self._texts[name] = value
+
+    @property
+    def location(self):
+        return self._get_text('location')
+
+    @location.setter
+    def location(self, value):
+        self._set_text('location', value)
+
+    @property
+    def remarks(self):
+        return self._get_text('remarks')
+
+    @remarks.setter
+    def remarks(self, value):
+        self._set_text('remarks', value)
+
+    def resolve_texts(self, text_ids):
+        """Point location_text and remarks_text at pending strings, given {text: id}"""
+        for name, value in getattr(self, '_texts', {}).items():
+            setattr(self, f'{name}_text', LogText(id=text_ids[value], text=value) if value is not None else None)
+        self._texts = {}
+
+    def pending_texts(self):
+        return [value for value in getattr(self, '_texts', {}).values() if value is not None]
+
+    def save(self, *args, **kwargs):
+        if getattr(self, '_texts', None):
+            self.resolve_texts(LogText.ids_for(self.pending_texts()))
+        if self.version is None:
+            self.version = self.daily_log.version
+        if self.log_date is None:
+            self.log_date = self.daily_log.date
+        super().save(*args, **kwargs)
@@ -1,20 +1,109 @@
+import datetime
+
 from rest_framework import serializers
 from .models import DailyLog, LogEntry
 
+ENTRY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
 class LogEntrySerializer(serializers.ModelSerializer):
     # Convert UTC times to strings, frontend will handle timezone conversion
-    start_time = serializers.DateTimeField(format="%Y-%m-%dT%H:%M:%SZ")
-    end_time = serializers.DateTimeField(format="%Y-%m-%dT%H:%M:%SZ")
+    start_time = serializers.DateTimeField(format=ENTRY_TIME_FORMAT)
+    end_time = serializers.DateTimeField(format=ENTRY_TIME_FORMAT)
+    # Stored dictionary-encoded in LogText; read and written as plain strings
+    location = serializers.CharField(max_length=255, allow_blank=True, allow_null=True, required=False)
+    remarks = serializers.CharField(allow_blank=True, allow_null=True, required=False)
                                          
     class Meta:
         model = LogEntry
         fields = ['id', 'start_time', 'end_time', 'status', 'location', 'remarks']
 
 class DailyLogSerializer(serializers.ModelSerializer):
-    entries = LogEntrySerializer(many=True, read_only=True)
+    entries = LogEntrySerializer(source='current_entries', many=True, read_only=True)
     # Format date consistently for frontend 
     date = serializers.DateField(format="%Y-%m-%d")
     
     class Meta:
         model = DailyLog
-        fields = ['id', 'trip', 'date', 'log_image', 'json_data', 'entries']
\ No newline at end of file
+        fields = ['id', 'trip', 'date', 'log_image', 'json_data', 'entries']
+
+
+# The functions below build the same output as the serializers above as plain
+# dicts, from objects already in memory or from values() queries; logs have
+# hundreds of entries, and per-field serializer calls dominate their cost
+
+def _entry_time(value):
+    if value is None:
+        return None
+    return value.astimezone(datetime.timezone.utc).strftime(ENTRY_TIME_FORMAT)
+
+
+def _log_image_url(name, request=None):
+    if not name:
+        return None
+    url = DailyLog._meta.get_field('log_image').storage.url(name)
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def log_entry_dict(entry_id, start_time, end_time, status, location, remarks):
+    """LogEntrySerializer's output for one entry"""
+    return {
+        'id': entry_id,
+        'start_time': _entry_time(start_time),
+        'end_time': _entry_time(end_time),
+        'status': status,
+        'location': location,
+        'remarks': remarks,
+    }
+
+
+def daily_log_dicts(daily_logs, request=None):
+    """DailyLogSerializer(daily_logs, many=True).data for logs in memory, such as generator output"""
+    return [
+        {
+            'id': daily_log.id,
+            'trip': daily_log.trip_id,
+            'date': daily_log.date.strftime('%Y-%m-%d'),
+            'log_image': _log_image_url(daily_log.log_image.name, request),
+            'json_data': daily_log.json_data,
+            'entries': [
+                log_entry_dict(entry.id, entry.start_time, entry.end_time, entry.status, entry.location, entry.remarks)
+                for entry in daily_log.current_entries
+            ],
+        }
+        for daily_log in daily_logs
+    ]
+
+
+def log_entry_rows(queryset):
+    """LogEntrySerializer output for the entries of a queryset, from one values() query"""
+    rows = queryset.values_list(
+        'id', 'start_time', 'end_time', 'status', 'location_text__text', 'remarks_text__text'
+    )
+    return [log_entry_dict(*row) for row in rows]
+
+
+def daily_log_rows(queryset, request=None):
+    """DailyLogSerializer output for the logs of a queryset, from two values() queries"""
+    queryset = queryset.prefetch_related(None)
+    logs = list(queryset.values_list('id', 'trip_id', 'date', 'log_image', 'json_data'))
+    entries = {}
+    rows = (
+        LogEntry.objects.current()
+        .filter(daily_log__in=queryset.values('id'))
+        .order_by('id')
+        .values_list('daily_log_id', 'id', 'start_time', 'end_time', 'status',
+                     'location_text__text', 'remarks_text__text')
+    )
+    for daily_log_id, *entry in rows:
+        entries.setdefault(daily_log_id, []).append(log_entry_dict(*entry))
+    return [
+        {
+            'id': log_id,
+            'trip': trip_id,
+            'date': date.strftime('%Y-%m-%d'),
+            'log_image': _log_image_url(log_image, request),
+            'json_data': json_data,
+            'entries': entries.get(log_id, []),
+        }
+        for log_id, trip_id, date, log_image, json_data in logs
+    ]
@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from trip_planner.response_cache import bump_versions
+from .models import DailyLog, LogEntry
+
+
+@receiver([post_save, post_delete], sender=DailyLog)
+def daily_log_changed(sender, instance, **kwargs):
+    # Regenerating a log bumps its version, which covers entries inserted in bulk
+    bump_versions('daily_log', [instance.pk])
+
+
+@receiver(post_save, sender=LogEntry)
+def log_entry_changed(sender, instance, **kwargs):
+    # Deletes bump the log where they are made: a delete receiver would keep
+    # Django from deleting entries, every version of them, in bulk
+    bump_versions('daily_log', [instance.daily_log_id])
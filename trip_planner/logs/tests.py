@@ -1,3 +1,110 @@
-from django.test import TestCase
+import datetime
+import io
+import zoneinfo
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from routes.models import Location, RouteStop, Trip
+from trip_planner.response_cache import current_version
+
+from .log_generator import CONTINUED_REMARK, generate_daily_logs_for_trip, split_days
+from .models import DailyLog, LogEntry
+
+CHICAGO = zoneinfo.ZoneInfo('America/Chicago')
+
+
+def local(*args):
+    return datetime.datetime(*args, tzinfo=CHICAGO).astimezone(datetime.timezone.utc)
+
+
+def hours(intervals):
+    return sum((end - start).total_seconds() for start, end, *_ in intervals) / 3600
+
+
+class SplitDaysTests(SimpleTestCase):
+    def test_spring_forward_day_has_23_hours(self):
+        days = split_days([(local(2024, 3, 9, 20), local(2024, 3, 11, 4), 'driving', 'I-55', 'Driving')], CHICAGO)
+        self.assertEqual([date for date, _ in days], [
+            datetime.date(2024, 3, 9), datetime.date(2024, 3, 10), datetime.date(2024, 3, 11),
+        ])
+        self.assertEqual([hours(intervals) for _, intervals in days], [4, 23, 4])
+        self.assertEqual(days[1][1][0][0], local(2024, 3, 10, 0))
+        self.assertEqual(days[1][1][0][1], local(2024, 3, 11, 0))
+
+    def test_fall_back_day_has_25_hours(self):
+        days = split_days([(local(2024, 11, 2, 22), local(2024, 11, 4, 1), 'driving', 'I-55', 'Driving')], CHICAGO)
+        self.assertEqual([hours(intervals) for _, intervals in days], [2, 25, 1])
+
+    def test_parts_after_midnight_are_marked_continued(self):
+        days = split_days([
+            (local(2024, 3, 9, 22), local(2024, 3, 9, 23), 'on_duty', 'Chicago', 'Pickup'),
+            (local(2024, 3, 9, 23), local(2024, 3, 10, 5), 'sleeper', 'Chicago', 'Sleep'),
+        ], CHICAGO)
+        self.assertEqual([len(intervals) for _, intervals in days], [2, 1])
+        self.assertEqual(days[0][1][1][4], 'Sleep')
+        self.assertEqual(days[1][1][0][4], f"Sleep{CONTINUED_REMARK}")
+
+    def test_interval_ending_at_midnight_stays_on_its_day(self):
+        days = split_days([(local(2024, 3, 9, 20), local(2024, 3, 10, 0), 'driving', 'I-55', None)], CHICAGO)
+        self.assertEqual([date for date, _ in days], [datetime.date(2024, 3, 9)])
+
+
+class GenerateDailyLogsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        driver = User.objects.create(username='driver')
+        cls.pickup = Location.objects.create(name='Chicago, IL', latitude=41.8781, longitude=-87.6298)
+        cls.dropoff = Location.objects.create(name='Memphis, TN', latitude=35.1495, longitude=-90.0490)
+        cls.trip = Trip.objects.create(
+            driver=driver, current_location=cls.pickup, pickup_location=cls.pickup,
+            dropoff_location=cls.dropoff, current_cycle_hours=0, client_timezone='America/Chicago',
+        )
+
+    def plan(self, pickup_time, dropoff_time):
+        """Replace the trip's stops with a pickup and a dropoff of an hour each, and generate its logs"""
+        RouteStop.objects.filter(trip=self.trip).delete()
+        for location, arrival, stop_type in ((self.pickup, pickup_time, 'pickup'), (self.dropoff, dropoff_time, 'dropoff')):
+            RouteStop.objects.create(
+                trip=self.trip, location=location, stop_type=stop_type,
+                arrival_time=arrival, departure_time=arrival + datetime.timedelta(hours=1),
+            )
+        return generate_daily_logs_for_trip(self.trip)
+
+    def test_days_cover_dst_transition(self):
+        daily_logs = self.plan(local(2024, 3, 9, 20), local(2024, 3, 11, 2))
+        self.assertEqual([daily_log.date for daily_log in daily_logs], [
+            datetime.date(2024, 3, 9), datetime.date(2024, 3, 10), datetime.date(2024, 3, 11),
+        ])
+        entries = LogEntry.objects.current().filter(daily_log=daily_logs[1]).order_by('start_time')
+        self.assertEqual(hours((entry.start_time, entry.end_time) for entry in entries), 23)
+        self.assertEqual({entry.status for entry in entries}, {'driving'})
+
+    def test_replan_drops_days_no_longer_covered(self):
+        first = self.plan(local(2024, 3, 9, 20), local(2024, 3, 11, 2))
+        dropped = first[2]
+        dropped_version = current_version('daily_log', dropped.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second = self.plan(local(2024, 3, 9, 20), local(2024, 3, 10, 10))
+        self.assertEqual([daily_log.date for daily_log in second], [datetime.date(2024, 3, 9), datetime.date(2024, 3, 10)])
+        self.assertEqual([daily_log.id for daily_log in second], [daily_log.id for daily_log in first[:2]])
+        self.assertEqual(
+            list(DailyLog.objects.filter(trip=self.trip).order_by('date').values_list('date', 'version')),
+            [(datetime.date(2024, 3, 9), 2), (datetime.date(2024, 3, 10), 2)],
+        )
+        self.assertFalse(LogEntry.objects.filter(daily_log_id=dropped.id).exists())
+        # Cached responses of the dropped log are no longer served
+        self.assertNotEqual(current_version('daily_log', dropped.id), dropped_version)
+
+        # The kept days serve their new entries; the earlier ones stay for audit until pruned
+        last_day = LogEntry.objects.current().filter(daily_log=second[1]).order_by('start_time')
+        self.assertEqual(last_day.last().status, 'on_duty')
+        self.assertEqual(last_day.last().end_time, local(2024, 3, 10, 11))
+        self.assertTrue(LogEntry.objects.filter(daily_log=second[1], version=1).exists())
+
+        call_command('prune_log_entries', stdout=io.StringIO())
+        self.assertFalse(LogEntry.objects.filter(daily_log__trip=self.trip, version=1).exists())
+        self.assertEqual(LogEntry.objects.filter(daily_log__trip=self.trip).count(),
+                         LogEntry.objects.current().filter(daily_log__trip=self.trip).count())
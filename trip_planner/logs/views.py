@@ -2,16 +2,40 @@ from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
+from django.db.models import Prefetch
+from django.http import Http404
 from .models import DailyLog, LogEntry
-from .serializers import DailyLogSerializer, LogEntrySerializer
+from .serializers import DailyLogSerializer, LogEntrySerializer, daily_log_rows, log_entry_rows
 from .log_generator import generate_log_image
+from trip_planner.response_cache import CachedRetrieveMixin, bump_versions
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 
 
-class DailyLogViewSet(viewsets.ModelViewSet):
-    queryset = DailyLog.objects.all()
+class DailyLogViewSet(CachedRetrieveMixin, viewsets.ModelViewSet):
+    queryset = DailyLog.objects.prefetch_related(Prefetch(
+        'entries',
+        queryset=LogEntry.objects.current().select_related('location_text', 'remarks_text').order_by('id'),
+        to_attr='_current_entries'
+    ))
     serializer_class = DailyLogSerializer
+    cache_kind = 'daily_log'
+    
+    # Reads build plain dicts from values() queries instead of serializer
+    # instances; writes go through DailyLogSerializer
+    
+    def list(self, request, *args, **kwargs):
+        if self.paginator is not None:
+            return super().list(request, *args, **kwargs)
+        return Response(daily_log_rows(self.filter_queryset(self.get_queryset()), request))
+    
+    def retrieve_data(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        rows = daily_log_rows(queryset, request)
+        if not rows:
+            raise Http404
+        return rows[0]
     
     @action(detail=True, methods=['get'])
     def generate_image(self, request, pk=None):
@@ -30,5 +54,16 @@ class DailyLogViewSet(viewsets.ModelViewSet):
         })
         
 class LogEntryViewSet(viewsets.ModelViewSet):
-    queryset = LogEntry.objects.all()
-    serializer_class = LogEntrySerializer
\ No newline at end of file
+    # Superseded versions are kept for audit but not served
+    queryset = LogEntry.objects.current().select_related('location_text', 'remarks_text')
+    serializer_class = LogEntrySerializer
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        # Entry deletes send no cache signals
+        bump_versions('daily_log', [instance.daily_log_id])
+    
+    def list(self, request, *args, **kwargs):
+        if self.paginator is not None:
+            return super().list(request, *args, **kwargs)
+        return Response(log_entry_rows(self.filter_queryset(self.get_queryset())))
\ No newline at end of file
@@ -1,10 +1,45 @@
 from django.contrib import admin
+from trip_planner.response_cache import bump_versions
 from .models import *
 
 # Register your models here.
-admin.site.register(Location)
+class LocationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'latitude', 'longitude', 'is_waypoint')
+    list_filter = ('is_waypoint',)
+    search_fields = ('name', 'address')
+
+class FuelStationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'price_per_gallon', 'latitude', 'longitude', 'updated_at')
+    search_fields = ('name', 'external_id')
+
+class TrafficProfileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'latitude', 'longitude', 'radius_meters', 'timezone', 'updated_at')
+    search_fields = ('name',)
+
+class RouteStopAdmin(admin.ModelAdmin):
+    # Stop deletes send no cache signals
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_versions('trip', [obj.trip_id])
+
+    def delete_queryset(self, request, queryset):
+        trip_ids = set(queryset.values_list('trip_id', flat=True))
+        super().delete_queryset(request, queryset)
+        bump_versions('trip', trip_ids)
+
+class WeeklyRollupAdmin(admin.ModelAdmin):
+    list_display = ('week', 'driver', 'pickup_location', 'dropoff_location', 'trips', 'planned_miles', 'actual_miles')
+    list_filter = ('week',)
+
+admin.site.register(Location, LocationAdmin)
 admin.site.register(Trip)
-admin.site.register(RouteStop)
+admin.site.register(RouteStop, RouteStopAdmin)
+admin.site.register(PlanSnapshot)
+admin.site.register(FuelStation, FuelStationAdmin)
+admin.site.register(TrafficProfile, TrafficProfileAdmin)
+admin.site.register(TripProgress)
+admin.site.register(TripRollup)
+admin.site.register(WeeklyRollup, WeeklyRollupAdmin)
 
 
 
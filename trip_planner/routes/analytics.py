@@ -0,0 +1,221 @@
+"""
+Rollups of planned trips for the analytics endpoint
+
+Each trip's totals (planned and covered miles, rest, sleep and fuel stops,
+the days and hours of driving in its daily logs) are kept in a TripRollup
+row, and summed per driver, lane and departure week in WeeklyRollup rows.
+The weekly rows are updated by adding the change in a trip's totals when it
+is planned, when pings move it along its route and when it is deleted or
+changes driver or lane, so reports read a row per driver, lane and week
+however many trips and log entries those cover.
+"""
+import datetime
+import zoneinfo
+
+from django.db.models import Case, F, FloatField, IntegerField, Sum, Value, When
+
+from logs.log_generator import duty_intervals, split_days
+from .models import RollupTotals, TripRollup, WeeklyRollup
+
+# Identify a weekly rollup row
+KEY_FIELDS = ('week', 'driver_id', 'pickup_location_id', 'dropoff_location_id')
+# Totals counting stops, by stop type
+STOP_COUNTS = {'rest': 'rest_stops', 'sleep': 'sleep_stops', 'fuel': 'fuel_stops'}
+FLOAT_FIELDS = ('planned_miles', 'actual_miles', 'driving_hours')
+# Report columns of each grouping
+GROUP_COLUMNS = {
+    'driver': ('driver_id', 'driver__username'),
+    'lane': ('pickup_location_id', 'pickup_location__name', 'dropoff_location_id', 'dropoff_location__name'),
+    'week': ('week',),
+}
+REPORT_COLUMN_NAMES = {
+    'driver_id': 'driver', 'driver__username': 'driver_username',
+    'pickup_location_id': 'pickup_location', 'pickup_location__name': 'pickup_location_name',
+    'dropoff_location_id': 'dropoff_location', 'dropoff_location__name': 'dropoff_location_name',
+}
+
+
+def departure_week(departure_time, timezone_name):
+    """Monday of the week of departure_time in a timezone"""
+    local_date = departure_time.astimezone(zoneinfo.ZoneInfo(timezone_name or 'UTC')).date()
+    return local_date - datetime.timedelta(days=local_date.weekday())
+
+
+def plan_totals(trip, stops):
+    """Totals of a plan as {RollupTotals field: value}, except actual_miles"""
+    # In the order the daily logs are generated from, which is by arrival
+    # then by insertion; schedule_stops can list a stop before an earlier one
+    stops = sorted(stops, key=lambda stop: stop.arrival_time)
+    totals = dict.fromkeys(STOP_COUNTS.values(), 0)
+    for stop in stops:
+        if stop.stop_type in STOP_COUNTS:
+            totals[STOP_COUNTS[stop.stop_type]] += 1
+    totals['planned_miles'] = max((stop.position_miles or 0 for stop in stops), default=0)
+
+    # The days and driving of the daily logs generated from these stops
+    days = split_days(duty_intervals(stops), zoneinfo.ZoneInfo(trip.client_timezone or 'UTC'))
+    totals['log_days'] = len(days)
+    totals['driving_hours'] = sum(
+        (end - start).total_seconds()
+        for _, intervals in days
+        for start, end, status, _, _ in intervals
+        if status == 'driving'
+    ) / 3600
+    return totals
+
+
+def _set_key(rollup, trip):
+    rollup.driver_id = trip.driver_id
+    rollup.pickup_location_id = trip.pickup_location_id
+    rollup.dropoff_location_id = trip.dropoff_location_id
+    rollup.week = departure_week(rollup.departure_time, trip.client_timezone)
+
+
+def _key(rollup):
+    return tuple(getattr(rollup, field) for field in KEY_FIELDS)
+
+
+def _counted(rollup, sign=1):
+    """{weekly rollup key: {field: change}} counting a trip rollup in (or, with sign -1, out of) its week"""
+    return {_key(rollup): {'trips': sign, **{field: sign * getattr(rollup, field) for field in RollupTotals.FIELDS}}}
+
+
+def _combine(*changes):
+    combined = {}
+    for change in changes:
+        for key, fields in change.items():
+            totals = combined.setdefault(key, {})
+            for field, value in fields.items():
+                totals[field] = totals.get(field, 0) + value
+    return combined
+
+
+def update_trip_rollup(trip, stops):
+    """
+    Count a trip's new plan (its saved stops) in the rollups, in place of
+    its previous plan
+    """
+    if not stops:
+        return
+    rollup = TripRollup.objects.filter(trip=trip).first()
+    if rollup is None:
+        rollup, before = TripRollup(trip=trip), {}
+    else:
+        before = _counted(rollup, -1)
+    for field, value in plan_totals(trip, stops).items():
+        setattr(rollup, field, value)
+    rollup.departure_time = min(stop.arrival_time for stop in stops)
+    _set_key(rollup, trip)
+    rollup.save()
+    _apply(_combine(before, _counted(rollup)))
+
+
+def rekey_trip_rollup(trip):
+    """Move a trip's totals to the weekly rollup of its current driver, lane and timezone"""
+    rollup = TripRollup.objects.filter(trip=trip).first()
+    if rollup is None:
+        return
+    before = _key(rollup)
+    _set_key(rollup, trip)
+    if _key(rollup) == before:
+        return
+    moved = _counted(rollup)
+    rollup.save()
+    _apply(_combine({before: {field: -value for field, value in moved[_key(rollup)].items()}}, moved))
+
+
+def remove_trip_rollup(trip):
+    """Take a trip's totals out of its weekly rollup"""
+    rollup = TripRollup.objects.filter(trip=trip).first()
+    if rollup is not None:
+        _apply(_counted(rollup, -1))
+
+
+def update_actual_miles(positions):
+    """Record the route miles trips have covered, given as {trip id: miles}"""
+    rollups = list(TripRollup.objects.filter(trip_id__in=positions))
+    changes, changed = {}, []
+    for rollup in rollups:
+        change = positions[rollup.trip_id] - rollup.actual_miles
+        if change:
+            rollup.actual_miles = positions[rollup.trip_id]
+            changed.append(rollup)
+            changes = _combine(changes, {_key(rollup): {'actual_miles': change}})
+    if changed:
+        TripRollup.objects.bulk_update(changed, ['actual_miles'])
+        _apply(changes)
+
+
+def _rollup_ids(keys):
+    """Return {key: weekly rollup id} for a collection of keys, inserting the missing rows"""
+    keys = set(keys)
+
+    def existing():
+        # Narrow by each key field, then match whole keys
+        rows = WeeklyRollup.objects.filter(**{
+            f'{field}__in': {key[index] for key in keys} for index, field in enumerate(KEY_FIELDS)
+        }).values_list('id', *KEY_FIELDS)
+        return {tuple(row[1:]): row[0] for row in rows if tuple(row[1:]) in keys}
+
+    ids = existing()
+    missing = keys - ids.keys()
+    if missing:
+        # Concurrent writers may insert the same rows
+        WeeklyRollup.objects.bulk_create(
+            [WeeklyRollup(**dict(zip(KEY_FIELDS, key))) for key in missing], ignore_conflicts=True
+        )
+        ids = existing()
+    return ids
+
+
+def _apply(changes):
+    """
+    Add {key: {field: change}} to the weekly rollup rows, in one UPDATE
+
+    Rows are changed by relative updates, so concurrent writers don't
+    overwrite each other's changes; rows left without trips are deleted.
+    """
+    changes = {key: fields for key, fields in changes.items() if any(fields.values())}
+    if not changes:
+        return
+    ids = _rollup_ids(changes)
+    fields = {field for key_fields in changes.values() for field, value in key_fields.items() if value}
+    updates = {}
+    for field in fields:
+        output_field = FloatField() if field in FLOAT_FIELDS else IntegerField()
+        updates[field] = F(field) + Case(
+            *(When(id=ids[key], then=Value(key_fields[field]))
+              for key, key_fields in changes.items() if key_fields.get(field)),
+            default=Value(0), output_field=output_field,
+        )
+    WeeklyRollup.objects.filter(id__in=ids.values()).update(**updates)
+
+    emptied = [ids[key] for key, key_fields in changes.items() if key_fields.get('trips', 0) < 0]
+    if emptied:
+        WeeklyRollup.objects.filter(id__in=emptied, trips=0).delete()
+
+
+def rollup_report(rows, group_by):
+    """
+    Sum weekly rollup rows (a WeeklyRollup queryset) by the group_by
+    dimensions ('driver', 'lane' and/or 'week'), as a list of dicts
+    """
+    columns = [column for group in group_by for column in GROUP_COLUMNS[group]]
+    sums = {'total_trips': Sum('trips'), **{f'total_{field}': Sum(field) for field in RollupTotals.FIELDS}}
+    if columns:
+        groups = rows.values(*columns).annotate(**sums).order_by(*columns)
+    else:
+        groups = [rows.aggregate(**sums)]
+
+    report = []
+    for group in groups:
+        row = {REPORT_COLUMN_NAMES.get(column, column): group[column] for column in columns}
+        row['trips'] = group['total_trips'] or 0
+        for field in RollupTotals.FIELDS:
+            value = group[f'total_{field}'] or 0
+            row[field] = round(value, 2) if field in FLOAT_FIELDS else value
+        row['average_daily_driving_hours'] = (
+            round(group['total_driving_hours'] / group['total_log_days'], 2) if group['total_log_days'] else None
+        )
+        report.append(row)
+    return report
@@ -0,0 +1,99 @@
+import math
+
+from .geo import haversine_meters
+from .osrm_stub import OSRMStubServer
+from .road_graph import StraightLineRouter
+
+# Synthetic trips covering the range of plans the planner produces.
+# Each location is (name, latitude, longitude).
+BENCHMARK_TRIPS = {
+    'short': {
+        'current': ('Dallas, TX', 32.7767, -96.7970),
+        'pickup': ('Irving, TX', 32.8140, -96.9489),
+        'dropoff': ('Fort Worth, TX', 32.7555, -97.3308),
+        'cycle_hours': 10,
+    },
+    'regional': {
+        'current': ('Chicago, IL', 41.8781, -87.6298),
+        'pickup': ('Indianapolis, IN', 39.7684, -86.1581),
+        'dropoff': ('Nashville, TN', 36.1627, -86.7816),
+        'cycle_hours': 20,
+    },
+    'coast_to_coast': {
+        'current': ('New York, NY', 40.7128, -74.0060),
+        'pickup': ('Chicago, IL', 41.8781, -87.6298),
+        'dropoff': ('Los Angeles, CA', 34.0522, -118.2437),
+        'cycle_hours': 30,
+    },
+    # About ten days on the road
+    'long_haul': {
+        'current': ('Miami, FL', 25.7617, -80.1918),
+        'pickup': ('Seattle, WA', 47.6062, -122.3321),
+        'dropoff': ('Boston, MA', 42.3601, -71.0589),
+        'cycle_hours': 0,
+    },
+}
+
+ROAD_DETOUR_FACTOR = 1.15  # Road distance relative to great-circle distance
+RECORDED_SPEED_MPS = 24.6  # Roughly 55 mph including slowdowns
+POINT_SPACING_METERS = 200  # Similar density to OSRM "overview=full" geometry
+
+
+def recorded_route(start, end):
+    """
+    Build a route between two (lon, lat) points as the stub router returns it
+
+    The geometry is a gently curving line with OSRM-like point density, so
+    routes are deterministic and realistic in size without network access.
+    """
+    lon1, lat1 = start
+    lon2, lat2 = end
+    distance = haversine_meters(lat1, lon1, lat2, lon2) * ROAD_DETOUR_FACTOR
+    points = max(2, int(distance / POINT_SPACING_METERS))
+
+    coordinates = []
+    for i in range(points):
+        t = i / (points - 1)
+        # Offset perpendicular to the straight line so the route is not trivial
+        bend = 0.02 * math.sin(math.pi * t) * math.sin(12 * math.pi * t)
+        lat = lat1 + (lat2 - lat1) * t + bend * (lon2 - lon1)
+        lon = lon1 + (lon2 - lon1) * t - bend * (lat2 - lat1)
+        coordinates.append([round(lon, 6), round(lat, 6)])
+
+    duration = distance / RECORDED_SPEED_MPS
+    return {
+        'distance': distance,
+        'duration': duration,
+        'coordinates': coordinates,
+        'legs': [{'distance': distance, 'duration': duration}],
+        'waypoints': [
+            {'location': [lon1, lat1], 'distance': 0.0},
+            {'location': [lon2, lat2], 'distance': 0.0},
+        ],
+    }
+
+
+def recorded_routes():
+    """Return {((lon, lat), (lon, lat)): route} for every leg of every benchmark trip"""
+    routes = {}
+    for trip in BENCHMARK_TRIPS.values():
+        legs = ((trip['current'], trip['pickup']), (trip['pickup'], trip['dropoff']))
+        for (_, lat1, lon1), (_, lat2, lon2) in legs:
+            routes[((lon1, lat1), (lon2, lat2))] = recorded_route((lon1, lat1), (lon2, lat2))
+    return routes
+
+
+class RecordedRouter(StraightLineRouter):
+    """Answer route requests from recorded routes only"""
+
+    def __init__(self, routes=None):
+        super().__init__(ROAD_DETOUR_FACTOR, RECORDED_SPEED_MPS * 3.6)
+        self.routes = routes if routes is not None else recorded_routes()
+
+    def route(self, waypoints):
+        return self.routes.get(tuple(waypoints))
+
+
+def recorded_osrm_server():
+    """Local OSRM stub server replaying the benchmark routes on a free port"""
+    return OSRMStubServer(RecordedRouter())
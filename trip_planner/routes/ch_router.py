@@ -0,0 +1,363 @@
+"""
+In-process routing with contraction hierarchies
+
+A RoadGraph (see routes.road_graph) is preprocessed once with
+``manage.py build_routing_graph`` into a single binary file of flat arrays:
+
+    b'CHG1' | header length (uint32) | JSON header | padding | arrays...
+
+The header lists each array's type code, byte offset and length. At runtime
+the file is memory-mapped read-only and the arrays are used in place through
+memoryviews, so every worker process shares the same pages.
+
+Edges are identified by index. Original edges point at their geometry;
+shortcuts created during contraction point at the two edges they replace and
+are unpacked recursively after a query.
+"""
+import bisect
+import functools
+import heapq
+import json
+import math
+import mmap
+import struct
+from array import array
+
+from .geo import haversine_meters
+from .road_graph import RoadGraphRouter
+
+MAGIC = b'CHG1'
+GRID_CELL_DEGREES = 0.25  # Cell size of the nearest-node index
+WITNESS_SETTLE_LIMIT = 500  # Nodes settled per witness search before assuming no witness
+
+
+def _grid_key(lat, lon):
+    row = int(math.floor((lat + 90) / GRID_CELL_DEGREES))
+    col = int(math.floor((lon + 180) / GRID_CELL_DEGREES))
+    return row * 100000 + col
+
+
+def _witness_distance(out_edges, edge_weight, source, target, skip, limit):
+    """Shortest distance source -> target avoiding `skip`, searching no further than limit"""
+    distances = {source: 0.0}
+    queue = [(0.0, source)]
+    settled = 0
+    while queue and settled < WITNESS_SETTLE_LIMIT:
+        distance, node = heapq.heappop(queue)
+        if node == target:
+            return distance
+        if distance > limit:
+            break
+        if distance > distances[node]:
+            continue
+        settled += 1
+        for neighbour, edge in out_edges[node].items():
+            if neighbour == skip:
+                continue
+            candidate = distance + edge_weight[edge]
+            if candidate < distances.get(neighbour, math.inf):
+                distances[neighbour] = candidate
+                heapq.heappush(queue, (candidate, neighbour))
+    return math.inf
+
+
+def build_contraction_hierarchy(graph):
+    """
+    Contract a RoadGraph and return {name: array} ready for write_ch_file
+
+    Nodes are contracted in order of edge difference (shortcuts added minus
+    edges removed), updated lazily, with a penalty for contracted neighbours
+    to keep the hierarchy balanced.
+    """
+    node_count = len(graph.node_ids)
+
+    edge_weight = []
+    edge_distance = []
+    edge_children = []
+    edge_geometry = []
+    geometries = []
+
+    out_edges = [dict() for _ in range(node_count)]
+    in_edges = [dict() for _ in range(node_count)]
+
+    def add_edge(u, v, weight, distance, children, geometry):
+        existing = out_edges[u].get(v)
+        if existing is not None and edge_weight[existing] <= weight:
+            return
+        edge_weight.append(weight)
+        edge_distance.append(distance)
+        edge_children.append(children)
+        edge_geometry.append(geometry)
+        out_edges[u][v] = in_edges[v][u] = len(edge_weight) - 1
+
+    for u, neighbours in enumerate(graph.adjacency):
+        for v, duration, distance, coordinates in neighbours:
+            if u == v:
+                continue
+            geometries.append(coordinates)
+            add_edge(u, v, duration, distance, (-1, -1), len(geometries) - 1)
+
+    contracted = [False] * node_count
+    contracted_neighbours = [0] * node_count
+
+    def shortcuts_needed(node):
+        shortcuts = []
+        for u, in_edge in in_edges[node].items():
+            for v, out_edge in out_edges[node].items():
+                if u == v:
+                    continue
+                via = edge_weight[in_edge] + edge_weight[out_edge]
+                if _witness_distance(out_edges, edge_weight, u, v, node, via) > via:
+                    shortcuts.append((u, v, in_edge, out_edge, via))
+        return shortcuts
+
+    def priority(node):
+        removed = len(in_edges[node]) + len(out_edges[node])
+        return len(shortcuts_needed(node)) - removed + contracted_neighbours[node]
+
+    queue = [(priority(node), node) for node in range(node_count)]
+    heapq.heapify(queue)
+
+    forward_up = [[] for _ in range(node_count)]
+    backward_up = [[] for _ in range(node_count)]
+    while queue:
+        _, node = heapq.heappop(queue)
+        if contracted[node]:
+            continue
+        # Lazy update: re-queue if the node is no longer the cheapest
+        current = priority(node)
+        if queue and current > queue[0][0]:
+            heapq.heappush(queue, (current, node))
+            continue
+
+        for u, v, in_edge, out_edge, via in shortcuts_needed(node):
+            add_edge(u, v, via, edge_distance[in_edge] + edge_distance[out_edge],
+                     (in_edge, out_edge), -1)
+
+        # Remaining edges all lead to higher-ranked nodes
+        forward_up[node] = list(out_edges[node].items())
+        backward_up[node] = list(in_edges[node].items())
+        for v in out_edges[node]:
+            del in_edges[v][node]
+            contracted_neighbours[v] += 1
+        for u in in_edges[node]:
+            del out_edges[u][node]
+            contracted_neighbours[u] += 1
+        out_edges[node] = {}
+        in_edges[node] = {}
+
+        contracted[node] = True
+
+    def csr(adjacency):
+        offsets, targets, edges = array('i', [0]), array('i'), array('i')
+        for neighbours in adjacency:
+            for neighbour, edge in neighbours:
+                targets.append(neighbour)
+                edges.append(edge)
+            offsets.append(len(targets))
+        return offsets, targets, edges
+
+    forward_offsets, forward_targets, forward_edges = csr(forward_up)
+    backward_offsets, backward_sources, backward_edges = csr(backward_up)
+
+    geometry_offsets, geometry_coordinates = array('i', [0]), array('d')
+    for coordinates in geometries:
+        for lon, lat in coordinates:
+            geometry_coordinates.extend((lon, lat))
+        geometry_offsets.append(len(geometry_coordinates) // 2)
+
+    cells = {}
+    for node in range(node_count):
+        cells.setdefault(_grid_key(graph.lats[node], graph.lons[node]), []).append(node)
+    grid_keys, grid_offsets, grid_nodes = array('q'), array('i', [0]), array('i')
+    for key in sorted(cells):
+        grid_keys.append(key)
+        grid_nodes.extend(cells[key])
+        grid_offsets.append(len(grid_nodes))
+
+    return {
+        'node_lat': array('d', graph.lats),
+        'node_lon': array('d', graph.lons),
+        'forward_offsets': forward_offsets,
+        'forward_targets': forward_targets,
+        'forward_edges': forward_edges,
+        'backward_offsets': backward_offsets,
+        'backward_sources': backward_sources,
+        'backward_edges': backward_edges,
+        'edge_weight': array('d', edge_weight),
+        'edge_distance': array('d', edge_distance),
+        'edge_child1': array('i', (children[0] for children in edge_children)),
+        'edge_child2': array('i', (children[1] for children in edge_children)),
+        'edge_geometry': array('i', edge_geometry),
+        'geometry_offsets': geometry_offsets,
+        'geometry_coordinates': geometry_coordinates,
+        'grid_keys': grid_keys,
+        'grid_offsets': grid_offsets,
+        'grid_nodes': grid_nodes,
+    }
+
+
+def write_ch_file(arrays, path):
+    """Write arrays from build_contraction_hierarchy to a memory-mappable file"""
+    entries = {}
+    offset = 0
+    for name, values in arrays.items():
+        entries[name] = {'type': values.typecode, 'offset': offset, 'count': len(values)}
+        # Keep every array 8-byte aligned
+        offset += (len(values) * values.itemsize + 7) // 8 * 8
+
+    header = json.dumps({'arrays': entries}).encode('utf-8')
+    data_start = (len(MAGIC) + 4 + len(header) + 7) // 8 * 8
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_start - f.tell()))
+        for name, values in arrays.items():
+            raw = values.tobytes()
+            f.write(raw)
+            f.write(b'\0' * ((len(raw) + 7) // 8 * 8 - len(raw)))
+
+
+class CHGraph:
+    """Read-only contraction hierarchy backed by a memory-mapped file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:4]) != MAGIC:
+            raise ValueError(f"{path} is not a contraction hierarchy file")
+        header_length = struct.unpack('<I', buffer[4:8])[0]
+        header = json.loads(bytes(buffer[8:8 + header_length]))
+        data_start = (8 + header_length + 7) // 8 * 8
+
+        for name, entry in header['arrays'].items():
+            itemsize = array(entry['type']).itemsize
+            start = data_start + entry['offset']
+            view = buffer[start:start + entry['count'] * itemsize].cast(entry['type'])
+            setattr(self, name, view)
+
+        self.node_count = len(self.node_lat)
+        # Same names as RoadGraph, so RoadGraphRouter can snap to either
+        self.lats = self.node_lat
+        self.lons = self.node_lon
+
+    def nearest_node(self, lon, lat):
+        """Return (node, distance_m) of the node closest to a point"""
+        best, best_distance = None, math.inf
+        ring = 0
+        max_ring = int(180 / GRID_CELL_DEGREES)
+        center = _grid_key(lat, lon)
+        while ring <= max_ring:
+            for row in range(-ring, ring + 1):
+                for col in range(-ring, ring + 1):
+                    # Only visit the border of the ring
+                    if ring and abs(row) != ring and abs(col) != ring:
+                        continue
+                    key = center + row * 100000 + col
+                    index = bisect.bisect_left(self.grid_keys, key)
+                    if index == len(self.grid_keys) or self.grid_keys[index] != key:
+                        continue
+                    for i in range(self.grid_offsets[index], self.grid_offsets[index + 1]):
+                        node = self.grid_nodes[i]
+                        distance = haversine_meters(lat, lon, self.node_lat[node], self.node_lon[node])
+                        if distance < best_distance:
+                            best, best_distance = node, distance
+            # Cells beyond the next ring are at least `ring` cells away
+            if best is not None and best_distance < ring * GRID_CELL_DEGREES * 111000 * 0.5:
+                break
+            ring += 1
+        return best, best_distance
+
+    def shortest_path(self, source, target):
+        """
+        Bidirectional upward search minimising duration
+
+        Returns (duration_s, distance_m, coordinates) or None if unreachable.
+        """
+        if source == target:
+            return 0.0, 0.0, [[self.node_lon[source], self.node_lat[source]]]
+
+        forward = self._upward_search(source, self.forward_offsets, self.forward_targets, self.forward_edges)
+        backward = self._upward_search(target, self.backward_offsets, self.backward_sources, self.backward_edges)
+
+        best, meeting = math.inf, None
+        for node, (distance, _) in forward.items():
+            other = backward.get(node)
+            if other is not None and distance + other[0] < best:
+                best, meeting = distance + other[0], node
+        if meeting is None:
+            return None
+
+        # Edges from source to the meeting node, then on to the target
+        path_edges = []
+        node = meeting
+        while node != source:
+            edge, node = forward[node][1]
+            path_edges.append(edge)
+        path_edges.reverse()
+        node = meeting
+        while node != target:
+            edge, node = backward[node][1]
+            path_edges.append(edge)
+
+        distance = 0.0
+        coordinates = []
+        for edge in self._unpack(path_edges):
+            distance += self.edge_distance[edge]
+            geometry = self.edge_geometry[edge]
+            start, end = self.geometry_offsets[geometry], self.geometry_offsets[geometry + 1]
+            points = [
+                [self.geometry_coordinates[2 * i], self.geometry_coordinates[2 * i + 1]]
+                for i in range(start, end)
+            ]
+            coordinates.extend(points[1:] if coordinates else points)
+        return best, distance, coordinates
+
+    def _upward_search(self, origin, offsets, neighbours, edges):
+        """Dijkstra over upward edges; returns {node: (distance, (edge, previous) or None)}"""
+        settled = {}
+        best = {origin: (0.0, None)}
+        queue = [(0.0, origin)]
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if node in settled:
+                continue
+            settled[node] = best[node]
+            for i in range(offsets[node], offsets[node + 1]):
+                neighbour = neighbours[i]
+                edge = edges[i]
+                candidate = distance + self.edge_weight[edge]
+                if candidate < best.get(neighbour, (math.inf,))[0]:
+                    best[neighbour] = (candidate, (edge, node))
+                    heapq.heappush(queue, (candidate, neighbour))
+        return settled
+
+    def _unpack(self, path_edges):
+        """Expand shortcuts into original edges, in path order"""
+        stack = list(reversed(path_edges))
+        while stack:
+            edge = stack.pop()
+            first = self.edge_child1[edge]
+            if first < 0:
+                yield edge
+            else:
+                stack.append(self.edge_child2[edge])
+                stack.append(first)
+
+
+class CHRouter(RoadGraphRouter):
+    """Route over a memory-mapped contraction hierarchy (see RoadGraphRouter)"""
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        return cls(CHGraph(path), **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def load_ch_router(path):
+    """Open (once per process) the router for a contraction hierarchy file"""
+    return CHRouter.open(path)
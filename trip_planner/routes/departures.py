@@ -0,0 +1,81 @@
+"""
+Departure time search
+
+Runs the HOS simulation (schedule_stops) for a range of candidate departure
+times over one route, fuel plan and traffic model, and keeps the options
+that no other candidate beats on both arrival time and number of overnight
+rests. When the trip takes the same time and rests whenever it leaves (no
+traffic profile covers the route), there is nothing to trade off and every
+candidate is returned.
+"""
+import datetime
+
+from .route_planning import schedule_stops
+
+DEFAULT_WINDOW_HOURS = 48
+DEFAULT_STEP_MINUTES = 15
+MAX_CANDIDATES = 1000
+
+
+def candidate_departures(start, window_hours, step_minutes):
+    """Departure times from start to start + window_hours inclusive, step_minutes apart"""
+    step = datetime.timedelta(minutes=step_minutes)
+    count = int(window_hours * 60 // step_minutes) + 1
+    return [start + step * index for index in range(count)]
+
+
+def plan_summary(departure_time, stops):
+    """Dropoff arrival, trip hours and numbers of sleep stops and breaks of a schedule"""
+    dropoff = stops[-1]
+    return {
+        'departure_time': departure_time,
+        'arrival_time': dropoff.arrival_time,
+        'trip_hours': (dropoff.arrival_time - departure_time).total_seconds() / 3600,
+        'sleep_stops': sum(1 for stop in stops if stop.stop_type == 'sleep'),
+        'breaks': sum(1 for stop in stops[1:] if stop.stop_type in ('rest', 'fuel')),
+    }
+
+
+def sweep_departures(trip, route_data, departures, fuel_plan=None, traffic=None):
+    """
+    Simulate the trip from each departure time, without touching the database
+
+    Returns one option per departure: its dropoff arrival time, trip hours
+    and numbers of sleep stops and breaks. Without a traffic model the
+    simulation doesn't depend on the time of day, so it runs once and is
+    shifted to the other departures.
+    """
+    if not departures:
+        return []
+    if traffic is None:
+        first = plan_summary(departures[0], schedule_stops(trip, route_data, departures[0], fuel_plan))
+        return [
+            dict(first, departure_time=departure, arrival_time=first['arrival_time'] + (departure - departures[0]))
+            for departure in departures
+        ]
+    return [
+        plan_summary(departure, schedule_stops(trip, route_data, departure, fuel_plan, traffic))
+        for departure in departures
+    ]
+
+
+def varies_by_departure(options):
+    """Whether trip hours or overnight stops differ between departure times"""
+    return len({(round(option['trip_hours'], 6), option['sleep_stops']) for option in options}) > 1
+
+
+def pareto_options(options):
+    """
+    Options not dominated on (arrival time, sleep stops), earliest arrival
+    first; of options with the same arrival and sleep stops, the latest
+    departure is kept, since it leaves the driver the most time
+    """
+    best = []
+    fewest_sleeps = None
+    ordered = sorted(options, key=lambda option: (option['arrival_time'], option['sleep_stops'], -option['departure_time'].timestamp()))
+    for option in ordered:
+        # Anything arriving later must make fewer overnight stops to be kept
+        if fewest_sleeps is None or option['sleep_stops'] < fewest_sleeps:
+            best.append(option)
+            fewest_sleeps = option['sleep_stops']
+    return best
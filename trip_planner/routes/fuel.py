@@ -0,0 +1,303 @@
+"""
+Fuel stop planning over a local table of station prices
+
+Stations within FUEL_CORRIDOR_MILES of the route are fetched through the
+geohash cells along it and placed at their route miles. A dynamic-programming pass over them then chooses where to stop and
+how many gallons to buy so the trip's fuel costs least, given the truck's
+tank capacity and fuel economy.
+
+The truck is assumed to start with a full tank and never to plan below
+FUEL_RESERVE_FRACTION of it. Stretches of the route that stations don't
+cover get fallback stop candidates, priced above every corridor station so
+they are only used where nothing else reaches.
+"""
+import math
+
+from django.db.models import Count, Max
+
+from .geo import (
+    METERS_PER_DEGREE_LAT, METERS_PER_MILE, geohash_cell_degrees, geohash_encode, locate_on_line, route_polyline,
+)
+from .models import FUEL_STATION_CELL_PRECISION, FuelStation
+
+FUEL_CORRIDOR_MILES = 3  # Furthest a station may be from the route
+FUEL_RESERVE_FRACTION = 0.1  # Share of the tank never planned to be used
+FUEL_STOP_COST = 25.0  # Dollars a stop is worth avoiding, for the time it takes
+# Stations closer than this along the route (typically at one exit) are
+# treated as one candidate, the cheapest of them
+STATION_MERGE_MILES = 1
+FALLBACK_SPACING_MILES = 25  # Spacing of fallback candidates where stations are sparse
+FALLBACK_PRICE_PER_GALLON = 4.0  # Fallback price when the corridor has no stations
+FALLBACK_PRICE_PREMIUM = 0.5  # Added to the highest corridor price for fallback candidates
+# Shortest range plan_fuel_stops can plan for, given the fallback spacing
+MIN_FUEL_RANGE_MILES = FALLBACK_SPACING_MILES
+# Route points used to find corridor stations are about this far apart
+CORRIDOR_SAMPLE_SPACING_METERS = 3000
+
+
+def fuel_rule_set(trip):
+    """
+    Inputs of the fuel plan that are not part of the route, or None when
+    the trip doesn't give its tank capacity and fuel economy
+    """
+    if not trip.tank_capacity_gallons or not trip.mpg:
+        return None
+    prices = FuelStation.objects.aggregate(stations=Count('id'), updated=Max('updated_at'))
+    return {
+        'tank_capacity_gallons': trip.tank_capacity_gallons,
+        'mpg': trip.mpg,
+        'reserve_fraction': FUEL_RESERVE_FRACTION,
+        'corridor_miles': FUEL_CORRIDOR_MILES,
+        'stop_cost': FUEL_STOP_COST,
+        'fallback': [FALLBACK_SPACING_MILES, FALLBACK_PRICE_PER_GALLON, FALLBACK_PRICE_PREMIUM],
+        'price_table': [prices['stations'], prices['updated'].isoformat() if prices['updated'] else None],
+    }
+
+
+def fuel_range_miles(tank_capacity_gallons, mpg):
+    """Miles a full tank lasts without touching the reserve"""
+    return tank_capacity_gallons * (1 - FUEL_RESERVE_FRACTION) * mpg
+
+
+def plan_fuel_stops(trip, route_data):
+    """
+    Choose the fuel stops of a trip along a calculate_route result
+
+    Returns None when the trip doesn't give its tank capacity and fuel
+    economy, otherwise a dict with the plan's totals and its 'stops', each
+    with position_miles, the station (id, name and coordinates; None for a
+    fallback candidate), price_per_gallon, gallons and cost.
+    """
+    if not trip.tank_capacity_gallons or not trip.mpg:
+        return None
+    mpg = trip.mpg
+    usable_gallons = trip.tank_capacity_gallons * (1 - FUEL_RESERVE_FRACTION)
+    total_miles = route_data['current_to_pickup']['distance_miles'] + route_data['pickup_to_dropoff']['distance_miles']
+
+    stations = corridor_stations(route_data, FUEL_CORRIDOR_MILES * METERS_PER_MILE)
+    candidates = []
+    for position, station in _cheapest_per_exit(stations):
+        station = dict(station)
+        price = float(station.pop('price_per_gallon'))
+        candidates.append({'position_miles': position, 'station': station, 'price_per_gallon': price})
+    fallback_price = FALLBACK_PRICE_PER_GALLON
+    if candidates:
+        fallback_price = max(candidate['price_per_gallon'] for candidate in candidates)
+    fallback_price += FALLBACK_PRICE_PREMIUM
+    candidates = _with_fallbacks(candidates, total_miles, fallback_price)
+
+    result = cheapest_refuelling(
+        [candidate['position_miles'] / mpg for candidate in candidates],
+        [candidate['price_per_gallon'] for candidate in candidates],
+        total_miles / mpg,
+        usable_gallons,
+        FUEL_STOP_COST,
+    )
+    if result is None:
+        # Fallback candidates close every gap longer than MIN_FUEL_RANGE_MILES
+        raise ValueError(f"A range of {usable_gallons * mpg:.0f} miles can't cover the gaps between fuel stops")
+
+    stops = []
+    for index, gallons in result:
+        candidate = candidates[index]
+        stops.append(dict(
+            candidate,
+            gallons=round(gallons, 1),
+            cost=round(gallons * candidate['price_per_gallon'], 2),
+        ))
+    return {
+        'tank_capacity_gallons': trip.tank_capacity_gallons,
+        'mpg': mpg,
+        'total_gallons': round(sum(stop['gallons'] for stop in stops), 1),
+        'estimated_cost': round(sum(stop['cost'] for stop in stops), 2),
+        'stations_considered': len(stations),
+        'stops': stops,
+    }
+
+
+def _cheapest_per_exit(stations):
+    """Keep the cheapest of each run of stations spanning less than STATION_MERGE_MILES"""
+    kept = []
+    run_start = None
+    for position, station in stations:
+        if run_start is not None and position - run_start < STATION_MERGE_MILES:
+            if station['price_per_gallon'] < kept[-1][1]['price_per_gallon']:
+                kept[-1] = (position, station)
+        else:
+            run_start = position
+            kept.append((position, station))
+    return kept
+
+
+def _with_fallbacks(candidates, total_miles, price):
+    """Add evenly spaced fallback candidates to gaps between stations wider than FALLBACK_SPACING_MILES"""
+    positions = [0.0] + [candidate['position_miles'] for candidate in candidates] + [total_miles]
+    fallbacks = []
+    for start, end in zip(positions, positions[1:]):
+        count = math.ceil((end - start) / FALLBACK_SPACING_MILES) - 1
+        for step in range(1, count + 1):
+            fallbacks.append({
+                'position_miles': start + (end - start) * step / (count + 1),
+                'station': None,
+                'price_per_gallon': price,
+            })
+    return sorted(candidates + fallbacks, key=lambda candidate: candidate['position_miles'])
+
+
+def corridor_stations(route_data, corridor_meters):
+    """
+    Return [(route miles, station)] of the stations within corridor_meters of
+    the route, in route order, each station a dict of its id, name,
+    coordinates and price_per_gallon
+
+    Stations are fetched in one query over the geohash cells that the boxes
+    around the route's segments, widened by the corridor, touch. Each cell
+    remembers the segments that touched it, so a station is only located
+    against the nearby stretch of the route.
+    """
+    lats, lons, miles = route_polyline(route_data, CORRIDOR_SAMPLE_SPACING_METERS)
+    if len(lats) < 2:
+        return []
+
+    height, width = geohash_cell_degrees(FUEL_STATION_CELL_PRECISION)
+    columns = round(360 / width)
+    margin_lat = corridor_meters / METERS_PER_DEGREE_LAT
+    cell_segments = {}
+    for segment in range(len(lats) - 1):
+        lat1, lat2 = sorted((lats[segment], lats[segment + 1]))
+        lon1, lon2 = sorted((lons[segment], lons[segment + 1]))
+        if lon2 - lon1 > 180:
+            # Crosses the antimeridian
+            lon1, lon2 = lon2, lon1 + 360
+        cos_lat = max(math.cos(math.radians(min(90.0, max(abs(lat1), abs(lat2)) + margin_lat))), 1e-6)
+        margin_lon = margin_lat / cos_lat
+        first_row = max(0, int((lat1 - margin_lat + 90) // height))
+        last_row = min(round(180 / height) - 1, int((lat2 + margin_lat + 90) // height))
+        first_column = int((lon1 - margin_lon + 180) // width)
+        last_column = int((lon2 + margin_lon + 180) // width)
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                cell = (row, column % columns)
+                first, last = cell_segments.get(cell, (segment, segment))
+                cell_segments[cell] = (min(first, segment), max(last, segment))
+
+    prefix_segments = {
+        geohash_encode(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, FUEL_STATION_CELL_PRECISION): segments
+        for (row, column), segments in cell_segments.items()
+    }
+    stations = FuelStation.objects.in_cells(list(prefix_segments)).order_by('id').values(
+        'id', 'name', 'latitude', 'longitude', 'price_per_gallon', 'cell',
+    )
+    found = []
+    for station in stations:
+        first, last = prefix_segments[station.pop('cell')]
+        segment, fraction, offset = locate_on_line(
+            lats, lons, station['latitude'], station['longitude'], first, last + 1,
+        )
+        if offset <= corridor_meters:
+            found.append((miles[segment] + fraction * (miles[segment + 1] - miles[segment]), station))
+    found.sort(key=lambda item: (item[0], item[1]['id']))
+    return found
+
+
+def cheapest_refuelling(positions, prices, length, capacity, stop_cost=0.0):
+    """
+    Cheapest fuel purchases for a trip along a line
+
+    Distances are in gallons: positions are the candidate stops' distances
+    from the start (ascending), length the distance to the destination and
+    capacity the usable tank, which is full at the start. Each stop made
+    costs stop_cost on top of its fuel.
+
+    An optimal plan only ever fills the tank or buys just enough to reach
+    the next stop on reserve, so a stop is reached either on reserve or with
+    what is left after filling at an earlier one. The pass runs over the
+    stops in order, keeping the cheapest way to leave each stop full and to
+    reach it on reserve; with k stops within range of each other it takes
+    O(n * k) time.
+
+    Returns [(candidate index, gallons bought)] in route order, or None when
+    a gap between stops is longer than the tank reaches.
+    """
+    n = len(positions)
+    x = [0.0] + list(positions) + [length]
+    price = [0.0] + list(prices) + [0.0]
+    destination = n + 1
+    # Cheapest way to leave a stop with a full tank, and to reach it on reserve
+    full = [math.inf] * (n + 2)
+    empty = [math.inf] * (n + 2)
+    full_from = [None] * (n + 2)
+    empty_from = [None] * (n + 2)
+    full[0] = 0.0
+
+    first_in_range = 0
+    for v in range(1, destination + 1):
+        xv = x[v]
+        while xv - x[first_in_range] > capacity:
+            first_in_range += 1
+        if first_in_range == v:
+            return None
+        if v == destination:
+            break
+
+        # Leave v full: fill up after arriving on reserve, or top up what
+        # is left after leaving an earlier stop full
+        p = price[v]
+        best, best_from = empty[v] + capacity * p, None
+        topped_up = [f - xu * p for f, xu in zip(full[first_in_range:v], x[first_in_range:v])]
+        cheapest = min(topped_up)
+        if cheapest + xv * p < best:
+            best, best_from = cheapest + xv * p, first_in_range + topped_up.index(cheapest)
+        full[v] = best + stop_cost
+        full_from[v] = best_from
+
+        # Buy just enough at v to reach a later stop w on reserve, having
+        # arrived on reserve or with what is left after filling at an
+        # earlier stop u, which must not exceed the fuel needed
+        # (x[w] - x[u] >= capacity)
+        on_reserve = empty[v] + stop_cost - xv * p
+        left_over = math.inf
+        left_over_from = None
+        u = first_in_range
+        w = v + 1
+        while w <= destination and x[w] - xv <= capacity:
+            xw = x[w]
+            while u < v and x[u] <= xw - capacity:
+                cost = full[u] - x[u] * p
+                if cost < left_over:
+                    left_over, left_over_from = cost, u
+                u += 1
+            if on_reserve <= left_over + stop_cost - capacity * p:
+                cost, through = on_reserve + xw * p, None
+            else:
+                cost, through = left_over + stop_cost + (xw - capacity) * p, left_over_from
+            if cost < empty[w]:
+                empty[w], empty_from[w] = cost, (v, through)
+            w += 1
+
+    # Arrive on reserve, or with fuel left after filling at a stop in range
+    best, state = empty[destination], ('empty', destination)
+    for u in range(first_in_range, destination):
+        if full[u] < best:
+            best, state = full[u], ('full', u)
+
+    purchases = {}
+    kind, v = state
+    while not (kind == 'full' and v == 0):
+        if kind == 'full':
+            u = full_from[v]
+            if u is None:
+                purchases[v] = capacity
+                kind = 'empty'
+            else:
+                purchases[v] = x[v] - x[u]
+                v = u
+        else:
+            stop, u = empty_from[v]
+            if u is None:
+                purchases[stop] = x[v] - x[stop]
+                v = stop
+            else:
+                purchases[stop] = x[v] - capacity - x[u]
+                kind, v = 'full', u
+    return [(v - 1, gallons) for v, gallons in sorted(purchases.items()) if gallons > 1e-9]
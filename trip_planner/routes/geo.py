@@ -0,0 +1,191 @@
+import math
+from array import array
+
+EARTH_RADIUS_METERS = 6371000
+METERS_PER_MILE = 1609.34
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two points given in degrees"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def densify(coordinates, spacing_meters):
+    """
+    Insert evenly spaced points so no two consecutive points of a [lon, lat]
+    line are further apart than spacing_meters
+
+    Routing responses are indexed by point position, so evenly spaced points
+    keep positions along the line proportional to distance.
+    """
+    if len(coordinates) < 2:
+        return [list(point) for point in coordinates]
+
+    dense = [list(coordinates[0])]
+    append = dense.append
+    for (lon1, lat1), (lon2, lat2) in zip(coordinates, coordinates[1:]):
+        steps = max(1, int(math.ceil(haversine_meters(lat1, lon1, lat2, lon2) / spacing_meters)))
+        dlon = (lon2 - lon1) / steps
+        dlat = (lat2 - lat1) / steps
+        for step in range(1, steps):
+            append([lon1 + dlon * step, lat1 + dlat * step])
+        append([lon2, lat2])
+    return dense
+
+
+def route_polyline(route, spacing_meters):
+    """
+    One polyline over both legs of a calculate_route result, keeping points
+    at least spacing_meters apart (and each leg's last point)
+
+    Returns arrays (lats, lons, miles) where miles are route miles from the
+    trip start. Geometry length and route distance differ, so distances
+    along each leg are scaled to the leg's route miles.
+    """
+    lats, lons, miles = array('d'), array('d'), array('d')
+    leg_start = 0.0
+    for leg in ('current_to_pickup', 'pickup_to_dropoff'):
+        coordinates = route['coordinates'][leg]
+        leg_miles = route[leg]['distance_miles']
+        along = [0.0]
+        for (lon1, lat1), (lon2, lat2) in zip(coordinates, coordinates[1:]):
+            along.append(along[-1] + haversine_meters(lat1, lon1, lat2, lon2))
+        scale = leg_miles / along[-1] if along[-1] else 0.0
+
+        kept_at = None
+        for index, (lon, lat) in enumerate(coordinates):
+            last = index == len(coordinates) - 1
+            if kept_at is not None and not last and along[index] - kept_at < spacing_meters:
+                continue
+            kept_at = along[index]
+            lats.append(lat)
+            lons.append(lon)
+            miles.append(leg_start + along[index] * scale)
+        leg_start += leg_miles
+    return lats, lons, miles
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12  # Characters stored per location (cells of a few cm)
+METERS_PER_DEGREE_LAT = 111320
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    """Encode a point as a geohash; points sharing a prefix share a grid cell"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # Bits alternate between longitude and latitude, longitude first
+    while len(chars) < precision:
+        value, interval = (lon, lon_range) if even else (lat, lat_range)
+        mid = (interval[0] + interval[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            interval[0] = mid
+        else:
+            bits = bits * 2
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = bit_count = 0
+    return ''.join(chars)
+
+
+def geohash_cell_degrees(precision):
+    """Return the (height, width) in degrees of a geohash cell"""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def geohash_precision_for_radius(radius_meters, lat):
+    """
+    Longest geohash precision whose cells at latitude lat are at least
+    radius_meters across, so everything within the radius of a point lies
+    in the point's cell or one of its eight neighbours
+    """
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_degrees(precision)
+        if (height * METERS_PER_DEGREE_LAT >= radius_meters
+                and width * METERS_PER_DEGREE_LAT * cos_lat >= radius_meters):
+            return precision
+    return 1
+
+
+def geohash_neighbourhood(lat, lon, radius_meters, precision=None):
+    """
+    Return the geohash prefixes of the 3x3 block of cells covering a radius
+    around a point. A fixed precision must be no longer than
+    geohash_precision_for_radius gives at lat.
+    """
+    if precision is None:
+        precision = geohash_precision_for_radius(radius_meters, lat)
+    height, width = geohash_cell_degrees(precision)
+    prefixes = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_lat = min(90.0, max(-90.0, lat + dlat))
+            cell_lon = (lon + dlon + 180.0) % 360.0 - 180.0
+            prefixes.add(geohash_encode(cell_lat, cell_lon, precision))
+    return prefixes
+
+
+def bounding_box(lat, lon, radius_meters):
+    """
+    Return (min_lat, min_lon, max_lat, max_lon) of a box containing the
+    circle around a point. min_lon > max_lon when the box crosses the
+    antimeridian; boxes reaching a pole span every longitude.
+    """
+    dlat = radius_meters / METERS_PER_DEGREE_LAT
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), -180.0, min(max_lat, 90.0), 180.0
+
+    # Widest at the edge of the box furthest from the equator
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    dlon = radius_meters / (METERS_PER_DEGREE_LAT * cos_lat)
+    if dlon >= 180:
+        return min_lat, -180.0, max_lat, 180.0
+    min_lon = (lon - dlon + 180.0) % 360.0 - 180.0
+    max_lon = (lon + dlon + 180.0) % 360.0 - 180.0
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def locate_on_line(lats, lons, lat, lon, start=0, end=None):
+    """
+    Find the point of a polyline closest to (lat, lon), looking only at
+    segments start..end-1
+
+    Returns (segment, fraction along the segment, offset_meters), using a
+    local flat projection that is accurate for the short segments of
+    routing geometry.
+    """
+    if end is None:
+        end = len(lats) - 1
+    cos_lat = math.cos(math.radians(lat))
+    best = (start, 0.0, math.inf)
+    for segment in range(start, end):
+        # Segment ends in meters relative to the point
+        ax = (lons[segment] - lon) * cos_lat * METERS_PER_DEGREE_LAT
+        ay = (lats[segment] - lat) * METERS_PER_DEGREE_LAT
+        bx = (lons[segment + 1] - lon) * cos_lat * METERS_PER_DEGREE_LAT
+        by = (lats[segment + 1] - lat) * METERS_PER_DEGREE_LAT
+        dx, dy = bx - ax, by - ay
+        length_squared = dx * dx + dy * dy
+        fraction = 0.0
+        if length_squared > 0:
+            fraction = min(1.0, max(0.0, -(ax * dx + ay * dy) / length_squared))
+        x, y = ax + fraction * dx, ay + fraction * dy
+        offset = math.sqrt(x * x + y * y)
+        if offset < best[2]:
+            best = (segment, fraction, offset)
+    return best
@@ -0,0 +1,249 @@
+import datetime
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.renderers import JSONRenderer
+
+from logs.log_generator import generate_daily_logs_for_trip
+from logs.models import DailyLog
+from logs.serializers import DailyLogSerializer, daily_log_dicts, daily_log_rows
+from logs.views import DailyLogViewSet
+from routes.benchmark_fixtures import BENCHMARK_TRIPS, recorded_osrm_server
+from routes.models import Location, Trip
+from routes.route_planning import calculate_route, generate_stops, get_location_at_position
+from routes.serializers import RouteStopSerializer, route_stop_dicts
+from trip_planner.renderers import ORJSONRenderer
+
+# Fixed departure so every run plans the same schedule
+BENCHMARK_DEPARTURE = datetime.datetime(2025, 1, 6, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+class _Rollback(Exception):
+    """Raised to discard every row written by the benchmark"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark routing, HOS scheduling and log generation against recorded "
+        "OSRM responses. All database writes are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Timed runs per benchmark (default: 5)")
+        parser.add_argument('--trips', nargs='+', choices=sorted(BENCHMARK_TRIPS),
+                            default=list(BENCHMARK_TRIPS),
+                            help="Fixture trips to benchmark (default: all)")
+        parser.add_argument('--output', help="Write machine-readable results to this JSON file")
+        parser.add_argument('--compare', help="Compare against results from a previous --output file")
+        parser.add_argument('--threshold', type=float, default=0.10,
+                            help="Relative slowdown reported as a regression (default: 0.10)")
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help="Exit with an error if any benchmark regressed")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        self.repeat = options['repeat']
+        self.results = []
+
+        try:
+            with transaction.atomic():
+                self.run_benchmarks(options['trips'])
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        report = {'meta': self.metadata(), 'results': self.results}
+        self.print_results()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['compare']:
+            regressions = self.compare(options['compare'], options['threshold'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+
+    def run_benchmarks(self, trip_names):
+        driver = User.objects.create(username='benchmark-driver')
+
+        with recorded_osrm_server() as server, override_settings(OSRM_BASE_URL=server.base_url):
+            for name in trip_names:
+                trip = self.create_trip(driver, BENCHMARK_TRIPS[name])
+                locations = (trip.current_location, trip.pickup_location, trip.dropoff_location)
+
+                route_data = self.measure(
+                    f'calculate_route[{name}]',
+                    lambda: calculate_route(*locations, trip.current_cycle_hours)
+                )
+                stops = self.measure(
+                    f'generate_stops[{name}]',
+                    lambda: generate_stops(trip, route_data, BENCHMARK_DEPARTURE)
+                )
+                daily_logs = self.measure(
+                    f'generate_daily_logs_for_trip[{name}]',
+                    lambda: generate_daily_logs_for_trip(trip)
+                )
+                self.measure_serialization(name, trip, stops, daily_logs)
+
+                coordinates = route_data['coordinates']['pickup_to_dropoff']
+                ratios = random.Random(name).sample(range(1, 1000), 50)
+                self.measure(
+                    f'get_location_at_position[{name}]',
+                    lambda: [
+                        get_location_at_position(trip.pickup_location, trip.dropoff_location,
+                                                 ratio / 1000, coordinates)
+                        for ratio in ratios
+                    ],
+                    calls=len(ratios)
+                )
+
+    def measure_serialization(self, name, trip, stops, daily_logs):
+        """
+        Render a plan's stops and logs (as calculate_route does) and a trip's
+        daily logs (as the daily log list does) with the plain-dict builders
+        and orjson, and with the DRF serializers and renderer for comparison
+        """
+        renderer, drf_renderer = ORJSONRenderer(), JSONRenderer()
+        self.measure(
+            f'serialize_plan[{name}]',
+            lambda: renderer.render({'stops': route_stop_dicts(stops), 'daily_logs': daily_log_dicts(daily_logs)})
+        )
+        self.measure(
+            f'serialize_plan_drf[{name}]',
+            lambda: drf_renderer.render({
+                'stops': RouteStopSerializer(stops, many=True).data,
+                'daily_logs': DailyLogSerializer(daily_logs, many=True).data,
+            })
+        )
+        self.measure(
+            f'daily_log_list[{name}]',
+            lambda: renderer.render(daily_log_rows(DailyLog.objects.filter(trip=trip)))
+        )
+        self.measure(
+            f'daily_log_list_drf[{name}]',
+            lambda: drf_renderer.render(
+                DailyLogSerializer(DailyLogViewSet.queryset.filter(trip=trip), many=True).data
+            )
+        )
+
+    def create_trip(self, driver, fixture):
+        current, pickup, dropoff = [
+            Location.objects.create(name=name, latitude=lat, longitude=lon)
+            for name, lat, lon in (fixture['current'], fixture['pickup'], fixture['dropoff'])
+        ]
+        return Trip.objects.create(
+            driver=driver,
+            current_location=current,
+            pickup_location=pickup,
+            dropoff_location=dropoff,
+            current_cycle_hours=fixture['cycle_hours'],
+        )
+
+    def measure(self, name, func, calls=1):
+        """
+        Time func over self.repeat runs (after one warm-up run)
+
+        Timings and query counts are reported per call, so benchmarks that loop
+        over several inputs pass the number of calls they make.
+        """
+        result = func()
+
+        timings = []
+        queries = []
+        for _ in range(self.repeat):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                func()
+                timings.append((time.perf_counter() - start) * 1000 / calls)
+            queries.append(len(captured.captured_queries) / calls)
+
+        timings.sort()
+        self.results.append({
+            'name': name,
+            'runs': self.repeat,
+            'calls_per_run': calls,
+            'min_ms': timings[0],
+            'median_ms': statistics.median(timings),
+            'mean_ms': statistics.mean(timings),
+            'p95_ms': timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+            'stdev_ms': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+            'queries': statistics.mean(queries),
+        })
+        return result
+
+    def metadata(self):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        return {
+            'commit': commit,
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'repeat': self.repeat,
+        }
+
+    def print_results(self):
+        self.stdout.write(f"{'benchmark':<45} {'median ms':>10} {'min ms':>10} {'queries':>8}")
+        for result in self.results:
+            self.stdout.write(
+                f"{result['name']:<45} {result['median_ms']:>10.2f} "
+                f"{result['min_ms']:>10.2f} {result['queries']:>8.1f}"
+            )
+
+        # Benchmarks named 'x_drf[trip]' time the DRF serializers that 'x[trip]' replaces
+        medians = {result['name']: result['median_ms'] for result in self.results}
+        speedups = [
+            (name, medians[name.replace('_drf[', '[')] and drf_median / medians[name.replace('_drf[', '[')])
+            for name, drf_median in medians.items()
+            if '_drf[' in name and name.replace('_drf[', '[') in medians
+        ]
+        if speedups:
+            self.stdout.write("\nSpeedup over the DRF serializers:")
+            for name, speedup in speedups:
+                self.stdout.write(f"{name.replace('_drf[', '['):<45} {speedup:>9.1f}x")
+
+    def compare(self, path, threshold):
+        """Print the change in median time against a previous run and return regressions"""
+        try:
+            with open(path) as f:
+                baseline = {result['name']: result for result in json.load(f)['results']}
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Could not read baseline results from {path}: {e}")
+
+        regressions = []
+        self.stdout.write(f"\nCompared with {path}:")
+        for result in self.results:
+            previous = baseline.get(result['name'])
+            if previous is None or not previous['median_ms']:
+                continue
+            change = result['median_ms'] / previous['median_ms'] - 1
+            line = (
+                f"{result['name']:<45} {change:>+9.1%} "
+                f"queries {previous['queries']:.0f} -> {result['queries']:.0f}"
+            )
+            if change > threshold:
+                regressions.append(result['name'])
+                self.stdout.write(self.style.ERROR(line + "  REGRESSION"))
+            else:
+                self.stdout.write(line)
+        return regressions
@@ -0,0 +1,187 @@
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter: what a worker does before serving, without preload
+BOOT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from trip_planner.preload import preload
+preload()
+loaded = time.perf_counter()
+rss_kb = 0
+with open('/proc/self/status') as status:
+    for line in status:
+        if line.startswith('VmRSS:'):
+            rss_kb = int(line.split()[1])
+print(json.dumps({'setup': setup - started, 'preload': loaded - setup, 'rss_kb': rss_kb}))
+"""
+
+SERVER_READY_TIMEOUT = 60  # Seconds to wait for gunicorn to answer
+WARMUP_REQUESTS_PER_WORKER = 20
+# Fields of /proc/<pid>/smaps_rollup reported per worker, in kB
+MEMORY_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the application's boot time in a fresh process, and the memory of "
+        "gunicorn workers with and without preloading the application before fork. "
+        "Linux only (reads /proc)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Boots timed in fresh processes (default: 5)")
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Gunicorn workers to start (default: 4)")
+        parser.add_argument('--worker-class',
+                            help="Gunicorn worker class (default: the one in gunicorn.conf.py); "
+                                 "'sync' serves the WSGI application")
+        parser.add_argument('--skip-server', action='store_true',
+                            help="Only time the boot; don't start gunicorn")
+        parser.add_argument('--output', help="Write machine-readable results to this JSON file")
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/smaps_rollup'):
+            raise CommandError("benchmark_startup reads /proc and needs Linux 4.14 or later")
+        if options['repeat'] < 1 or options['workers'] < 1:
+            raise CommandError("--repeat and --workers must be at least 1")
+
+        self.env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        results = {'boot': self.measure_boot(options['repeat'])}
+        if not options['skip_server']:
+            results['workers'] = {
+                'preload' if preload else 'no_preload': self.measure_workers(
+                    options['workers'], options['worker_class'], preload
+                )
+                for preload in (False, True)
+            }
+
+        self.print_results(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def measure_boot(self, repeat):
+        """Median setup and preload seconds, and RSS, of fresh interpreters loading the application"""
+        runs = []
+        for _ in range(repeat):
+            completed = subprocess.run(
+                [sys.executable, '-c', BOOT_SCRIPT], cwd=settings.BASE_DIR, env=self.env,
+                capture_output=True, text=True,
+            )
+            if completed.returncode != 0:
+                raise CommandError(f"Booting the application failed:\n{completed.stderr}")
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        return {
+            'setup_ms': statistics.median(run['setup'] for run in runs) * 1000,
+            'preload_ms': statistics.median(run['preload'] for run in runs) * 1000,
+            'rss_kb': statistics.median(run['rss_kb'] for run in runs),
+        }
+
+    def measure_workers(self, workers, worker_class, preload):
+        """Start gunicorn, warm its workers up and read their memory"""
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        command = [
+            sys.executable, '-m', 'gunicorn', '--config', str(settings.BASE_DIR / 'gunicorn.conf.py'),
+            '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+        ]
+        # Without a worker class, gunicorn.conf.py sets it and the application
+        if worker_class:
+            app = 'trip_planner.wsgi:application' if worker_class == 'sync' else 'trip_planner.asgi:application'
+            command += ['--worker-class', worker_class, app]
+        started = time.monotonic()
+        server = subprocess.Popen(
+            command, cwd=settings.BASE_DIR, env=dict(self.env, GUNICORN_PRELOAD='1' if preload else '0'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        )
+        try:
+            base_url = f'http://127.0.0.1:{port}'
+            self.wait_ready(server, f'{base_url}/healthz')
+            ready = time.monotonic() - started
+            # Let every worker serve requests touching the database and cache
+            for _ in range(workers * WARMUP_REQUESTS_PER_WORKER):
+                self.get(f'{base_url}/readyz')
+            master = self.worker_memory(server.pid)
+            memory = [self.worker_memory(pid) for pid in self.children(server.pid)]
+            if len(memory) != workers:
+                raise CommandError(f"Expected {workers} workers, found {len(memory)}")
+        finally:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+        return {
+            'ready_seconds': ready,
+            'master_kb': master,
+            'worker_average_kb': {field: statistics.mean(worker[field] for worker in memory) for field in MEMORY_FIELDS},
+            # Memory the server takes as a whole, master included
+            'total_pss_kb': master['Pss'] + sum(worker['Pss'] for worker in memory),
+        }
+
+    def wait_ready(self, server, url):
+        deadline = time.monotonic() + SERVER_READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f"gunicorn exited:\n{server.stderr.read()}")
+            try:
+                self.get(url)
+                return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.1)
+        raise CommandError(f"gunicorn didn't answer within {SERVER_READY_TIMEOUT}s")
+
+    def get(self, url):
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.read()
+
+    def children(self, pid):
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            return [int(child) for child in children.read().split()]
+
+    def worker_memory(self, pid):
+        memory = {}
+        with open(f'/proc/{pid}/smaps_rollup') as rollup:
+            for line in rollup:
+                name, _, value = line.partition(':')
+                if name in MEMORY_FIELDS:
+                    memory[name] = int(value.split()[0])
+        return memory
+
+    def print_results(self, results):
+        boot = results['boot']
+        self.stdout.write(
+            f"Boot in a fresh process: django.setup {boot['setup_ms']:.0f} ms, "
+            f"preload {boot['preload_ms']:.0f} ms, RSS {boot['rss_kb'] / 1024:.1f} MB"
+        )
+        if 'workers' not in results:
+            return
+        self.stdout.write(
+            f"\n{'gunicorn':<12} {'ready s':>8} {'RSS MB':>8} {'PSS MB':>8} {'private MB':>11} {'total PSS MB':>13}"
+        )
+        for name, run in results['workers'].items():
+            worker = run['worker_average_kb']
+            private = worker['Private_Clean'] + worker['Private_Dirty']
+            self.stdout.write(
+                f"{name:<12} {run['ready_seconds']:>8.2f} {worker['Rss'] / 1024:>8.1f} {worker['Pss'] / 1024:>8.1f} "
+                f"{private / 1024:>11.1f} {run['total_pss_kb'] / 1024:>13.1f}"
+            )
+        self.stdout.write("Per-worker averages after warm-up; PSS splits shared pages between the processes sharing them.")
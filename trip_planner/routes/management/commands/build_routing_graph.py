@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from routes.ch_router import build_contraction_hierarchy, write_ch_file
+from routes.management.commands.osrm_stub import DEFAULT_GRAPH
+from routes.road_graph import RoadGraph
+
+
+class Command(BaseCommand):
+    help = (
+        "Preprocess a road graph JSON file into a contraction hierarchy file "
+        "for the in-process 'ch' routing backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the contraction hierarchy file to write")
+        parser.add_argument('--graph', default=DEFAULT_GRAPH,
+                            help="Road graph JSON file (default: bundled US highway network)")
+
+    def handle(self, *args, **options):
+        try:
+            graph = RoadGraph.load(options['graph'])
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Could not load road graph {options['graph']}: {e}")
+
+        start = time.perf_counter()
+        arrays = build_contraction_hierarchy(graph)
+        write_ch_file(arrays, options['output'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Contracted {len(graph.node_ids)} nodes into {len(arrays['edge_weight'])} edges "
+            f"in {time.perf_counter() - start:.1f}s; written to {options['output']}"
+        ))
@@ -0,0 +1,146 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import BigIntegerField, Case, Max, Min, Value, When
+
+from routes.geo import geohash_encode, geohash_neighbourhood, geohash_precision_for_radius, haversine_meters
+from routes.models import Location, PlanSnapshot, RouteStop, Trip, TripRollup, WeeklyRollup
+from trip_planner.response_cache import bump_versions
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Merge waypoint locations that lie within a radius of each other, "
+        "repointing route stops to the oldest location of each cluster. Waypoints "
+        "trips or rollups use are kept."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--radius', type=float, default=settings.STOP_DEDUP_RADIUS_METERS,
+                            help="Cluster radius in meters (default: STOP_DEDUP_RADIUS_METERS)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report what would be merged without changing anything")
+
+    def handle(self, *args, **options):
+        radius = options['radius']
+        if radius < 0:
+            raise CommandError("--radius must not be negative")
+
+        with transaction.atomic():
+            filled = self.backfill_geohashes()
+            marked = self.mark_waypoints()
+            merges = self.cluster(radius)
+            self.stdout.write(
+                f"Filled {filled} geohashes, marked {marked} locations as waypoints, "
+                f"found {len(merges)} duplicate waypoints within {radius:g} m"
+            )
+
+            if options['dry_run']:
+                transaction.set_rollback(True)
+                self.stdout.write("Dry run, no changes saved")
+                return
+
+            repointed, snapshots = self.merge(merges)
+            self.stdout.write(self.style.SUCCESS(
+                f"Repointed {repointed} route stops, deleted {len(merges)} locations "
+                f"and {snapshots} stale plan snapshots"
+            ))
+
+    def backfill_geohashes(self):
+        """Set the geohash of locations saved before it existed or by bulk inserts"""
+        locations = list(Location.objects.filter(geohash='').only('latitude', 'longitude'))
+        for location in locations:
+            location.geohash = geohash_encode(location.latitude, location.longitude)
+        Location.objects.bulk_update(locations, ['geohash'], batch_size=BATCH_SIZE)
+        return len(locations)
+
+    def mark_waypoints(self):
+        """
+        Flag generated stop positions saved before is_waypoint existed:
+        locations used by route stops but by no trip
+        """
+        return Location.objects.filter(
+            is_waypoint=False,
+            trips_as_current__isnull=True,
+            trips_as_pickup__isnull=True,
+            trips_as_dropoff__isnull=True,
+            routestop__isnull=False,
+        ).update(is_waypoint=True)
+
+    def cluster(self, radius):
+        """
+        Return {duplicate id: kept id}, clustering waypoints greedily in id
+        order so each cluster keeps its oldest location. Waypoints referenced
+        by trips or rollups are always kept: deleting them would delete those
+        rows with them.
+        """
+        waypoints = Location.objects.filter(is_waypoint=True)
+        referenced = self.referenced_waypoints()
+        bounds = waypoints.aggregate(Min('latitude'), Max('latitude'))
+        if bounds['latitude__min'] is None:
+            return {}
+        # One cell size for the whole table, wide enough at the latitude
+        # furthest from the equator, where cells are narrowest in meters
+        furthest = max(abs(bounds['latitude__min']), abs(bounds['latitude__max']))
+        precision = geohash_precision_for_radius(radius, furthest)
+
+        # Kept locations bucketed by geohash cell
+        kept = {}
+        merges = {}
+        rows = waypoints.order_by('id').values_list('id', 'latitude', 'longitude')
+        for pk, lat, lon in rows.iterator():
+            best, best_distance = None, None
+            for prefix in geohash_neighbourhood(lat, lon, radius, precision):
+                for other_pk, other_lat, other_lon in kept.get(prefix, ()):
+                    distance = haversine_meters(lat, lon, other_lat, other_lon)
+                    if distance <= radius and (best is None or distance < best_distance):
+                        best, best_distance = other_pk, distance
+
+            if best is not None and pk not in referenced:
+                merges[pk] = best
+                continue
+
+            kept.setdefault(geohash_encode(lat, lon, precision), []).append((pk, lat, lon))
+        return merges
+
+    def referenced_waypoints(self):
+        """
+        Ids of waypoints used by something other than route stops: a trip
+        endpoint picked from location search, or the lane of a rollup
+        """
+        referenced = set()
+        for model, fields in (
+            (Trip, ('current_location', 'pickup_location', 'dropoff_location')),
+            (TripRollup, ('pickup_location', 'dropoff_location')),
+            (WeeklyRollup, ('pickup_location', 'dropoff_location')),
+        ):
+            for field in fields:
+                referenced.update(
+                    model.objects.filter(**{f'{field}__is_waypoint': True}).values_list(f'{field}_id', flat=True)
+                )
+        return referenced
+
+    def merge(self, merges):
+        """Repoint route stops from duplicates to kept locations, then delete the duplicates"""
+        duplicates = list(merges)
+        repointed = 0
+        trip_ids = set()
+        for start in range(0, len(duplicates), BATCH_SIZE):
+            batch = duplicates[start:start + BATCH_SIZE]
+            stops = RouteStop.objects.filter(location_id__in=batch)
+            trip_ids.update(stops.values_list('trip_id', flat=True))
+            repointed += stops.update(location_id=Case(
+                *[When(location_id=pk, then=Value(merges[pk])) for pk in batch],
+                output_field=BigIntegerField(),
+            ))
+            Location.objects.filter(id__in=batch).delete()
+
+        # Update() sends no signals
+        bump_versions('trip', trip_ids)
+        # Stored plans reference the deleted locations by id
+        snapshots = 0
+        if trip_ids:
+            snapshots, _ = PlanSnapshot.objects.filter(trip_id__in=trip_ids).delete()
+        return repointed, snapshots
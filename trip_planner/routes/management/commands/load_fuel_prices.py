@@ -0,0 +1,88 @@
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from routes.geo import geohash_encode
+from routes.models import FuelStation
+
+BATCH_SIZE = 500
+COLUMNS = ('id', 'name', 'latitude', 'longitude', 'price')
+PRICE_STEP = Decimal('0.001')
+
+
+class Command(BaseCommand):
+    help = (
+        "Load fuel stations and their prices from a CSV file with id, name, latitude, "
+        "longitude and price (per gallon) columns. Stations are matched by id, so "
+        "reloading a feed updates prices in place."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file to load")
+        parser.add_argument('--replace', action='store_true',
+                            help="Delete stations that are not in the file")
+
+    def handle(self, *args, **options):
+        rows = self.read_rows(options['path'])
+        now = timezone.now()
+
+        with transaction.atomic():
+            existing = {station.external_id: station for station in FuelStation.objects.all()}
+            created, changed = [], []
+            for external_id, (name, latitude, longitude, price) in rows.items():
+                station = existing.get(external_id)
+                if station is None:
+                    created.append(FuelStation(
+                        external_id=external_id, name=name, latitude=latitude, longitude=longitude,
+                        geohash=geohash_encode(latitude, longitude), price_per_gallon=price, updated_at=now,
+                    ))
+                elif (station.name, station.latitude, station.longitude, station.price_per_gallon) != (
+                        name, latitude, longitude, price):
+                    station.name, station.latitude, station.longitude = name, latitude, longitude
+                    station.geohash = geohash_encode(latitude, longitude)
+                    station.price_per_gallon = price
+                    # bulk_update doesn't apply auto_now
+                    station.updated_at = now
+                    changed.append(station)
+
+            FuelStation.objects.bulk_create(created, batch_size=BATCH_SIZE)
+            FuelStation.objects.bulk_update(
+                changed, ['name', 'latitude', 'longitude', 'geohash', 'price_per_gallon', 'updated_at'],
+                batch_size=BATCH_SIZE,
+            )
+            deleted = 0
+            if options['replace']:
+                stale = [station.id for external_id, station in existing.items() if external_id not in rows]
+                for start in range(0, len(stale), BATCH_SIZE):
+                    deleted += FuelStation.objects.filter(id__in=stale[start:start + BATCH_SIZE]).delete()[0]
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Loaded {len(rows)} stations: {len(created)} new, {len(changed)} updated, {deleted} deleted"
+        ))
+
+    def read_rows(self, path):
+        """Return {id: (name, latitude, longitude, price)}, the last row winning for repeated ids"""
+        try:
+            with open(path, newline='', encoding='utf-8') as csv_file:
+                reader = csv.DictReader(csv_file)
+                missing = set(COLUMNS) - set(reader.fieldnames or ())
+                if missing:
+                    raise CommandError(f"Missing columns: {', '.join(sorted(missing))}")
+
+                rows = {}
+                for row in reader:
+                    try:
+                        latitude, longitude = float(row['latitude']), float(row['longitude'])
+                        price = Decimal(row['price']).quantize(PRICE_STEP)
+                        in_range = -90 <= latitude <= 90 and -180 <= longitude <= 180 and 0 < price < 1000
+                    except (ValueError, InvalidOperation):
+                        raise CommandError(f"Line {reader.line_num}: invalid coordinates or price")
+                    if not in_range:
+                        raise CommandError(f"Line {reader.line_num}: coordinates or price out of range")
+                    rows[row['id'].strip()] = (row['name'].strip(), latitude, longitude, price)
+        except OSError as error:
+            raise CommandError(f"Can't read {path}: {error}")
+        return rows
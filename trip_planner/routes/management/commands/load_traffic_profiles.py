@@ -0,0 +1,85 @@
+import json
+
+import pytz
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from routes.models import TrafficProfile
+from routes.traffic import HOURS_PER_WEEK
+
+# Largest speed factor accepted, relative to the routing engine's free flow
+MAX_SPEED_FACTOR = 2
+
+
+class Command(BaseCommand):
+    help = (
+        "Load traffic profiles from a JSON file: a list of objects with name, latitude, "
+        "longitude, radius_km, timezone and speed_factors. speed_factors holds 168 hourly "
+        "speeds relative to free flow from Monday 00:00 local time, or 24 used for every "
+        "day. Profiles are matched by name, so reloading a file updates them in place."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="JSON file to load")
+        parser.add_argument('--replace', action='store_true',
+                            help="Delete profiles that are not in the file")
+
+    def handle(self, *args, **options):
+        profiles = self.read_profiles(options['path'])
+
+        with transaction.atomic():
+            created = updated = 0
+            for name, fields in profiles.items():
+                # Few enough rows that saving one by one keeps auto_now working
+                _, was_created = TrafficProfile.objects.update_or_create(name=name, defaults=fields)
+                if was_created:
+                    created += 1
+                else:
+                    updated += 1
+            deleted = 0
+            if options['replace']:
+                deleted = TrafficProfile.objects.exclude(name__in=profiles).delete()[0]
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Loaded {len(profiles)} traffic profiles: {created} new, {updated} updated, {deleted} deleted"
+        ))
+
+    def read_profiles(self, path):
+        """Return {name: model fields}, the last entry winning for repeated names"""
+        try:
+            with open(path, encoding='utf-8') as json_file:
+                entries = json.load(json_file)
+        except OSError as error:
+            raise CommandError(f"Can't read {path}: {error}")
+        except ValueError as error:
+            raise CommandError(f"Invalid JSON in {path}: {error}")
+        if not isinstance(entries, list):
+            raise CommandError("Expected a list of profiles")
+
+        profiles = {}
+        for number, entry in enumerate(entries, 1):
+            try:
+                name = str(entry['name']).strip()
+                latitude, longitude = float(entry['latitude']), float(entry['longitude'])
+                radius_meters = float(entry['radius_km']) * 1000
+                timezone = entry.get('timezone', 'UTC')
+                factors = [float(factor) for factor in entry['speed_factors']]
+            except (KeyError, TypeError, ValueError):
+                raise CommandError(f"Profile {number}: missing or invalid fields")
+            if not name:
+                raise CommandError(f"Profile {number}: name is empty")
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and radius_meters > 0):
+                raise CommandError(f"Profile {number}: coordinates or radius out of range")
+            if timezone not in pytz.all_timezones_set:
+                raise CommandError(f"Profile {number}: unknown timezone {timezone!r}")
+            if len(factors) == 24:
+                factors *= 7
+            if len(factors) != HOURS_PER_WEEK:
+                raise CommandError(f"Profile {number}: expected 24 or {HOURS_PER_WEEK} speed factors")
+            if not all(0 < factor <= MAX_SPEED_FACTOR for factor in factors):
+                raise CommandError(f"Profile {number}: speed factors must be above 0 and at most {MAX_SPEED_FACTOR}")
+            profiles[name] = {
+                'latitude': latitude, 'longitude': longitude, 'radius_meters': radius_meters,
+                'timezone': timezone, 'speed_factors': factors,
+            }
+        return profiles
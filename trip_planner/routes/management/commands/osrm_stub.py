@@ -0,0 +1,54 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from routes.osrm_stub import serve_forever
+from routes.road_graph import RoadGraph, RoadGraphRouter, StraightLineRouter
+
+DEFAULT_GRAPH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                             'data', 'us_highways.json')
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local OSRM-compatible routing server (route and table services) "
+        "for tests, load tests and offline use. Point OSRM_BASE_URL at it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--graph', default=DEFAULT_GRAPH,
+                            help="Road graph JSON file (default: bundled US highway network)")
+        parser.add_argument('--straight-line', action='store_true',
+                            help="Ignore the road graph and route in straight lines")
+        parser.add_argument('--no-fallback', action='store_true',
+                            help="Return NoRoute instead of a straight line when the graph has no route")
+        parser.add_argument('--max-snap-km', type=float, default=100,
+                            help="Furthest a waypoint may be from the graph (default: 100)")
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Processes sharing the listening socket (default: 1)")
+        parser.add_argument('--verbose', action='store_true', help="Log every request")
+
+    def handle(self, *args, **options):
+        if options['straight_line']:
+            router = StraightLineRouter()
+            description = "straight-line routing"
+        else:
+            try:
+                graph = RoadGraph.load(options['graph'])
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f"Could not load road graph {options['graph']}: {e}")
+            router = RoadGraphRouter(
+                graph,
+                fallback=not options['no_fallback'],
+                max_snap_meters=options['max_snap_km'] * 1000
+            )
+            description = f"{len(graph.node_ids)}-node road graph from {options['graph']}"
+
+        self.stdout.write(
+            f"Serving OSRM API on http://{options['host']}:{options['port']} "
+            f"with {description} ({options['workers']} worker(s)). Press CTRL-C to stop."
+        )
+        serve_forever(router, options['host'], options['port'],
+                      workers=options['workers'], verbose=options['verbose'])
@@ -0,0 +1,91 @@
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from routes.analytics import KEY_FIELDS, departure_week, plan_totals
+from routes.models import Location, PlanSnapshot, RollupTotals, RouteStop, Trip, TripProgress, TripRollup, WeeklyRollup
+from routes.progress import latest_snapshot_ids
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the analytics rollups from the latest plan and progress of every trip, "
+        "for trips planned before the rollups existed or after changing them by hand."
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            TripRollup.objects.all().delete()
+            WeeklyRollup.objects.all().delete()
+
+            weeks = {}
+            trips = 0
+            trip_ids = list(Trip.objects.order_by('id').values_list('id', flat=True))
+            for offset in range(0, len(trip_ids), BATCH_SIZE):
+                rollups = self.trip_rollups(trip_ids[offset:offset + BATCH_SIZE])
+                TripRollup.objects.bulk_create(rollups, batch_size=BATCH_SIZE)
+                trips += len(rollups)
+                for rollup in rollups:
+                    key = tuple(getattr(rollup, field) for field in KEY_FIELDS)
+                    week = weeks.setdefault(key, WeeklyRollup(**dict(zip(KEY_FIELDS, key))))
+                    week.trips += 1
+                    for field in RollupTotals.FIELDS:
+                        setattr(week, field, getattr(week, field) + getattr(rollup, field))
+            WeeklyRollup.objects.bulk_create(weeks.values(), batch_size=BATCH_SIZE)
+
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {trips} trips into {len(weeks)} weekly rows"))
+
+    def trip_rollups(self, trip_ids):
+        """Unsaved TripRollup rows of a batch of trips, from their latest plans and progress"""
+        trips = Trip.objects.in_bulk(trip_ids)
+        positions = dict(TripProgress.objects.filter(trip_id__in=trip_ids).values_list('trip_id', 'position_miles'))
+        plans = self.plan_stops(trip_ids)
+        rollups = []
+        for trip_id, trip_stops in plans.items():
+            trip = trips[trip_id]
+            departure_time = min(stop.arrival_time for stop in trip_stops)
+            rollups.append(TripRollup(
+                trip=trip,
+                driver_id=trip.driver_id,
+                pickup_location_id=trip.pickup_location_id,
+                dropoff_location_id=trip.dropoff_location_id,
+                departure_time=departure_time,
+                week=departure_week(departure_time, trip.client_timezone),
+                actual_miles=positions.get(trip_id, 0),
+                **plan_totals(trip, trip_stops),
+            ))
+        return rollups
+
+    def plan_stops(self, trip_ids):
+        """
+        {trip id: stops} of the trips' latest plans, as their snapshots
+        recorded them: progress pings shift the saved stops of trips under
+        way. Trips planned before snapshots existed use their saved stops.
+        """
+        snapshot_ids = [snapshot_id for snapshot_id in latest_snapshot_ids(trip_ids).values() if snapshot_id]
+        plans = {}
+        for trip_id, data in PlanSnapshot.objects.filter(id__in=snapshot_ids).values_list('trip_id', 'data'):
+            plans[trip_id] = [
+                RouteStop(
+                    stop_type=stop['stop_type'],
+                    arrival_time=parse_datetime(stop['arrival_time']),
+                    departure_time=parse_datetime(stop['departure_time']),
+                    notes=stop['notes'],
+                    position_miles=stop['position_miles'],
+                    location=Location(name=stop['location_details']['name']),
+                )
+                for stop in data['stops']
+            ]
+
+        stops = (
+            RouteStop.objects.filter(trip_id__in=set(trip_ids) - plans.keys())
+            .select_related('location')
+            .order_by('trip_id', 'arrival_time', 'id')
+        )
+        for trip_id, trip_stops in groupby(stops, key=lambda stop: stop.trip_id):
+            plans[trip_id] = list(trip_stops)
+        return {trip_id: trip_stops for trip_id, trip_stops in plans.items() if trip_stops}
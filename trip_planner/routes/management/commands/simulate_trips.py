@@ -0,0 +1,129 @@
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from routes.simulation import OPTIONAL_COLUMNS, REQUIRED_COLUMNS, init_worker, simulate_batch
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+# Batches queued per worker process, so reading stays just ahead of planning
+BATCHES_PER_WORKER = 4
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+
+class Command(BaseCommand):
+    help = (
+        "Plan trips from a CSV or Parquet file with the HOS scheduler, without the API or "
+        f"the database, and write one JSON line per trip. Columns: {', '.join(REQUIRED_COLUMNS)}; "
+        f"optional: {', '.join(OPTIONAL_COLUMNS)}. Routes come from the configured routing backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="CSV or Parquet (.parquet, .pq) file of trips")
+        parser.add_argument('output', help="JSON Lines file to write the results to")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help="Worker processes (default: one per CPU); 1 plans in this process")
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Trips sent to a worker at a time (default: 50)")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--workers and --batch-size must be at least 1")
+
+        rows = self.read_rows(options['input'])
+        # Open the input and check its columns before creating the output
+        first = next(rows, None)
+        rows = itertools.chain([first], rows) if first is not None else iter(())
+        batches = self.batches(rows, options['batch_size'])
+        started = time.monotonic()
+        trips = errors = 0
+        try:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                for results in self.simulate(batches, options['workers']):
+                    for result in results:
+                        output.write(json.dumps(result, separators=(',', ':')) + '\n')
+                    trips += len(results)
+                    errors += sum(1 for result in results if 'error' in result)
+        except OSError as error:
+            raise CommandError(f"Can't write {options['output']}: {error}")
+
+        elapsed = time.monotonic() - started
+        rate = trips / elapsed * 3600 if elapsed > 0 else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Simulated {trips} trips ({errors} failed) in {elapsed:.1f}s, {rate:,.0f} trips per hour"
+        ))
+
+    def simulate(self, batches, workers):
+        """Results of each batch, in input order"""
+        if workers == 1:
+            for batch in batches:
+                yield simulate_batch(batch)
+            return
+
+        # Forked workers must not share this process's database connections
+        connections.close_all()
+        with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(simulate_batch, (batch,)))
+                if len(pending) >= workers * BATCHES_PER_WORKER:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def batches(self, rows, batch_size):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def read_rows(self, path):
+        """(row number, {column: value}) for each trip in the file"""
+        if path.lower().endswith(PARQUET_EXTENSIONS):
+            return self.read_parquet(path)
+        return self.read_csv(path)
+
+    def check_columns(self, columns):
+        missing = set(REQUIRED_COLUMNS) - set(columns)
+        if missing:
+            raise CommandError(f"Missing columns: {', '.join(sorted(missing))}")
+
+    def read_csv(self, path):
+        try:
+            csv_file = open(path, newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(f"Can't read {path}: {error}")
+        with csv_file:
+            reader = csv.DictReader(csv_file)
+            self.check_columns(reader.fieldnames or ())
+            for row in reader:
+                yield reader.line_num, row
+
+    def read_parquet(self, path):
+        if parquet is None:
+            raise CommandError("Reading Parquet files requires pyarrow (pip install pyarrow)")
+        try:
+            parquet_file = parquet.ParquetFile(path)
+        except OSError as error:
+            raise CommandError(f"Can't read {path}: {error}")
+        self.check_columns(parquet_file.schema_arrow.names)
+        columns = [column for column in REQUIRED_COLUMNS + OPTIONAL_COLUMNS if column in parquet_file.schema_arrow.names]
+        number = 0
+        for record_batch in parquet_file.iter_batches(columns=columns):
+            for row in record_batch.to_pylist():
+                number += 1
+                yield number, row
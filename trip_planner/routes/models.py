@@ -1,11 +1,67 @@
+import math
 from django.db import models
+from django.db.models import ExpressionWrapper, F, FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt, Substr
 from django.contrib.auth.models import User
+from .geo import EARTH_RADIUS_METERS, bounding_box, geohash_encode, geohash_neighbourhood
+
+class LocationQuerySet(models.QuerySet):
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Filter to a box; min_lon > max_lon selects a box crossing the antimeridian"""
+        queryset = self.filter(latitude__gte=min_lat, latitude__lte=max_lat)
+        if min_lon <= max_lon:
+            return queryset.filter(longitude__gte=min_lon, longitude__lte=max_lon)
+        return queryset.filter(Q(longitude__gte=min_lon) | Q(longitude__lte=max_lon))
+    
+    def within_radius(self, lat, lon, radius_meters):
+        """
+        Filter to locations within radius_meters of a point, annotated with
+        their `distance` in meters
+        
+        The geohash cells and bounding box around the point narrow the rows
+        through indexes before the exact distance is compared.
+        """
+        in_cells = Q()
+        for prefix in geohash_neighbourhood(lat, lon, radius_meters):
+            in_cells |= Q(geohash__startswith=prefix)
+        return (
+            self.filter(in_cells)
+            .within_bbox(*bounding_box(lat, lon, radius_meters))
+            .with_distance(lat, lon)
+            .filter(distance__lte=radius_meters)
+        )
+    
+    def with_distance(self, lat, lon):
+        """Annotate the great-circle `distance` in meters from a point"""
+        lat_radians = Radians(F('latitude'))
+        half_dlat = Sin((lat_radians - Value(math.radians(lat))) / 2)
+        half_dlon = Sin((Radians(F('longitude')) - Value(math.radians(lon))) / 2)
+        a = Power(half_dlat, 2) + Value(math.cos(math.radians(lat))) * Cos(lat_radians) * Power(half_dlon, 2)
+        return self.annotate(distance=ExpressionWrapper(
+            2 * EARTH_RADIUS_METERS * ASin(Least(Sqrt(a), Value(1.0))),
+            output_field=FloatField(),
+        ))
 
 class Location(models.Model):
     name = models.CharField(max_length=255)
     latitude = models.FloatField()
     longitude = models.FloatField()
     address = models.TextField(blank=True, null=True)
+    # Kept in step with the coordinates by save(); bulk inserts must set it
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False)
+    is_waypoint = models.BooleanField(
+        default=False, db_index=True,
+        help_text="Generated stop position rather than a user-managed location"
+    )
+    
+    objects = LocationQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [models.Index(fields=['latitude', 'longitude'])]
+    
+    def save(self, *args, **kwargs):
+        self.geohash = geohash_encode(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return self.name
@@ -27,6 +83,9 @@ class Trip(models.Model):
     current_cycle_hours = models.FloatField(help_text="Current cycle hours used (in hours)")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='planned')
     client_timezone = models.CharField(max_length=50, default='UTC', help_text="Client's timezone")
+    # With both set, fuel stops are placed to minimize fuel cost at the stations in FuelStation
+    tank_capacity_gallons = models.FloatField(null=True, blank=True, help_text="Usable fuel tank capacity")
+    mpg = models.FloatField(null=True, blank=True, help_text="Fuel economy in miles per gallon")
     
     def __str__(self):
         return f"Trip from {self.pickup_location} to {self.dropoff_location}"
@@ -47,7 +106,162 @@ class RouteStop(models.Model):
     departure_time = models.DateTimeField(null=True, blank=True)
     stop_type = models.CharField(max_length=20, choices=STOP_TYPE_CHOICES)
     notes = models.TextField(blank=True, null=True)
+    position_miles = models.FloatField(null=True, blank=True, help_text="Route miles from the trip start")
     
     def __str__(self):
         return f"{self.get_stop_type_display()} at {self.location}"
 
+
+
+# Geohash cells of about 20 by 20-40 km, indexed for corridor searches
+FUEL_STATION_CELL_PRECISION = 4
+
+class FuelStationQuerySet(models.QuerySet):
+    def in_cells(self, prefixes):
+        """Filter to stations in geohash cells given as prefixes of FUEL_STATION_CELL_PRECISION characters"""
+        return self.annotate(cell=Substr('geohash', 1, FUEL_STATION_CELL_PRECISION)).filter(cell__in=prefixes)
+
+class FuelStation(models.Model):
+    """A fuel station and its current price, loaded with `manage.py load_fuel_prices`"""
+    external_id = models.CharField(max_length=64, unique=True, help_text="Identifier in the price feed")
+    name = models.CharField(max_length=255)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    # Kept in step with the coordinates by save(); bulk inserts must set it
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False)
+    price_per_gallon = models.DecimalField(max_digits=6, decimal_places=3)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = FuelStationQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [models.Index(Substr('geohash', 1, FUEL_STATION_CELL_PRECISION), name='routes_fuelstation_cell')]
+    
+    def save(self, *args, **kwargs):
+        self.geohash = geohash_encode(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
+    
+    def __str__(self):
+        return f"{self.name} (${self.price_per_gallon}/gal)"
+
+
+
+class TrafficProfile(models.Model):
+    """
+    Hour-of-week driving speeds around a metro area or along a corridor,
+    loaded with `manage.py load_traffic_profiles`
+    """
+    name = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    radius_meters = models.FloatField(help_text="Radius of the area the profile covers")
+    timezone = models.CharField(max_length=50, default='UTC', help_text="Hours of the week are local to this timezone")
+    speed_factors = models.JSONField(
+        help_text="168 speeds relative to free flow, one per hour of the week from Monday 00:00"
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return self.name
+
+
+
+class PlanSnapshotQuerySet(models.QuerySet):
+    def for_trip(self, trip):
+        """
+        The trip's snapshots, its current plan (the one its stops and daily
+        logs were generated from) first: every plan computed gets the next
+        version, so the current plan has the highest
+        """
+        return self.filter(trip=trip).order_by('-version')
+
+class PlanSnapshot(models.Model):
+    """
+    Stored response of a plan calculation, keyed by a content hash of the
+    planning inputs so identical requests can be served without recomputing
+
+    The stop times are as planned; progress pings shift the saved stops of
+    a trip under way but not its snapshot.
+    """
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='plan_snapshots')
+    input_hash = models.CharField(max_length=64, help_text="SHA-256 of all planning inputs")
+    version = models.PositiveIntegerField(default=1, help_text="Plan version within the trip, counting from 1")
+    departure_time = models.DateTimeField()
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = PlanSnapshotQuerySet.as_manager()
+    
+    class Meta:
+        unique_together = [('trip', 'input_hash'), ('trip', 'version')]
+    
+    def __str__(self):
+        return f"Plan snapshot {self.input_hash[:12]} for {self.trip}"
+
+
+
+class TripProgress(models.Model):
+    """
+    Latest reported position of a trip, matched onto the geometry of the
+    plan snapshot it was tracked against
+    """
+    trip = models.OneToOneField(Trip, on_delete=models.CASCADE, related_name='progress')
+    snapshot = models.ForeignKey(PlanSnapshot, on_delete=models.SET_NULL, null=True, blank=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    recorded_at = models.DateTimeField(help_text="Time of the latest accepted ping")
+    position_miles = models.FloatField(default=0, help_text="Route miles from the trip start")
+    segment_index = models.PositiveIntegerField(default=0, help_text="Matched geometry segment, where matching resumes")
+    off_route_meters = models.FloatField(default=0)
+    delay_seconds = models.FloatField(default=0, help_text="Shift applied to the remaining stops")
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Progress of {self.trip} at {self.position_miles:.1f} mi"
+
+
+
+class RollupTotals(models.Model):
+    """Plan and log totals summed by the analytics rollups"""
+    planned_miles = models.FloatField(default=0)
+    actual_miles = models.FloatField(default=0, help_text="Route miles covered, from progress pings")
+    rest_stops = models.PositiveIntegerField(default=0)
+    sleep_stops = models.PositiveIntegerField(default=0)
+    fuel_stops = models.PositiveIntegerField(default=0)
+    log_days = models.PositiveIntegerField(default=0, help_text="Daily logs the plan spans")
+    driving_hours = models.FloatField(default=0)
+    
+    FIELDS = ('planned_miles', 'actual_miles', 'rest_stops', 'sleep_stops', 'fuel_stops', 'log_days', 'driving_hours')
+    
+    class Meta:
+        abstract = True
+
+class TripRollup(RollupTotals):
+    """
+    A trip's totals as of its latest plan, and the weekly rollup row they
+    are counted in; kept so a new plan can replace them there
+    """
+    trip = models.OneToOneField(Trip, on_delete=models.CASCADE, related_name='rollup')
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    pickup_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    dropoff_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    departure_time = models.DateTimeField()
+    week = models.DateField(help_text="Monday of the departure week in the trip's timezone")
+    
+    def __str__(self):
+        return f"Rollup of {self.trip}"
+
+class WeeklyRollup(RollupTotals):
+    """Totals of the trips of a driver on a lane (pickup to dropoff) departing in a week"""
+    week = models.DateField(help_text="Monday of the departure week in the trips' timezone")
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    pickup_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    dropoff_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    trips = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = [('week', 'driver', 'pickup_location', 'dropoff_location')]
+        indexes = [models.Index(fields=['driver', 'week'])]
+    
+    def __str__(self):
+        return f"Week of {self.week}: {self.trips} trips from {self.pickup_location} to {self.dropoff_location}"
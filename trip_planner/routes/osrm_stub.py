@@ -0,0 +1,262 @@
+"""
+Local OSRM-compatible routing server
+
+Implements the subset of the OSRM HTTP API used by the planner:
+
+    GET /route/v1/{profile}/{lon,lat;lon,lat;...}?overview=full&geometries=geojson
+    GET /table/v1/{profile}/{lon,lat;...}?sources=0&destinations=1;2&annotations=duration,distance
+
+Routes come from a router object (see routes.road_graph). Encoded responses
+are cached per URL, so repeated requests in load tests skip routing entirely.
+"""
+import json
+import os
+import signal
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+RESPONSE_CACHE_SIZE = 4096
+
+
+class OSRMError(Exception):
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def encode_polyline(coordinates, precision=5):
+    """Encode [lon, lat] points in Google's polyline format, as OSRM does"""
+    factor = 10 ** precision
+    output = []
+    previous_lat = previous_lon = 0
+    for lon, lat in coordinates:
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        for value in (lat - previous_lat, lon - previous_lon):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                output.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            output.append(chr(value + 63))
+        previous_lat, previous_lon = lat, lon
+    return ''.join(output)
+
+
+def parse_coordinates(text):
+    """Parse 'lon,lat;lon,lat' into a list of (lon, lat) tuples"""
+    try:
+        coordinates = [tuple(float(value) for value in pair.split(',')) for pair in unquote(text).split(';')]
+    except ValueError:
+        raise OSRMError('InvalidUrl', 'Coordinates must be lon,lat pairs separated by ;')
+    if any(len(pair) != 2 for pair in coordinates):
+        raise OSRMError('InvalidUrl', 'Coordinates must be lon,lat pairs separated by ;')
+    for lon, lat in coordinates:
+        if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+            raise OSRMError('InvalidValue', 'Coordinates are out of range')
+    return coordinates
+
+
+def _index_list(value, count):
+    if value in (None, 'all'):
+        return list(range(count))
+    try:
+        indexes = [int(index) for index in value.split(';')]
+    except ValueError:
+        raise OSRMError('InvalidQuery', 'Indexes must be integers separated by ;')
+    if any(index < 0 or index >= count for index in indexes):
+        raise OSRMError('InvalidQuery', 'Index out of range')
+    return indexes
+
+
+def route_response(router, coordinates, query):
+    if len(coordinates) < 2:
+        raise OSRMError('InvalidQuery', 'At least two coordinates are required')
+
+    result = router.route(coordinates)
+    if result is None:
+        raise OSRMError('NoRoute', 'Impossible route between points')
+
+    overview = query.get('overview', 'simplified')
+    geometries = query.get('geometries', 'polyline')
+    route = {
+        'distance': result['distance'],
+        'duration': result['duration'],
+        'weight': result['duration'],
+        'weight_name': 'duration',
+        'legs': [
+            {'distance': leg['distance'], 'duration': leg['duration'],
+             'weight': leg['duration'], 'summary': '', 'steps': []}
+            for leg in result['legs']
+        ],
+    }
+    if overview != 'false':
+        points = result['coordinates']
+        if overview == 'simplified':
+            # Keep at most ~100 points, always including the ends
+            stride = max(1, len(points) // 100)
+            points = points[::stride] + ([points[-1]] if (len(points) - 1) % stride else [])
+        if geometries == 'geojson':
+            route['geometry'] = {'type': 'LineString', 'coordinates': points}
+        elif geometries in ('polyline', 'polyline6'):
+            route['geometry'] = encode_polyline(points, 6 if geometries == 'polyline6' else 5)
+        else:
+            raise OSRMError('InvalidOptions', f"Unsupported geometries '{geometries}'")
+
+    return {
+        'code': 'Ok',
+        'routes': [route],
+        'waypoints': [
+            {'location': waypoint['location'], 'distance': waypoint['distance'], 'name': '', 'hint': ''}
+            for waypoint in result['waypoints']
+        ],
+    }
+
+
+def table_response(router, coordinates, query):
+    sources = _index_list(query.get('sources'), len(coordinates))
+    destinations = _index_list(query.get('destinations'), len(coordinates))
+    annotations = query.get('annotations', 'duration').split(',')
+
+    durations, distances = router.table(
+        [coordinates[index] for index in sources],
+        [coordinates[index] for index in destinations]
+    )
+
+    def waypoint(index):
+        location, distance = router.snap(coordinates[index])
+        return {'location': list(location), 'distance': distance, 'name': '', 'hint': ''}
+
+    response = {
+        'code': 'Ok',
+        'sources': [waypoint(index) for index in sources],
+        'destinations': [waypoint(index) for index in destinations],
+    }
+    if 'duration' in annotations:
+        response['durations'] = durations
+    if 'distance' in annotations:
+        response['distances'] = distances
+    return response
+
+
+SERVICES = {
+    'route': route_response,
+    'table': table_response,
+}
+
+
+def handle_request(router, path_and_query):
+    """Return (status, body dict) for an OSRM request path"""
+    url = urlsplit(path_and_query)
+    parts = url.path.strip('/').split('/')
+    # /{service}/{version}/{profile}/{coordinates}
+    if len(parts) != 4 or parts[1] != 'v1' or parts[0] not in SERVICES:
+        raise OSRMError('InvalidUrl', f"URL string malformed close to position 1: \"{url.path}\"")
+
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    coordinates = parse_coordinates(parts[3])
+    return 200, SERVICES[parts[0]](router, coordinates, query)
+
+
+class OSRMStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        payload, status = self.server.cached_response(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class OSRMStubServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering OSRM requests with a router
+
+    Can be used as a context manager that serves on a background thread:
+
+        with OSRMStubServer(StraightLineRouter()) as server:
+            ... settings.OSRM_BASE_URL = server.base_url ...
+    """
+    daemon_threads = True
+
+    def __init__(self, router, host='127.0.0.1', port=0, verbose=False, bind_and_activate=True):
+        super().__init__((host, port), OSRMStubHandler, bind_and_activate)
+        self.router = router
+        self.verbose = verbose
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def cached_response(self, path):
+        """Return (encoded body, status) for a request path, memoizing successes"""
+        with self._cache_lock:
+            cached = self._cache.get(path)
+            if cached is not None:
+                self._cache.move_to_end(path)
+                return cached
+
+        try:
+            status, body = handle_request(self.router, path)
+        except OSRMError as e:
+            return json.dumps({'code': e.code, 'message': e.message}).encode('utf-8'), e.status
+
+        result = (json.dumps(body, separators=(',', ':')).encode('utf-8'), status)
+        with self._cache_lock:
+            self._cache[path] = result
+            if len(self._cache) > RESPONSE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def serve_forever(router, host, port, workers=1, verbose=False):
+    """
+    Serve until interrupted, forking `workers` processes that share the
+    listening socket (and the already-loaded router) when workers > 1
+    """
+    server = OSRMStubServer(router, host, port, verbose=verbose)
+    children = []
+    if workers > 1 and hasattr(os, 'fork'):
+        for _ in range(workers - 1):
+            pid = os.fork()
+            if pid == 0:
+                children = None
+                break
+            children.append(pid)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for pid in children or ():
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (OSError, KeyboardInterrupt):
+                pass
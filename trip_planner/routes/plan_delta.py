@@ -0,0 +1,92 @@
+"""
+Differences between two stored plans of a trip
+
+Plans are compared as they were returned to clients (PlanSnapshot.data).
+Stops and log entries are aligned between the plans before being compared
+(stops by type and route position, entries by status and location), so an
+inserted or removed stop doesn't mark every later one as changed; daily logs
+are matched by date. Stop and log entry ids are left out of the comparison:
+regenerating a plan recreates the stops and appends new log entries, so ids
+change even where nothing else does.
+"""
+from difflib import SequenceMatcher
+
+# Fields that change with every regeneration and are not compared
+VOLATILE_FIELDS = ('id',)
+
+
+def _content(item):
+    return {key: value for key, value in item.items() if key not in VOLATILE_FIELDS}
+
+
+def stop_key(stop):
+    position = stop.get('position_miles')
+    return stop['stop_type'], round(position, 3) if position is not None else None
+
+
+def entry_key(entry):
+    return entry['status'], entry['location']
+
+
+def list_delta(old, new, key):
+    """
+    Delta from list old to list new, aligning their items by key:
+    {'count': length of new,
+     'kept': [[new index, old index, length], ...] runs of aligned items,
+     'changed': [{'index': i, 'fields': {field: new value}}] aligned items
+     whose other fields differ,
+     'added': [{'index': i, 'item': new[i]}] the items not aligned}
+    Old items outside the kept runs were removed.
+    """
+    matcher = SequenceMatcher(None, [key(item) for item in old], [key(item) for item in new], autojunk=False)
+    kept, changed, aligned = [], [], set()
+    for old_start, new_start, length in matcher.get_matching_blocks():
+        if not length:
+            continue
+        kept.append([new_start, old_start, length])
+        for offset in range(length):
+            before, after = old[old_start + offset], new[new_start + offset]
+            aligned.add(new_start + offset)
+            fields = {field: value for field, value in _content(after).items() if before.get(field) != value}
+            if fields:
+                changed.append({'index': new_start + offset, 'fields': fields})
+    added = [{'index': index, 'item': item} for index, item in enumerate(new) if index not in aligned]
+    return {'count': len(new), 'kept': kept, 'changed': changed, 'added': added}
+
+
+def daily_logs_delta(old, new):
+    """Daily logs added or changed between two plans, by date, and the dates removed"""
+    old_by_date = {log['date']: log for log in old}
+    new_dates = {log['date'] for log in new}
+    changed = []
+    for log in new:
+        previous = old_by_date.get(log['date'])
+        if previous is None:
+            changed.append(dict(log, entries=list_delta([], log['entries'], entry_key)))
+            continue
+        entries = list_delta(previous['entries'], log['entries'], entry_key)
+        fields_changed = _content(dict(previous, entries=None)) != _content(dict(log, entries=None))
+        removed = len(previous['entries']) - sum(length for _, _, length in entries['kept'])
+        if fields_changed or entries['changed'] or entries['added'] or removed:
+            changed.append(dict(log, entries=entries))
+    return {
+        'changed': changed,
+        'removed': sorted(date for date in old_by_date if date not in new_dates),
+    }
+
+
+def diff_plans(old, new):
+    """
+    Delta from one plan's data to another's
+
+    'stops' and 'daily_logs' hold only what changed; 'route' and 'fuel_plan'
+    are included only when they differ.
+    """
+    delta = {
+        'stops': list_delta(old['stops'], new['stops'], stop_key),
+        'daily_logs': daily_logs_delta(old['daily_logs'], new['daily_logs']),
+    }
+    for key in ('route', 'fuel_plan'):
+        if old.get(key) != new.get(key):
+            delta[key] = new.get(key)
+    return delta
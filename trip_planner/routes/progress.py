@@ -0,0 +1,340 @@
+"""
+Trip progress tracking from GPS/ELD pings
+
+Pings are matched onto the route geometry stored in the trip's latest plan
+snapshot. The matched position gives the planned time at that point of the
+route; the difference to the ping time is the trip's delay, which is applied
+to the remaining stops' arrival and departure times.
+
+Trackers (the route geometry with cumulative route miles per point, plus the
+planned timeline) are built once per snapshot and kept in a per-process LRU
+cache, so a batch of pings costs a fixed handful of queries however many
+trips it covers.
+"""
+import bisect
+import datetime
+import threading
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils.dateparse import parse_datetime
+
+from trip_planner.response_cache import bump_versions
+
+from .analytics import update_actual_miles
+from .geo import haversine_meters, locate_on_line, route_polyline
+from .models import PlanSnapshot, RouteStop, Trip, TripProgress
+
+TRACKER_CACHE_SIZE = 1024
+# Route geometry points closer than this to the previous kept point are dropped
+TRACKING_SPACING_METERS = 200
+# Segments searched around the last matched one before falling back to the whole route
+MATCH_WINDOW_BEHIND = 5
+MATCH_WINDOW_AHEAD = 50
+# Pings further than this from the route don't move the trip along it
+MAX_MATCH_OFFSET_METERS = 2000
+# Delays applied to remaining stops are rounded to this, so stops are only
+# rewritten when the ETA moves by a whole step and trips sharing a change
+# are shifted together
+ETA_RESOLUTION_SECONDS = 60
+# TripProgress fields a ping sets
+PROGRESS_FIELDS = (
+    'snapshot', 'latitude', 'longitude', 'recorded_at',
+    'position_miles', 'segment_index', 'off_route_meters', 'delay_seconds',
+)
+BATCH_SIZE = 500
+
+
+class TripTracker:
+    """Route geometry and planned timeline of one plan snapshot"""
+
+    def __init__(self, snapshot_id, data):
+        self.snapshot_id = snapshot_id
+        route = data['route']
+
+        self.lats, self.lons, self.miles = route_polyline(route, TRACKING_SPACING_METERS)
+        self.total_miles = route['current_to_pickup']['distance_miles'] + route['pickup_to_dropoff']['distance_miles']
+
+        # Planned stops, and the timeline as (miles, arrival, departure) with
+        # stops at the same position merged into one window
+        self.stops = []
+        for stop in data['stops']:
+            arrival = parse_datetime(stop['arrival_time'])
+            departure = parse_datetime(stop['departure_time']) if stop['departure_time'] else arrival
+            self.stops.append((stop['id'], stop['stop_type'], stop['position_miles'], arrival, departure))
+        self.stops.sort(key=lambda stop: (stop[2], stop[3]))
+
+        self.timeline = []
+        for _, _, position, arrival, departure in self.stops:
+            if self.timeline and abs(self.timeline[-1][0] - position) < 1e-6:
+                previous = self.timeline[-1]
+                self.timeline[-1] = (previous[0], min(previous[1], arrival), max(previous[2], departure))
+            else:
+                self.timeline.append((position, arrival, departure))
+        self.timeline_miles = [position for position, _, _ in self.timeline]
+
+    def match(self, lat, lon, segment_hint=None):
+        """
+        Return (route miles, segment, offset_meters) of the closest point of
+        the route, searching near segment_hint first
+        """
+        last_segment = len(self.lats) - 1
+        if last_segment < 1:
+            return 0.0, 0, haversine_meters(lat, lon, self.lats[0], self.lons[0]) if self.lats else 0.0
+
+        result = None
+        if segment_hint is not None:
+            start = max(0, segment_hint - MATCH_WINDOW_BEHIND)
+            end = min(last_segment, segment_hint + MATCH_WINDOW_AHEAD)
+            result = locate_on_line(self.lats, self.lons, lat, lon, start, end)
+            if result[2] > MAX_MATCH_OFFSET_METERS:
+                result = None
+        if result is None:
+            result = locate_on_line(self.lats, self.lons, lat, lon)
+
+        segment, fraction, offset = result
+        miles = self.miles[segment] + fraction * (self.miles[segment + 1] - self.miles[segment])
+        return miles, segment, offset
+
+    def delay_seconds(self, position, when):
+        """
+        Seconds the trip is behind plan when at route position `position` at
+        time `when` (negative when ahead)
+
+        Between stops the planned time is interpolated over the drive; at a
+        stop, any time within its planned window is on schedule.
+        """
+        index = bisect.bisect_right(self.timeline_miles, position + 1e-6) - 1
+        if index < 0:
+            return (when - self.timeline[0][1]).total_seconds()
+
+        stop_miles, arrival, departure = self.timeline[index]
+        if position - stop_miles < 1e-3 or index == len(self.timeline) - 1:
+            if when < arrival:
+                return (when - arrival).total_seconds()
+            return max(0.0, (when - departure).total_seconds())
+
+        next_miles, next_arrival, _ = self.timeline[index + 1]
+        fraction = (position - stop_miles) / (next_miles - stop_miles)
+        planned = departure + (next_arrival - departure) * fraction
+        return (when - planned).total_seconds()
+
+    def remaining_stops(self, position):
+        return [stop for stop in self.stops if stop[2] > position + 1e-6]
+
+
+_trackers = OrderedDict()
+_trackers_lock = threading.Lock()
+
+
+def get_trackers(snapshot_ids):
+    """
+    Return {snapshot id: TripTracker, or None if untrackable}, loading
+    snapshots missing from the cache in one query
+    """
+    trackers = {}
+    missing = []
+    with _trackers_lock:
+        for snapshot_id in snapshot_ids:
+            if snapshot_id in _trackers:
+                _trackers.move_to_end(snapshot_id)
+                trackers[snapshot_id] = _trackers[snapshot_id]
+            else:
+                missing.append(snapshot_id)
+
+    if missing:
+        for snapshot_id, data in PlanSnapshot.objects.filter(id__in=missing).values_list('id', 'data'):
+            # Snapshots from before stops had route positions can't be tracked
+            trackable = all(stop.get('position_miles') is not None for stop in data['stops'])
+            trackers[snapshot_id] = TripTracker(snapshot_id, data) if trackable else None
+        with _trackers_lock:
+            for snapshot_id in missing:
+                if snapshot_id in trackers:
+                    _trackers[snapshot_id] = trackers[snapshot_id]
+            while len(_trackers) > TRACKER_CACHE_SIZE:
+                _trackers.popitem(last=False)
+    return trackers
+
+
+def latest_snapshot_ids(trip_ids):
+    """Return {trip id: id of the snapshot the trip's stops were generated with}"""
+    # Each plan computed rewrites the trip's stops and gets the next version,
+    # so the highest version describes the current stops
+    latest = PlanSnapshot.objects.filter(trip=OuterRef('pk')).order_by('-version').values('id')[:1]
+    rows = Trip.objects.filter(id__in=trip_ids).annotate(snapshot_id=Subquery(latest)).values_list('id', 'snapshot_id')
+    return dict(rows)
+
+
+def ingest_pings(pings):
+    """
+    Apply a batch of pings, each a dict with trip, latitude, longitude and
+    timestamp
+
+    Only the newest ping per trip is used; pings for unknown or unplanned
+    trips and pings older than the trip's last accepted one are ignored.
+    Returns the progress events of the updated trips.
+
+    The trips' rows are locked for the whole batch, as calculate_route locks
+    a trip while replacing its stops, so concurrent batches and replans of a
+    trip apply one after the other instead of shifting stops twice or from a
+    stale delay.
+    """
+    newest = {}
+    for ping in pings:
+        current = newest.get(ping['trip'])
+        if current is None or ping['timestamp'] > current['timestamp']:
+            newest[ping['trip']] = ping
+
+    with transaction.atomic():
+        # In id order, so batches covering the same trips don't deadlock
+        list(Trip.objects.select_for_update().filter(id__in=newest).order_by('id').values_list('id', flat=True))
+        events, shifts, changed = _track(newest)
+
+        _save_progress(changed)
+        update_actual_miles({progress.trip_id: progress.position_miles for progress in changed})
+        _shift_remaining_stops(shifts)
+        started = list(Trip.objects.filter(
+            id__in=[event['trip'] for event in events], status='planned'
+        ).values_list('id', flat=True))
+        if started:
+            Trip.objects.filter(id__in=started).update(status='in_progress')
+        # Trip responses show the status and the stop times
+        bump_versions('trip', started + [trip_id for trip_ids in shifts.values() for trip_id in trip_ids])
+
+    return events
+
+
+def _track(newest):
+    """
+    Match each trip's newest ping onto its current plan; return the progress
+    events, the stop shifts as {change in seconds: [trip ids]} and the
+    changed TripProgress instances
+    """
+    snapshot_ids = {trip_id: snapshot_id for trip_id, snapshot_id in latest_snapshot_ids(newest).items() if snapshot_id}
+    trackers = get_trackers(set(snapshot_ids.values()))
+    progress_by_trip = {progress.trip_id: progress for progress in TripProgress.objects.filter(trip_id__in=snapshot_ids)}
+
+    changed, shifts, events = [], {}, []
+    for trip_id, snapshot_id in snapshot_ids.items():
+        tracker = trackers.get(snapshot_id)
+        ping = newest[trip_id]
+        if tracker is None or not tracker.timeline:
+            continue
+
+        progress = progress_by_trip.get(trip_id)
+        if progress is not None and progress.snapshot_id == snapshot_id and ping['timestamp'] <= progress.recorded_at:
+            continue
+        if progress is None:
+            progress = TripProgress(trip_id=trip_id)
+        changed.append(progress)
+        if progress.snapshot_id != snapshot_id:
+            # Tracking a new plan, whose stops carry no shift yet
+            progress.snapshot_id = snapshot_id
+            progress.position_miles = 0.0
+            progress.segment_index = None
+            progress.delay_seconds = 0.0
+
+        miles, segment, offset = tracker.match(ping['latitude'], ping['longitude'], progress.segment_index)
+        progress.latitude = ping['latitude']
+        progress.longitude = ping['longitude']
+        progress.recorded_at = ping['timestamp']
+        progress.off_route_meters = offset
+        if offset <= MAX_MATCH_OFFSET_METERS and miles >= progress.position_miles:
+            # Trucks don't reverse along a route; backwards matches are GPS noise
+            progress.position_miles = miles
+            progress.segment_index = segment
+            delay = tracker.delay_seconds(miles, ping['timestamp'])
+            delay = round(delay / ETA_RESOLUTION_SECONDS) * ETA_RESOLUTION_SECONDS
+            if delay != progress.delay_seconds:
+                shifts.setdefault(delay - progress.delay_seconds, []).append(trip_id)
+                progress.delay_seconds = delay
+        if progress.segment_index is None:
+            progress.segment_index = 0
+
+        events.append(progress_event(
+            progress,
+            [
+                (stop_id, stop_type, position,
+                 arrival + datetime.timedelta(seconds=progress.delay_seconds),
+                 departure + datetime.timedelta(seconds=progress.delay_seconds))
+                for stop_id, stop_type, position, arrival, departure in tracker.remaining_stops(progress.position_miles)
+            ]
+        ))
+    return events, shifts, changed
+
+
+def _save_progress(changed):
+    """
+    Update or create the progress rows of a batch's trips, in place: two
+    queries for the whole batch. The trips are locked, so no concurrent
+    batch creates or updates the same rows.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for progress in changed:
+        # Not set by bulk_update
+        progress.updated_at = now
+    TripProgress.objects.bulk_update(
+        [progress for progress in changed if progress.pk], [*PROGRESS_FIELDS, 'updated_at'], batch_size=BATCH_SIZE
+    )
+    TripProgress.objects.bulk_create([progress for progress in changed if not progress.pk], batch_size=BATCH_SIZE)
+
+
+def _shift_remaining_stops(shifts):
+    """
+    Move the stops beyond each trip's saved position by the trip's change in
+    delay, given as {change in seconds: [trip ids]}; one query per change
+
+    Plan snapshots are left as planned: they are what calculate_route serves
+    and what delays are measured against, and their ETag identifies the
+    planning inputs, so shifting doesn't change it. Progress events and the
+    saved stops carry the shifted times.
+    """
+    position = TripProgress.objects.filter(trip_id=OuterRef('trip_id')).values('position_miles')
+    for delta_seconds, trip_ids in shifts.items():
+        delta = datetime.timedelta(seconds=delta_seconds)
+        RouteStop.objects.filter(
+            trip_id__in=trip_ids, position_miles__gt=Subquery(position) + 1e-6
+        ).update(
+            arrival_time=F('arrival_time') + delta,
+            departure_time=F('departure_time') + delta,
+        )
+
+
+def progress_event(progress, remaining_stops):
+    """
+    Describe a trip's progress and the ETAs of its remaining stops, given
+    as (id, stop_type, position_miles, arrival, departure) tuples
+    """
+    return {
+        'trip': progress.trip_id,
+        'latitude': progress.latitude,
+        'longitude': progress.longitude,
+        'recorded_at': progress.recorded_at.isoformat(),
+        'position_miles': progress.position_miles,
+        'off_route_meters': progress.off_route_meters,
+        'delay_seconds': progress.delay_seconds,
+        'remaining_stops': [
+            {
+                'id': stop_id,
+                'stop_type': stop_type,
+                'position_miles': position,
+                'arrival_time': arrival.isoformat(),
+                'departure_time': departure.isoformat() if departure else None,
+            }
+            for stop_id, stop_type, position, arrival, departure in remaining_stops
+        ],
+    }
+
+
+def current_progress_event(trip_id):
+    """Build the progress event of a trip from the database, or None before its first ping"""
+    progress = TripProgress.objects.filter(trip_id=trip_id).first()
+    if progress is None:
+        return None
+    stops = RouteStop.objects.filter(
+        trip_id=trip_id, position_miles__gt=progress.position_miles + 1e-6
+    ).order_by('position_miles', 'arrival_time').values_list(
+        'id', 'stop_type', 'position_miles', 'arrival_time', 'departure_time'
+    )
+    return progress_event(progress, stops)
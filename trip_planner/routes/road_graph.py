@@ -0,0 +1,257 @@
+"""
+Small road-network routing used by the local OSRM stub server
+
+A road graph is loaded from a JSON file:
+
+    {
+        "detour_factor": 1.15,      # road distance / great-circle distance
+        "default_speed_kph": 96,
+        "nodes": [{"id": "CHI", "lat": 41.8781, "lon": -87.6298}, ...],
+        "edges": [{"from": "CHI", "to": "IND", "speed_kph": 100}, ...]
+    }
+
+Edges are two-way unless marked "oneway". "distance_m" and "geometry" (a list
+of [lon, lat] points between the two nodes) may be given per edge; otherwise
+they are derived from the node positions.
+"""
+import heapq
+import json
+import math
+
+from .geo import densify, haversine_meters
+
+DEFAULT_DETOUR_FACTOR = 1.15
+DEFAULT_SPEED_KPH = 88.5  # 55 mph
+GEOMETRY_SPACING_METERS = 500  # Point spacing of returned route geometry
+GRID_CELL_DEGREES = 1.0  # Cell size of the nearest-node index
+
+
+class StraightLineRouter:
+    """Route along the straight line between waypoints at a constant speed"""
+
+    def __init__(self, detour_factor=DEFAULT_DETOUR_FACTOR, speed_kph=DEFAULT_SPEED_KPH):
+        self.detour_factor = detour_factor
+        self.speed_mps = speed_kph / 3.6
+
+    def leg(self, start, end):
+        """Return (distance_m, duration_s, coordinates) between two (lon, lat) points"""
+        (lon1, lat1), (lon2, lat2) = start, end
+        distance = haversine_meters(lat1, lon1, lat2, lon2) * self.detour_factor
+        coordinates = densify([[lon1, lat1], [lon2, lat2]], GEOMETRY_SPACING_METERS)
+        return distance, distance / self.speed_mps, coordinates
+
+    def snap(self, point):
+        """Return the (lon, lat) a waypoint is matched to and the snapping distance"""
+        return point, 0.0
+
+    def route(self, waypoints):
+        """
+        Route through a list of (lon, lat) waypoints
+
+        Returns a dict with 'distance' (m), 'duration' (s), 'coordinates',
+        'legs' and snapped 'waypoints', or None when no route exists.
+        """
+        legs = []
+        coordinates = []
+        for start, end in zip(waypoints, waypoints[1:]):
+            leg = self.leg(start, end)
+            if leg is None:
+                return None
+            distance, duration, leg_coordinates = leg
+            legs.append({'distance': distance, 'duration': duration})
+            # Consecutive legs share their joining point
+            coordinates.extend(leg_coordinates[1:] if coordinates else leg_coordinates)
+
+        snapped = []
+        for point in waypoints:
+            location, distance = self.snap(point)
+            snapped.append({'location': list(location), 'distance': distance})
+
+        return {
+            'distance': sum(leg['distance'] for leg in legs),
+            'duration': sum(leg['duration'] for leg in legs),
+            'coordinates': coordinates,
+            'legs': legs,
+            'waypoints': snapped,
+        }
+
+    def table(self, sources, destinations):
+        """Return (durations, distances) matrices between two lists of (lon, lat) points"""
+        durations = []
+        distances = []
+        for source in sources:
+            duration_row = []
+            distance_row = []
+            for destination in destinations:
+                leg = self.leg(source, destination)
+                duration_row.append(leg[1] if leg else None)
+                distance_row.append(leg[0] if leg else None)
+            durations.append(duration_row)
+            distances.append(distance_row)
+        return durations, distances
+
+
+class RoadGraph:
+    """Road network held as adjacency lists with a grid index for snapping"""
+
+    def __init__(self, node_ids, lats, lons, edges):
+        self.node_ids = node_ids
+        self.lats = lats
+        self.lons = lons
+        # adjacency[u] -> list of (v, duration_s, distance_m, geometry)
+        self.adjacency = [[] for _ in node_ids]
+        for u, v, duration, distance, geometry in edges:
+            self.adjacency[u].append((v, duration, distance, geometry))
+        self.max_speed_mps = max(
+            (distance / duration for u, v, duration, distance, geometry in edges if duration > 0),
+            default=DEFAULT_SPEED_KPH / 3.6
+        )
+
+        self.grid = {}
+        for node, (lat, lon) in enumerate(zip(lats, lons)):
+            self.grid.setdefault(self._cell(lat, lon), []).append(node)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        detour_factor = data.get('detour_factor', DEFAULT_DETOUR_FACTOR)
+        default_speed = data.get('default_speed_kph', DEFAULT_SPEED_KPH)
+
+        index = {}
+        node_ids, lats, lons = [], [], []
+        for node in data['nodes']:
+            index[node['id']] = len(node_ids)
+            node_ids.append(node['id'])
+            lats.append(float(node['lat']))
+            lons.append(float(node['lon']))
+
+        edges = []
+        for edge in data['edges']:
+            u, v = index[edge['from']], index[edge['to']]
+            geometry = [[lons[u], lats[u]]] + edge.get('geometry', []) + [[lons[v], lats[v]]]
+            distance = edge.get('distance_m')
+            if distance is None:
+                distance = detour_factor * sum(
+                    haversine_meters(lat1, lon1, lat2, lon2)
+                    for (lon1, lat1), (lon2, lat2) in zip(geometry, geometry[1:])
+                )
+            duration = distance / (edge.get('speed_kph', default_speed) / 3.6)
+            edges.append((u, v, duration, distance, geometry))
+            if not edge.get('oneway', False):
+                edges.append((v, u, duration, distance, geometry[::-1]))
+
+        return cls(node_ids, lats, lons, edges)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / GRID_CELL_DEGREES)), int(math.floor(lon / GRID_CELL_DEGREES)))
+
+    def nearest_node(self, lon, lat):
+        """Return (node, distance_m) of the node closest to a point"""
+        row, col = self._cell(lat, lon)
+        best, best_distance = None, math.inf
+        ring = 0
+        max_ring = int(360 / GRID_CELL_DEGREES)
+        while ring <= max_ring:
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    # Only visit the border of the ring
+                    if ring and abs(r - row) != ring and abs(c - col) != ring:
+                        continue
+                    for node in self.grid.get((r, c), ()):
+                        distance = haversine_meters(lat, lon, self.lats[node], self.lons[node])
+                        if distance < best_distance:
+                            best, best_distance = node, distance
+            # Cells beyond the next ring are at least `ring` cells away
+            if best is not None and best_distance < ring * GRID_CELL_DEGREES * 111000 * 0.5:
+                break
+            ring += 1
+        return best, best_distance
+
+    def shortest_path(self, source, target):
+        """
+        A* search minimising duration
+
+        Returns (duration_s, distance_m, coordinates) or None if unreachable.
+        """
+        if source == target:
+            return 0.0, 0.0, [[self.lons[source], self.lats[source]]]
+
+        target_lat, target_lon = self.lats[target], self.lons[target]
+
+        def heuristic(node):
+            return haversine_meters(self.lats[node], self.lons[node], target_lat, target_lon) / self.max_speed_mps
+
+        best = {source: 0.0}
+        previous = {}
+        queue = [(heuristic(source), 0.0, source)]
+        while queue:
+            _, duration, node = heapq.heappop(queue)
+            if node == target:
+                break
+            if duration > best[node]:
+                continue
+            for neighbour, edge_duration, edge_distance, geometry in self.adjacency[node]:
+                candidate = duration + edge_duration
+                if candidate < best.get(neighbour, math.inf):
+                    best[neighbour] = candidate
+                    previous[neighbour] = (node, edge_distance, geometry)
+                    heapq.heappush(queue, (candidate + heuristic(neighbour), candidate, neighbour))
+        else:
+            return None
+
+        distance = 0.0
+        pieces = []
+        node = target
+        while node != source:
+            node, edge_distance, geometry = previous[node]
+            distance += edge_distance
+            pieces.append(geometry)
+
+        coordinates = []
+        for geometry in reversed(pieces):
+            coordinates.extend(geometry[1:] if coordinates else geometry)
+        return best[target], distance, coordinates
+
+
+class RoadGraphRouter(StraightLineRouter):
+    """
+    Route over a RoadGraph, or any graph with the same nearest_node,
+    shortest_path, lats and lons (such as routes.ch_router.CHGraph)
+
+    Waypoints are joined to their nearest graph node by a straight connector.
+    Waypoints further than max_snap_meters from the graph, or node pairs with
+    no path, are routed in a straight line when fallback is enabled.
+    """
+
+    def __init__(self, graph, fallback=True, max_snap_meters=100000,
+                 detour_factor=DEFAULT_DETOUR_FACTOR, speed_kph=DEFAULT_SPEED_KPH):
+        super().__init__(detour_factor, speed_kph)
+        self.graph = graph
+        self.fallback = fallback
+        self.max_snap_meters = max_snap_meters
+
+    def snap(self, point):
+        node, distance = self.graph.nearest_node(*point)
+        if node is None or distance > self.max_snap_meters:
+            return point, 0.0
+        return (self.graph.lons[node], self.graph.lats[node]), distance
+
+    def leg(self, start, end):
+        source, source_distance = self.graph.nearest_node(*start)
+        target, target_distance = self.graph.nearest_node(*end)
+        path = None
+        if source is not None and max(source_distance, target_distance) <= self.max_snap_meters:
+            path = self.graph.shortest_path(source, target)
+
+        if path is None:
+            return super().leg(start, end) if self.fallback else None
+
+        duration, distance, coordinates = path
+        # Straight connectors from the waypoints onto the graph
+        for connector_distance in (source_distance, target_distance):
+            distance += connector_distance * self.detour_factor
+            duration += connector_distance * self.detour_factor / self.speed_mps
+        coordinates = [list(start)] + coordinates + [list(end)]
+        return distance, duration, densify(coordinates, GEOMETRY_SPACING_METERS)
@@ -1,8 +1,19 @@
 import requests
 import datetime
+import hashlib
+import json
 from .models import RouteStop, Location
+from .ch_router import load_ch_router
+from .fuel import fuel_rule_set, plan_fuel_stops
+from .geo import geohash_encode, geohash_neighbourhood, haversine_meters
+from .traffic import SegmentClock, traffic_model, traffic_rule_set
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
 from django.utils import timezone
+from trip_planner.db import insert_all
+from trip_planner.instrumentation import span
+from trip_planner.response_cache import bump_versions
 
 # HOS (Hours of Service) regulations
 MAX_DRIVING_HOURS = 11  # Maximum driving hours per day
@@ -14,60 +25,101 @@ AVERAGE_SPEED_MPH = 55  # Average truck speed in miles per hour
 FUELING_INTERVAL_MILES = 1000  # Fueling needed every 1000 miles
 PICKUP_DROPOFF_HOURS = 1  # Hours needed for pickup and dropoff
 
+# Bump whenever route calculation, stop generation or daily log generation
+# changes the plan produced for the same inputs, so stored plan snapshots are
+# not reused across versions
+ROUTE_VERSION = 3
+
+
+def hos_rule_set():
+    """Return the HOS rule constants that shape a generated plan"""
+    return {
+        'max_driving_hours': MAX_DRIVING_HOURS,
+        'max_on_duty_hours': MAX_ON_DUTY_HOURS,
+        'max_cycle_hours': MAX_CYCLE_HOURS,
+        'required_rest_hours': REQUIRED_REST_HOURS,
+        'max_driving_before_break': MAX_DRIVING_BEFORE_BREAK,
+        'fueling_interval_miles': FUELING_INTERVAL_MILES,
+        'pickup_dropoff_hours': PICKUP_DROPOFF_HOURS,
+    }
+
+
+def planning_inputs_hash(trip, departure_time):
+    """
+    Content hash of every input that determines a trip plan
+    
+    Two calls with the same hash produce the same route, stops and daily logs
+    (given the same routing backend), so the hash is used to key stored plan
+    snapshots.
+    
+    Args:
+        trip: Trip model instance
+        departure_time: Aware datetime the plan starts from
+    
+    Returns:
+        Hex SHA-256 digest of the planning inputs
+    """
+    locations = [
+        [location.id, location.name, location.latitude, location.longitude]
+        for location in (trip.current_location, trip.pickup_location, trip.dropoff_location)
+    ]
+    payload = {
+        'locations': locations,
+        'current_cycle_hours': trip.current_cycle_hours,
+        'client_timezone': trip.client_timezone,
+        'departure_time': departure_time.astimezone(datetime.timezone.utc).isoformat(),
+        'rules': hos_rule_set(),
+        'fuel': fuel_rule_set(trip),
+        'traffic': traffic_rule_set(),
+        'route_version': ROUTE_VERSION,
+        'routing_backend': settings.ROUTING_BACKEND,
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
 def calculate_route(current_location, pickup_location, dropoff_location, current_cycle_hours):
     """
     Calculate the route using a free map API
     
     This function uses OpenStreetMap's Nominatim API for geocoding
-    and OSRM (Open Source Routing Machine) for route planning
+    and OSRM (Open Source Routing Machine) for route planning, or the
+    in-process routing engine selected by settings.ROUTING_BACKEND
     """
     # Create a route object with sections:
     # 1. Current location to pickup
     # 2. Pickup to dropoff
     
-    # For OSRM API
-    base_url = "http://router.project-osrm.org/route/v1/driving/"
-    
     # Current to pickup
-    current_to_pickup_url = f"{base_url}{current_location.longitude},{current_location.latitude};"
-    current_to_pickup_url += f"{pickup_location.longitude},{pickup_location.latitude}?overview=full&geometries=geojson"
-    
-    # Make API request
-    response = requests.get(current_to_pickup_url)
-    current_to_pickup_data = response.json()
+    current_to_pickup_route = fetch_route(current_location, pickup_location)
     
     # Extract the detailed route geometry coordinates
-    current_to_pickup_coordinates = current_to_pickup_data['routes'][0]['geometry']['coordinates']
+    current_to_pickup_coordinates = current_to_pickup_route['geometry']['coordinates']
     
     # Pickup to dropoff
-    pickup_to_dropoff_url = f"{base_url}{pickup_location.longitude},{pickup_location.latitude};"
-    pickup_to_dropoff_url += f"{dropoff_location.longitude},{dropoff_location.latitude}?overview=full&geometries=geojson"
-    
-    # Make API request
-    response = requests.get(pickup_to_dropoff_url)
-    pickup_to_dropoff_data = response.json()
+    pickup_to_dropoff_route = fetch_route(pickup_location, dropoff_location)
     
     # Extract the detailed route geometry coordinates
-    pickup_to_dropoff_coordinates = pickup_to_dropoff_data['routes'][0]['geometry']['coordinates']
+    pickup_to_dropoff_coordinates = pickup_to_dropoff_route['geometry']['coordinates']
     
     # Calculate distance and time
     total_distance_meters = (
-        current_to_pickup_data['routes'][0]['distance'] + 
-        pickup_to_dropoff_data['routes'][0]['distance']
+        current_to_pickup_route['distance'] + 
+        pickup_to_dropoff_route['distance']
     )
     total_distance_miles = total_distance_meters / 1609.34
     
     total_duration_seconds = (
-        current_to_pickup_data['routes'][0]['duration'] + 
-        pickup_to_dropoff_data['routes'][0]['duration']
+        current_to_pickup_route['duration'] + 
+        pickup_to_dropoff_route['duration']
     )
     # Convert to hours and add pickup/dropoff time
     total_duration_hours = (total_duration_seconds / 3600) + (2 * PICKUP_DROPOFF_HOURS)
     
     # Combine route geometries
     combined_geometry = {
-        'section1': current_to_pickup_data['routes'][0]['geometry'],
-        'section2': pickup_to_dropoff_data['routes'][0]['geometry']
+        'section1': current_to_pickup_route['geometry'],
+        'section2': pickup_to_dropoff_route['geometry']
     }
     
     return {
@@ -79,23 +131,96 @@ def calculate_route(current_location, pickup_location, dropoff_location, current
             'pickup_to_dropoff': pickup_to_dropoff_coordinates
         },
         'current_to_pickup': {
-            'distance_miles': current_to_pickup_data['routes'][0]['distance'] / 1609.34,
-            'duration_hours': current_to_pickup_data['routes'][0]['duration'] / 3600
+            'distance_miles': current_to_pickup_route['distance'] / 1609.34,
+            'duration_hours': current_to_pickup_route['duration'] / 3600
         },
         'pickup_to_dropoff': {
-            'distance_miles': pickup_to_dropoff_data['routes'][0]['distance'] / 1609.34,
-            'duration_hours': pickup_to_dropoff_data['routes'][0]['duration'] / 3600
+            'distance_miles': pickup_to_dropoff_route['distance'] / 1609.34,
+            'duration_hours': pickup_to_dropoff_route['duration'] / 3600
         }
     }
 
-def generate_stops(trip, route_data):
-    """Generate all necessary stops based on HOS regulations"""
-    # Clear existing stops
-    trip.stops.all().delete()
+def fetch_route(start_location, end_location):
+    """
+    Route between two locations with the configured routing backend
+    
+    Returns an OSRM route object: 'distance' in meters, 'duration' in seconds
+    and a GeoJSON LineString 'geometry'.
+    """
+    if settings.ROUTING_BACKEND == 'ch':
+        if not settings.ROUTING_GRAPH_PATH:
+            raise ImproperlyConfigured("ROUTING_GRAPH_PATH must be set to use the 'ch' routing backend")
+        router = load_ch_router(settings.ROUTING_GRAPH_PATH)
+        with span('routing'):
+            route = router.route([
+                (start_location.longitude, start_location.latitude),
+                (end_location.longitude, end_location.latitude)
+            ])
+        return {
+            'distance': route['distance'],
+            'duration': route['duration'],
+            'geometry': {'type': 'LineString', 'coordinates': route['coordinates']}
+        }
+    
+    # For OSRM API
+    base_url = f"{settings.OSRM_BASE_URL.rstrip('/')}/route/v1/driving/"
+    url = f"{base_url}{start_location.longitude},{start_location.latitude};"
+    url += f"{end_location.longitude},{end_location.latitude}?overview=full&geometries=geojson"
+    
+    # Make API request
+    with span('routing'):
+        response = requests.get(url)
+        data = response.json()
+    
+    return data['routes'][0]
+
+def generate_stops(trip, route_data, departure_time=None, fuel_plan=None, traffic=None):
+    """
+    Generate all necessary stops based on HOS regulations and save them,
+    replacing the trip's existing stops
+    
+    The plan starts at departure_time (an aware datetime). When omitted the
+    current time is used, which makes the result depend on the wall clock.
+    Fuel stops follow fuel_plan (see plan_fuel_stops), and driving times
+    follow the traffic profiles along the route (see traffic_model); both are
+    computed when not given.
+    """
+    if departure_time is None:
+        departure_time = timezone.now()
+    if fuel_plan is None:
+        with span('fuel_plan'):
+            fuel_plan = plan_fuel_stops(trip, route_data)
+    if traffic is None:
+        with span('traffic'):
+            traffic = traffic_model(route_data)
+    
+    with span('scheduling'):
+        stops = schedule_stops(trip, route_data, departure_time, fuel_plan, traffic)
+    
+    with span('locations'):
+        resolve_stop_locations(stops)
+    
+    with span('persist_stops'):
+        # Clear existing stops
+        trip.stops.all().delete()
+        save_stops(stops)
     
-    # Start with current time
-    current_time = datetime.datetime.now()
-    current_time = timezone.make_aware(current_time)
+    return stops
+
+def schedule_stops(trip, route_data, departure_time, fuel_plan=None, traffic=None):
+    """
+    Plan the stops of a trip without touching the database
+    
+    Returns unsaved RouteStop objects. Stops between the trip's own locations
+    point at unsaved Location objects until resolve_stop_locations is called.
+    Without a fuel_plan, the truck refuels every FUELING_INTERVAL_MILES;
+    without a traffic model, driving times are the routed durations.
+    """
+    # Start with the requested departure time
+    current_time = departure_time
+    
+    # Unsaved waypoint locations, shared by stops at the same coordinates
+    waypoints = {}
     
     # Track driver hours
     driving_hours_today = 0
@@ -105,6 +230,8 @@ def generate_stops(trip, route_data):
     # Track position (miles from start)
     current_position = 0
     last_fuel_position = 0
+    # Planned fuel stops not yet reached
+    fuel_stops = list(fuel_plan['stops']) if fuel_plan else None
     
     stops = []
     
@@ -115,9 +242,9 @@ def generate_stops(trip, route_data):
         arrival_time=current_time,
         departure_time=current_time + datetime.timedelta(minutes=15),
         stop_type='rest',
-        notes="Trip start"
+        notes="Trip start",
+        position_miles=current_position
     )
-    start_stop.save()
     stops.append(start_stop)
     
     current_time += datetime.timedelta(minutes=15)  # 15 min preparation
@@ -141,7 +268,10 @@ def generate_stops(trip, route_data):
         cycle_hours_used,
         current_position,
         last_fuel_position,
-        coordinates_section1
+        coordinates_section1,
+        waypoints,
+        fuel_stops,
+        traffic
     )
     
     current_time = segment_result['current_time']
@@ -158,9 +288,9 @@ def generate_stops(trip, route_data):
         arrival_time=current_time,
         departure_time=current_time + datetime.timedelta(hours=PICKUP_DROPOFF_HOURS),
         stop_type='pickup',
-        notes="Cargo pickup"
+        notes="Cargo pickup",
+        position_miles=current_position
     )
-    pickup_stop.save()
     stops.append(pickup_stop)
     
     current_time += datetime.timedelta(hours=PICKUP_DROPOFF_HOURS)
@@ -176,9 +306,9 @@ def generate_stops(trip, route_data):
             arrival_time=current_time,
             departure_time=current_time + datetime.timedelta(hours=REQUIRED_REST_HOURS),
             stop_type='sleep',
-            notes="Required 10-hour rest period"
+            notes="Required 10-hour rest period",
+            position_miles=current_position
         )
-        rest_stop.save()
         stops.append(rest_stop)
         
         current_time += datetime.timedelta(hours=REQUIRED_REST_HOURS)
@@ -204,7 +334,10 @@ def generate_stops(trip, route_data):
         cycle_hours_used,
         current_position,
         last_fuel_position,
-        coordinates_section2
+        coordinates_section2,
+        waypoints,
+        fuel_stops,
+        traffic
     )
     
     current_time = segment_result['current_time']
@@ -216,9 +349,9 @@ def generate_stops(trip, route_data):
         arrival_time=current_time,
         departure_time=current_time + datetime.timedelta(hours=PICKUP_DROPOFF_HOURS),
         stop_type='dropoff',
-        notes="Cargo dropoff"
+        notes="Cargo dropoff",
+        position_miles=segment_result['current_position']
     )
-    dropoff_stop.save()
     stops.append(dropoff_stop)
     
     return stops
@@ -226,10 +359,22 @@ def generate_stops(trip, route_data):
 def process_segment_iteratively(trip, stops, start_location, end_location, 
                                current_time, total_distance, total_duration, 
                                driving_hours_today, on_duty_hours_today, cycle_hours_used, 
-                               current_position, last_fuel_position, coordinates):
+                               current_position, last_fuel_position, coordinates, waypoints=None,
+                               fuel_stops=None, traffic=None):
     """
     Process a driving segment iteratively (not recursively) with potential breaks
+    
+    Stops are appended to `stops` unsaved; `waypoints` memoizes the unsaved
+    locations created along the way (see waypoint_at_position). Planned fuel
+    stops in the segment are taken off the front of `fuel_stops`; when it is
+    None the truck refuels every FUELING_INTERVAL_MILES instead. Driving
+    times come from the traffic model's clock for the segment, at the time
+    each stretch is driven.
     """
+    if waypoints is None:
+        waypoints = {}
+    clock = SegmentClock(traffic, current_position, total_distance, total_duration)
+    
     # Initialize variables for tracking progress
     distance_covered = 0
     time_spent = 0
@@ -239,23 +384,73 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
     while distance_covered < total_distance:
         # Calculate remaining portions
         remaining_distance = total_distance - distance_covered
-        remaining_duration = (remaining_distance / total_distance) * total_duration
+        remaining_duration = clock.hours(distance_covered, remaining_distance, current_time)
         
         # Check for driver hours limits
         remaining_driving_hours = min(MAX_DRIVING_HOURS - driving_hours_today, MAX_ON_DUTY_HOURS - on_duty_hours_today)
         
         # Need a break?
         
-        last_rest_stop = RouteStop.objects.filter(trip=trip, stop_type__in=["rest", "fuel"]).order_by('-pk').first()
+        last_rest_stop = next((stop for stop in reversed(stops) if stop.stop_type in ('rest', 'fuel')), None)
         last_rest_location = getattr(last_rest_stop, 'location', None)
-        if driving_hours_today > 0 and driving_hours_today + remaining_duration > MAX_DRIVING_BEFORE_BREAK and current_location != last_rest_location:
+        needs_break = (
+            driving_hours_today > 0
+            and driving_hours_today + remaining_duration > MAX_DRIVING_BEFORE_BREAK
+            and current_location != last_rest_location
+        )
+        
+        # Planned fuel stop before the next break or overnight stop?
+        if fuel_stops and fuel_stops[0]['position_miles'] - current_position <= remaining_distance:
+            fuel_miles = max(0, fuel_stops[0]['position_miles'] - current_position)
+            fuel_driving_time = clock.hours(distance_covered, fuel_miles, current_time)
+            if needs_break:
+                next_stop_hours = MAX_DRIVING_BEFORE_BREAK - driving_hours_today
+            else:
+                next_stop_hours = min(remaining_duration, remaining_driving_hours)
+            
+            if fuel_driving_time <= next_stop_hours:
+                fuel = fuel_stops.pop(0)
+                fuel_ratio = (distance_covered + fuel_miles) / total_distance
+                fuel_location = fuel_stop_location(fuel, start_location, end_location, fuel_ratio, coordinates, waypoints)
+                
+                distance_covered += fuel_miles
+                current_position += fuel_miles
+                time_spent += fuel_driving_time
+                
+                fuel_stop_time = current_time + datetime.timedelta(hours=fuel_driving_time)
+                if fuel['station'] is not None:
+                    notes = (f"Refueling at {fuel['station']['name']}: "
+                             f"{fuel['gallons']:.1f} gal at ${fuel['price_per_gallon']:.3f}/gal")
+                else:
+                    notes = f"Scheduled refueling: {fuel['gallons']:.1f} gal"
+                fuel_stop = RouteStop(
+                    trip=trip,
+                    location=fuel_location,
+                    arrival_time=fuel_stop_time,
+                    departure_time=fuel_stop_time + datetime.timedelta(hours=0.75),  # 45 minutes for fueling
+                    stop_type='fuel',
+                    notes=notes,
+                    position_miles=current_position
+                )
+                stops.append(fuel_stop)
+                
+                current_time = fuel_stop_time + datetime.timedelta(hours=0.75)
+                driving_hours_today += fuel_driving_time
+                on_duty_hours_today += fuel_driving_time + 0.75
+                cycle_hours_used += fuel_driving_time + 0.75
+                current_location = fuel_location
+                last_fuel_position = current_position
+                
+                continue
+        
+        if needs_break:
             # Calculate when the break is needed
             break_point = MAX_DRIVING_BEFORE_BREAK - driving_hours_today
-            break_distance = (break_point / remaining_duration) * remaining_distance
+            break_distance = clock.miles(distance_covered, break_point, current_time)
             
             # Find exact break location using coordinates
             break_ratio = (distance_covered + break_distance) / total_distance
-            break_location = get_location_at_position(start_location, end_location, break_ratio, coordinates)
+            break_location = waypoint_at_position(start_location, end_location, break_ratio, coordinates, waypoints)
             
             # Update progress
             distance_covered += break_distance
@@ -270,9 +465,9 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
                 arrival_time=break_stop_time,
                 departure_time=break_stop_time + datetime.timedelta(hours=0.5),  # 30-minute break
                 stop_type='rest',
-                notes="Required 30-minute break"
+                notes="Required 30-minute break",
+                position_miles=current_position
             )
-            break_stop.save()
             stops.append(break_stop)
             
             
@@ -287,16 +482,16 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
             continue
         
         # Need fueling?
-        if current_position - last_fuel_position >= FUELING_INTERVAL_MILES - 100:  # 100 mile buffer
+        if fuel_stops is None and current_position - last_fuel_position >= FUELING_INTERVAL_MILES - 100:  # 100 mile buffer
             # Add fuel after a bit more driving
             fuel_miles = min(100, remaining_distance)  # Don't go past the destination
             
             # Find exact fuel location using coordinates
             fuel_ratio = (distance_covered + fuel_miles) / total_distance
-            fuel_location = get_location_at_position(start_location, end_location, fuel_ratio, coordinates)
+            fuel_location = waypoint_at_position(start_location, end_location, fuel_ratio, coordinates, waypoints)
             
             # Calculate driving time to fuel location
-            fuel_driving_time = (fuel_miles / remaining_distance) * remaining_duration
+            fuel_driving_time = clock.hours(distance_covered, fuel_miles, current_time)
             
             # Update progress
             distance_covered += fuel_miles
@@ -311,9 +506,9 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
                 arrival_time=fuel_stop_time,
                 departure_time=fuel_stop_time + datetime.timedelta(hours=0.75),  # 45 minutes for fueling
                 stop_type='fuel',
-                notes="Scheduled refueling"
+                notes="Scheduled refueling",
+                position_miles=current_position
             )
-            fuel_stop.save()
             stops.append(fuel_stop)
             
             # Update time and hours
@@ -330,11 +525,11 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
         if remaining_duration > remaining_driving_hours:
             # Calculate how far we can go today
             drivable_hours = remaining_driving_hours
-            drivable_distance = (drivable_hours / remaining_duration) * remaining_distance
+            drivable_distance = clock.miles(distance_covered, drivable_hours, current_time)
             
             # Find exact overnight location using coordinates
             overnight_ratio = (distance_covered + drivable_distance) / total_distance
-            overnight_location = get_location_at_position(start_location, end_location, overnight_ratio, coordinates)
+            overnight_location = waypoint_at_position(start_location, end_location, overnight_ratio, coordinates, waypoints)
             
             # Update progress
             distance_covered += drivable_distance
@@ -349,9 +544,9 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
                 arrival_time=overnight_arrival,
                 departure_time=overnight_arrival + datetime.timedelta(hours=REQUIRED_REST_HOURS),
                 stop_type='sleep',
-                notes="Required 10-hour rest period"
+                notes="Required 10-hour rest period",
+                position_miles=current_position
             )
-            overnight_stop.save()
             stops.append(overnight_stop)
             
             # Update time and reset hours for new day
@@ -383,18 +578,22 @@ def process_segment_iteratively(trip, stops, start_location, end_location,
         'last_fuel_position': last_fuel_position
     }
 
-def get_location_at_position(start_location, end_location, ratio, coordinates):
+def waypoint_at_position(start_location, end_location, ratio, coordinates, waypoints=None):
     """
-    Get an exact location that's a certain ratio along the route using the actual route coordinates
+    Get the location that's a certain ratio along the route using the actual
+    route coordinates, without touching the database
     
     Args:
         start_location: Starting location object
         end_location: Ending location object
         ratio: Position ratio along the route (0.0 to 1.0)
         coordinates: List of [lon, lat] coordinates from the routing API
+        waypoints: Optional dict memoizing unsaved locations by coordinates, so
+            stops at the same point share (and compare equal on) one object
     
     Returns:
-        Location object at the specified position
+        start_location or end_location at the ends of the route, otherwise
+        an unsaved Location object at the specified position
     """
     # Check if we're at the start or end
     if ratio <= 0:
@@ -408,14 +607,119 @@ def get_location_at_position(start_location, end_location, ratio, coordinates):
     
     # Get the coordinates
     lon, lat = coordinates[point_index]
+    key = (round(lat, 6), round(lon, 6))
     
-    # Create or find a location object
-    location_name = f"Stop at {ratio:.0%} between {start_location.name} and {end_location.name}"
+    if waypoints is not None and key in waypoints:
+        return waypoints[key]
     
-    location, created = Location.objects.get_or_create(
-        latitude=round(lat, 6),
-        longitude=round(lon, 6),
-        defaults={'name': location_name}
+    location = Location(
+        name=f"Stop at {ratio:.0%} between {start_location.name} and {end_location.name}",
+        latitude=key[0],
+        longitude=key[1],
+        is_waypoint=True
     )
+    if waypoints is not None:
+        waypoints[key] = location
+    return location
+
+def fuel_stop_location(fuel_stop, start_location, end_location, ratio, coordinates, waypoints=None):
+    """
+    Unsaved location of a planned fuel stop: the station's, or the route
+    position for a stop without a station (see waypoint_at_position)
+    """
+    station = fuel_stop['station']
+    if station is None:
+        return waypoint_at_position(start_location, end_location, ratio, coordinates, waypoints)
+    
+    key = (round(station['latitude'], 6), round(station['longitude'], 6))
+    if waypoints is not None and key in waypoints:
+        return waypoints[key]
+    location = Location(name=station['name'], latitude=key[0], longitude=key[1], is_waypoint=True)
+    if waypoints is not None:
+        waypoints[key] = location
+    return location
+
+def get_location_at_position(start_location, end_location, ratio, coordinates):
+    """
+    Get an exact location that's a certain ratio along the route using the actual route coordinates
+    
+    Args:
+        start_location: Starting location object
+        end_location: Ending location object
+        ratio: Position ratio along the route (0.0 to 1.0)
+        coordinates: List of [lon, lat] coordinates from the routing API
+    
+    Returns:
+        Location object at the specified position
+    """
+    location = waypoint_at_position(start_location, end_location, ratio, coordinates)
+    if location.pk is None:
+        location = snap_waypoints([location])[0]
+    return location
+
+def snap_waypoints(waypoints, radius_meters=None):
+    """
+    Return a saved location for each unsaved waypoint location
     
-    return location
\ No newline at end of file
+    A waypoint is replaced by the nearest existing waypoint location within
+    radius_meters (settings.STOP_DEDUP_RADIUS_METERS by default). Candidates
+    for all waypoints are fetched in one query over the geohash cells around
+    them, and the waypoints left unmatched are inserted together. Unmatched
+    waypoints also absorb later ones within the radius.
+    """
+    if radius_meters is None:
+        radius_meters = settings.STOP_DEDUP_RADIUS_METERS
+    if not waypoints:
+        return []
+    
+    cells = set()
+    for waypoint in waypoints:
+        cells |= geohash_neighbourhood(waypoint.latitude, waypoint.longitude, radius_meters)
+    in_cells = Q()
+    for prefix in cells:
+        in_cells |= Q(geohash__startswith=prefix)
+    # Oldest first, so ties resolve to the location that has been reused longest
+    candidates = list(Location.objects.filter(in_cells, is_waypoint=True).order_by('id'))
+    
+    resolved = []
+    new_locations = []
+    for waypoint in waypoints:
+        location = _nearest_location(waypoint.latitude, waypoint.longitude, candidates, radius_meters)
+        if location is None:
+            location = waypoint
+            location.is_waypoint = True
+            location.geohash = geohash_encode(location.latitude, location.longitude)
+            new_locations.append(location)
+            candidates.append(location)
+        resolved.append(location)
+    
+    insert_all(new_locations)
+    return resolved
+
+def _nearest_location(lat, lon, candidates, radius_meters):
+    best, best_distance = None, None
+    for location in candidates:
+        distance = haversine_meters(lat, lon, location.latitude, location.longitude)
+        if distance <= radius_meters and (best is None or distance < best_distance):
+            best, best_distance = location, distance
+    return best
+
+def resolve_stop_locations(stops):
+    """Replace the unsaved waypoint locations of scheduled stops with saved ones"""
+    waypoints = {}
+    for stop in stops:
+        if stop.location.pk is None:
+            waypoints.setdefault(id(stop.location), stop.location)
+    
+    resolved = dict(zip(waypoints, snap_waypoints(list(waypoints.values()))))
+    for stop in stops:
+        if id(stop.location) in resolved:
+            # Reassign even when unchanged so location_id picks up the new key
+            stop.location = resolved[id(stop.location)]
+
+def save_stops(stops):
+    """Insert scheduled stops in one query where the database allows it"""
+    insert_all(stops)
+    # Bulk inserts send no signals
+    bump_versions('trip', {stop.trip_id for stop in stops})
+
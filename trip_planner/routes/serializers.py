@@ -1,10 +1,62 @@
+import datetime
+import zoneinfo
+
 from rest_framework import serializers
 from .models import Location, Trip, RouteStop
+from .departures import DEFAULT_STEP_MINUTES, DEFAULT_WINDOW_HOURS, MAX_CANDIDATES
+from .fuel import MIN_FUEL_RANGE_MILES, fuel_range_miles
 
 class LocationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Location
-        fields = ['id', 'name', 'latitude', 'longitude', 'address']
+        fields = ['id', 'name', 'latitude', 'longitude', 'address', 'is_waypoint']
+        read_only_fields = ['is_waypoint']
+
+class NearbyLocationSerializer(LocationSerializer):
+    # Meters from the search point, when there is one
+    distance = serializers.FloatField(read_only=True)
+    
+    class Meta(LocationSerializer.Meta):
+        fields = LocationSerializer.Meta.fields + ['distance']
+
+def utc_isoformat(value):
+    """A datetime as DRF's DateTimeField renders it: ISO 8601 in UTC, with a Z"""
+    if value is None:
+        return None
+    value = value.astimezone(datetime.timezone.utc).isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+def location_dict(location):
+    """LocationSerializer's output for a location, built directly"""
+    return {
+        'id': location.id,
+        'name': location.name,
+        'latitude': float(location.latitude),
+        'longitude': float(location.longitude),
+        'address': location.address,
+        'is_waypoint': location.is_waypoint,
+    }
+
+def route_stop_dicts(stops):
+    """
+    RouteStopSerializer(stops, many=True).data, built directly from stops
+    already in memory (e.g. planner output): plans have hundreds of stops,
+    and per-field serializer calls dominate the cost of rendering them
+    """
+    return [
+        {
+            'id': stop.id,
+            'location': stop.location_id,
+            'location_details': location_dict(stop.location),
+            'arrival_time': utc_isoformat(stop.arrival_time),
+            'departure_time': utc_isoformat(stop.departure_time),
+            'stop_type': stop.stop_type,
+            'notes': stop.notes,
+            # Positions are ints at the trip start, as the planner counts them
+            'position_miles': float(stop.position_miles) if stop.position_miles is not None else None,
+        }
+        for stop in stops
+    ]
 
 class RouteStopSerializer(serializers.ModelSerializer):
     location_details = LocationSerializer(source='location', read_only=True)
@@ -12,7 +64,7 @@ class RouteStopSerializer(serializers.ModelSerializer):
     class Meta:
         model = RouteStop
         fields = ['id', 'location', 'location_details', 'arrival_time', 'departure_time', 
-                  'stop_type', 'notes']
+                  'stop_type', 'notes', 'position_miles']
 
 class TripSerializer(serializers.ModelSerializer):
     stops = RouteStopSerializer(many=True, read_only=True)
@@ -26,5 +78,132 @@ class TripSerializer(serializers.ModelSerializer):
                   'pickup_location', 'pickup_location_details',
                   'dropoff_location', 'dropoff_location_details',
                   'current_cycle_hours', 'created_at', 'updated_at',
-                  'status', 'stops', 'client_timezone']
+                  'status', 'stops', 'client_timezone', 'tank_capacity_gallons', 'mpg']
         read_only_fields = ['created_at', 'updated_at']
+        extra_kwargs = {
+            'tank_capacity_gallons': {'min_value': 0},
+            'mpg': {'min_value': 0},
+        }
+    
+    def validate(self, data):
+        tank = data.get('tank_capacity_gallons', getattr(self.instance, 'tank_capacity_gallons', None))
+        mpg = data.get('mpg', getattr(self.instance, 'mpg', None))
+        if (tank is None) != (mpg is None):
+            raise serializers.ValidationError("tank_capacity_gallons and mpg must be given together")
+        if tank is not None and fuel_range_miles(tank, mpg) < MIN_FUEL_RANGE_MILES:
+            raise serializers.ValidationError(
+                f"The tank must last at least {MIN_FUEL_RANGE_MILES} miles above the fuel reserve"
+            )
+        return data
+    
+    def validate_client_timezone(self, value):
+        # Daily logs are split at midnight in this zone
+        try:
+            zoneinfo.ZoneInfo(value)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            raise serializers.ValidationError(f"Unknown timezone {value!r}")
+        return value
+
+
+class PlanRequestSerializer(serializers.Serializer):
+    """Query parameters accepted when calculating a trip plan"""
+    # Naive values are interpreted as UTC; defaults to the current minute
+    departure_time = serializers.DateTimeField(required=False)
+
+
+class PlanDeltaSerializer(serializers.Serializer):
+    """Query parameters of a plan delta request"""
+    since = serializers.IntegerField(min_value=1, help_text="Plan version the client has")
+    # Defaults to the latest version
+    version = serializers.IntegerField(min_value=1, required=False)
+
+class DepartureSearchSerializer(serializers.Serializer):
+    """Query parameters of a departure time search"""
+    # Naive values are interpreted as UTC; defaults to the current minute
+    start = serializers.DateTimeField(required=False)
+    window_hours = serializers.FloatField(default=DEFAULT_WINDOW_HOURS, min_value=0, max_value=7 * 24)
+    step_minutes = serializers.IntegerField(default=DEFAULT_STEP_MINUTES, min_value=1, max_value=24 * 60)
+    
+    def validate(self, data):
+        if data['window_hours'] * 60 // data['step_minutes'] + 1 > MAX_CANDIDATES:
+            raise serializers.ValidationError(
+                f"At most {MAX_CANDIDATES} departure times can be compared; use a larger step_minutes"
+            )
+        return data
+
+
+class LocationSearchSerializer(serializers.Serializer):
+    """Query parameters of a radius or bounding-box location search"""
+    MAX_RADIUS_METERS = 500000
+    
+    lat = serializers.FloatField(required=False, min_value=-90, max_value=90)
+    lon = serializers.FloatField(required=False, min_value=-180, max_value=180)
+    radius = serializers.FloatField(required=False, min_value=0, max_value=MAX_RADIUS_METERS,
+                                    help_text="Meters around lat/lon")
+    # min_lon,min_lat,max_lon,max_lat; min_lon > max_lon crosses the antimeridian
+    bbox = serializers.CharField(required=False)
+    include_waypoints = serializers.BooleanField(default=False)
+    
+    def validate_bbox(self, value):
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+        except ValueError:
+            raise serializers.ValidationError("Expected min_lon,min_lat,max_lon,max_lat")
+        if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+            raise serializers.ValidationError("Coordinates are out of range")
+        return min_lat, min_lon, max_lat, max_lon
+    
+    def validate(self, data):
+        has_point = 'lat' in data and 'lon' in data
+        if ('lat' in data) != ('lon' in data):
+            raise serializers.ValidationError("lat and lon must be given together")
+        if 'radius' in data and not has_point:
+            raise serializers.ValidationError("radius requires lat and lon")
+        if 'radius' not in data and 'bbox' not in data:
+            raise serializers.ValidationError("Give lat, lon and radius, or bbox")
+        return data
+
+
+class AnalyticsQuerySerializer(serializers.Serializer):
+    """Query parameters of an analytics report"""
+    GROUPS = ('driver', 'lane', 'week')
+    
+    # Weeks run from Monday in the trips' timezones; a start mid-week
+    # includes its whole week
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    driver = serializers.IntegerField(required=False)
+    pickup_location = serializers.IntegerField(required=False)
+    dropoff_location = serializers.IntegerField(required=False)
+    # Comma-separated; empty for totals over all matching trips
+    group_by = serializers.CharField(required=False, allow_blank=True, default='week')
+    
+    def validate_start(self, value):
+        return value - datetime.timedelta(days=value.weekday())
+    
+    def validate_group_by(self, value):
+        groups = [group.strip() for group in value.split(',') if group.strip()]
+        unknown = set(groups) - set(self.GROUPS)
+        if unknown:
+            raise serializers.ValidationError(f"Unknown groups {', '.join(sorted(unknown))}; use {', '.join(self.GROUPS)}")
+        return list(dict.fromkeys(groups))
+    
+    def validate(self, data):
+        if 'start' in data and 'end' in data and data['start'] > data['end']:
+            raise serializers.ValidationError("start must not be after end")
+        return data
+
+
+class TripPingSerializer(serializers.Serializer):
+    """One GPS/ELD position report"""
+    trip = serializers.IntegerField()
+    latitude = serializers.FloatField(min_value=-90, max_value=90)
+    longitude = serializers.FloatField(min_value=-180, max_value=180)
+    # Naive values are interpreted as UTC
+    timestamp = serializers.DateTimeField()
+
+
+class TripPingBatchSerializer(serializers.Serializer):
+    MAX_PINGS = 5000
+    
+    pings = TripPingSerializer(many=True, allow_empty=False, max_length=MAX_PINGS)
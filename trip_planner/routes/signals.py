@@ -0,0 +1,43 @@
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from trip_planner.response_cache import bump_versions
+from .analytics import rekey_trip_rollup, remove_trip_rollup
+from .models import Location, RouteStop, Trip
+
+
+@receiver([post_save, post_delete], sender=Trip)
+def trip_changed(sender, instance, **kwargs):
+    bump_versions('trip', [instance.pk])
+
+
+@receiver(post_save, sender=Trip)
+def trip_saved(sender, instance, created, **kwargs):
+    # A new driver, lane or timezone moves the trip's totals to another weekly rollup
+    if not created:
+        rekey_trip_rollup(instance)
+
+
+@receiver(pre_delete, sender=Trip)
+def trip_deleting(sender, instance, **kwargs):
+    remove_trip_rollup(instance)
+
+
+@receiver(post_save, sender=RouteStop)
+def stop_changed(sender, instance, **kwargs):
+    # Trip responses nest their stops. Deletes bump the trip where they are
+    # made: a delete receiver would keep Django from deleting stops in bulk
+    bump_versions('trip', [instance.trip_id])
+
+
+@receiver(post_save, sender=Location)
+def location_changed(sender, instance, created, **kwargs):
+    # ... and the details of their locations and their stops' locations
+    if created:
+        return
+    trip_ids = Trip.objects.filter(
+        Q(current_location=instance) | Q(pickup_location=instance) | Q(dropoff_location=instance)
+    ).values_list('id', flat=True)
+    stop_trip_ids = RouteStop.objects.filter(location=instance).values_list('trip_id', flat=True)
+    bump_versions('trip', set(trip_ids) | set(stop_trip_ids))
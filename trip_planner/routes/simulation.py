@@ -0,0 +1,204 @@
+"""
+Offline HOS simulation of many trips
+
+Each trip is planned as calculate_route and schedule_stops plan it for the
+API, but on unsaved Trip and Location objects, so nothing is written to the
+database. Trips are simulated in batches by worker processes (see the
+simulate_trips command); each worker keeps the routes, traffic models and
+fuel plans of the lanes it has seen, since historical loads repeat lanes.
+"""
+import datetime
+import zoneinfo
+from collections import OrderedDict
+
+import django
+from django.db import connections
+from django.utils.dateparse import parse_datetime
+
+from logs.log_generator import duty_intervals, split_days
+
+from .departures import plan_summary
+from .fuel import plan_fuel_stops
+from .models import Location, Trip
+from .route_planning import calculate_route, schedule_stops
+from .serializers import utc_isoformat
+from .traffic import traffic_model
+
+REQUIRED_COLUMNS = (
+    'origin_lat', 'origin_lon', 'pickup_lat', 'pickup_lon', 'dropoff_lat', 'dropoff_lon',
+    'cycle_hours', 'departure',
+)
+# Optional: an id echoed in the results, tank_capacity_gallons and mpg to
+# plan fuel stops by price, and the timezone daily totals are split in
+OPTIONAL_COLUMNS = ('id', 'tank_capacity_gallons', 'mpg', 'timezone')
+# Lanes (routes with their traffic models and fuel plans) kept per worker
+LANE_CACHE_SIZE = 2048
+# Coordinates are rounded to this many decimals (about 10 m) to match lanes
+LANE_PRECISION = 4
+
+DUTY_STATUSES = ('off_duty', 'sleeper', 'driving', 'on_duty')
+
+_lanes = OrderedDict()
+
+
+def init_worker():
+    """Pool initializer: make Django usable in the worker process"""
+    # Spawned workers start without Django set up; forked ones inherit the
+    # parent's database connections, which must not be shared
+    django.setup()
+    connections.close_all()
+
+
+def _number(row, column, low, high):
+    try:
+        value = float(row[column])
+    except (TypeError, ValueError):
+        raise ValueError(f"{column} is not a number")
+    if not low <= value <= high:
+        raise ValueError(f"{column} is out of range")
+    return value
+
+
+def _departure(value):
+    if isinstance(value, str):
+        try:
+            value = parse_datetime(value.strip())
+        except ValueError:
+            value = None
+    if not isinstance(value, datetime.datetime):
+        raise ValueError("departure is not a date and time")
+    # Naive departures are taken as UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def parse_trip(row):
+    """
+    Trip, departure time and timezone of an input row (a dict of column
+    values, strings from CSV or typed values from Parquet); raises
+    ValueError for an invalid row
+    """
+    points = []
+    for prefix in ('origin', 'pickup', 'dropoff'):
+        points.append((
+            _number(row, f'{prefix}_lat', -90, 90),
+            _number(row, f'{prefix}_lon', -180, 180),
+        ))
+    cycle_hours = _number(row, 'cycle_hours', 0, 70)
+    departure = _departure(row.get('departure'))
+
+    tank_capacity_gallons = mpg = None
+    if row.get('tank_capacity_gallons') not in (None, '') and row.get('mpg') not in (None, ''):
+        tank_capacity_gallons = _number(row, 'tank_capacity_gallons', 1, 1000)
+        mpg = _number(row, 'mpg', 1, 100)
+
+    try:
+        timezone = zoneinfo.ZoneInfo(row.get('timezone') or 'UTC')
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError("timezone is unknown")
+
+    current, pickup, dropoff = (
+        Location(name=name, latitude=lat, longitude=lon)
+        for name, (lat, lon) in zip(('Origin', 'Pickup', 'Dropoff'), points)
+    )
+    trip = Trip(
+        current_location=current, pickup_location=pickup, dropoff_location=dropoff,
+        current_cycle_hours=cycle_hours, tank_capacity_gallons=tank_capacity_gallons, mpg=mpg,
+    )
+    return trip, departure, timezone
+
+
+def _cached(key, compute):
+    value = _lanes.get(key)
+    if value is None:
+        value = compute()
+        _lanes[key] = value
+        if len(_lanes) > LANE_CACHE_SIZE:
+            _lanes.popitem(last=False)
+    else:
+        _lanes.move_to_end(key)
+    return value
+
+
+def lane_plan(trip):
+    """Route, fuel plan and traffic model of a trip, reused across trips on the same lane"""
+    lane = tuple(
+        (round(location.latitude, LANE_PRECISION), round(location.longitude, LANE_PRECISION))
+        for location in (trip.current_location, trip.pickup_location, trip.dropoff_location)
+    )
+
+    def route():
+        route_data = calculate_route(trip.current_location, trip.pickup_location, trip.dropoff_location,
+                                     trip.current_cycle_hours)
+        return route_data, traffic_model(route_data)
+
+    route_data, traffic = _cached(('route', lane), route)
+    fuel_plan = None
+    if trip.tank_capacity_gallons and trip.mpg:
+        fuel_plan = _cached(('fuel', lane, trip.tank_capacity_gallons, trip.mpg),
+                            lambda: plan_fuel_stops(trip, route_data))
+    return route_data, fuel_plan, traffic
+
+
+def daily_totals(stops, timezone):
+    """Hours in each duty status per local date, as the trip's daily logs would record them"""
+    totals = []
+    for date, intervals in split_days(duty_intervals(stops), timezone):
+        hours = dict.fromkeys(DUTY_STATUSES, 0.0)
+        for start, end, status, _, _ in intervals:
+            hours[status] += (end - start).total_seconds() / 3600
+        totals.append({'date': date.isoformat(), **{status: round(value, 4) for status, value in hours.items()}})
+    return totals
+
+
+def simulate_trip(row):
+    """Plan one input row (see parse_trip) and summarize its schedule"""
+    trip, departure, timezone = parse_trip(row)
+    route_data, fuel_plan, traffic = lane_plan(trip)
+    stops = schedule_stops(trip, route_data, departure, fuel_plan, traffic)
+
+    summary = plan_summary(departure, stops)
+    result = {
+        'distance_miles': round(route_data['distance_miles'], 2),
+        'departure_time': utc_isoformat(departure),
+        'arrival_time': utc_isoformat(summary['arrival_time']),
+        'trip_hours': round(summary['trip_hours'], 4),
+        'sleep_stops': summary['sleep_stops'],
+        'breaks': summary['breaks'],
+    }
+    if fuel_plan is not None:
+        result['fuel_cost'] = fuel_plan['estimated_cost']
+    result['stops'] = [
+        {
+            'stop_type': stop.stop_type,
+            'arrival_time': utc_isoformat(stop.arrival_time),
+            'departure_time': utc_isoformat(stop.departure_time),
+            'position_miles': round(float(stop.position_miles), 2),
+            'latitude': float(stop.location.latitude),
+            'longitude': float(stop.location.longitude),
+        }
+        for stop in stops
+    ]
+    result['daily_totals'] = daily_totals(stops, timezone)
+    return result
+
+
+def simulate_batch(rows):
+    """
+    Simulate (row number, row) pairs; returns a result per row, in order,
+    with the row number, its id and either the plan or an 'error'
+    """
+    results = []
+    for number, row in rows:
+        result = {'row': number, 'id': row.get('id')}
+        try:
+            result.update(simulate_trip(row))
+        except ValueError as error:
+            result['error'] = str(error)
+        except Exception as error:
+            # Routing failures (an unreachable point, a routing server
+            # error) fail the trip, not the whole run
+            result['error'] = f"{type(error).__name__}: {error}"
+        results.append(result)
+    return results
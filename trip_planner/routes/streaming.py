@@ -0,0 +1,167 @@
+"""
+Server-Sent Events stream of trip progress, served by the ASGI application
+
+Progress events published by ping ingestion in this process are pushed to
+subscribers immediately. Ingestion handled by another worker process can't
+reach them, so idle streams also poll the database every
+STREAM_POLL_SECONDS and send the trip's progress when it has changed.
+
+Streams bypass Django's request handling and middleware, so the handler
+answers CORS itself, from the django-cors-headers settings, and closes
+database connections after each query as the end of a request would.
+"""
+import asyncio
+import json
+import re
+import threading
+
+from asgiref.sync import sync_to_async
+from corsheaders.conf import conf as cors_conf
+from django.db import close_old_connections
+
+from .models import Trip
+from .progress import current_progress_event
+
+STREAM_POLL_SECONDS = 5
+# Progress events supersede each other, so slow clients only get the latest few
+SUBSCRIBER_QUEUE_SIZE = 8
+
+
+class ProgressBroker:
+    """Fan progress events out to the streams subscribed to each trip"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, trip_id):
+        """Return a queue receiving the trip's events; call from the event loop"""
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(trip_id, set()).add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, trip_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(trip_id, set())
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(trip_id, None)
+
+    def publish(self, event):
+        """Deliver an event to its trip's subscribers; safe to call from any thread"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(event['trip'], ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_put_latest, queue, event)
+
+
+def _put_latest(queue, event):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+
+broker = ProgressBroker()
+
+
+def _cors_headers(scope):
+    """CORS response headers for the request's Origin, as CorsMiddleware would send them"""
+    origin = dict(scope['headers']).get(b'origin', b'').decode('latin-1')
+    if not origin:
+        return []
+    allowed = (
+        cors_conf.CORS_ALLOW_ALL_ORIGINS
+        or origin in cors_conf.CORS_ALLOWED_ORIGINS
+        or any(re.match(pattern, origin) for pattern in cors_conf.CORS_ALLOWED_ORIGIN_REGEXES)
+    )
+    if not allowed:
+        return [(b'vary', b'origin')]
+    headers = [(b'vary', b'origin')]
+    if cors_conf.CORS_ALLOW_ALL_ORIGINS and not cors_conf.CORS_ALLOW_CREDENTIALS:
+        headers.append((b'access-control-allow-origin', b'*'))
+    else:
+        headers.append((b'access-control-allow-origin', origin.encode('latin-1')))
+    if cors_conf.CORS_ALLOW_CREDENTIALS:
+        headers.append((b'access-control-allow-credentials', b'true'))
+    return headers
+
+
+def _query(function, *args):
+    """Call a database function and release the connection as a finished request would"""
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+def _trip_exists(trip_id):
+    return Trip.objects.filter(pk=trip_id).exists()
+
+
+def _format_event(event):
+    return f"event: progress\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode('utf-8')
+
+
+async def trip_events(scope, receive, send, trip_id):
+    """ASGI handler streaming a trip's progress events until the client disconnects"""
+    cors_headers = _cors_headers(scope)
+    if scope['method'] != 'GET':
+        await send({'type': 'http.response.start', 'status': 405, 'headers': [(b'allow', b'GET'), *cors_headers]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    if not await sync_to_async(_query)(_trip_exists, trip_id):
+        await send({
+            'type': 'http.response.start',
+            'status': 404,
+            'headers': [(b'content-type', b'application/json'), *cors_headers],
+        })
+        await send({'type': 'http.response.body', 'body': b'{"detail":"Not found."}'})
+        return
+
+    queue = broker.subscribe(trip_id)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                *cors_headers,
+            ],
+        })
+        last_sent = await sync_to_async(_query)(current_progress_event, trip_id)
+        if last_sent is not None:
+            await send({'type': 'http.response.body', 'body': _format_event(last_sent), 'more_body': True})
+
+        while not disconnected.done():
+            next_event = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {next_event, disconnected}, timeout=STREAM_POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected in done:
+                next_event.cancel()
+                break
+
+            if next_event in done:
+                event = next_event.result()
+            else:
+                next_event.cancel()
+                event = await sync_to_async(_query)(current_progress_event, trip_id)
+
+            if event is not None and event != last_sent:
+                body = _format_event(event)
+                last_sent = event
+            else:
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        broker.unsubscribe(trip_id, queue)
+        disconnected.cancel()
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -1,3 +1,399 @@
-from django.test import TestCase
+import datetime
+import functools
+import io
+import math
+import os
+import random
+import tempfile
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.dateparse import parse_datetime
+
+from .benchmark_fixtures import BENCHMARK_TRIPS, recorded_osrm_server
+from .ch_router import CHGraph, build_contraction_hierarchy, write_ch_file
+from .fuel import cheapest_refuelling
+from .models import Location, PlanSnapshot, RouteStop, Trip, TripRollup, WeeklyRollup
+from .plan_delta import diff_plans, list_delta, stop_key
+from .progress import ETA_RESOLUTION_SECONDS, get_trackers
+from .road_graph import RoadGraph
+
+DEPARTURE = datetime.datetime(2025, 1, 6, 8, 0, tzinfo=datetime.timezone.utc)
+HIGHWAYS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'us_highways.json')
+
+
+def exhaustive_refuelling_cost(positions, prices, length, capacity, stop_cost):
+    """
+    Cheapest cost of a trip over every whole-gallon purchase at every stop,
+    or inf when it can't be made; exact when all distances are whole gallons
+    """
+    x = list(positions) + [length]
+
+    @functools.lru_cache(maxsize=None)
+    def cost(stop, fuel):
+        # Fuel left on arriving at candidate `stop`; len(positions) is the destination
+        if stop == len(positions):
+            return 0.0
+        best = math.inf
+        for bought in range(capacity - fuel + 1):
+            left = fuel + bought - (x[stop + 1] - x[stop])
+            if left >= 0:
+                best = min(best, bought * prices[stop] + (stop_cost if bought else 0) + cost(stop + 1, left))
+        return best
+
+    if not positions:
+        return 0.0 if length <= capacity else math.inf
+    if x[0] > capacity:
+        return math.inf
+    return cost(0, capacity - x[0])
+
+
+class CheapestRefuellingTests(SimpleTestCase):
+    def check_plan(self, positions, prices, length, capacity, plan):
+        """Return the cost of a plan after checking the tank never runs dry or overflows"""
+        bought = dict(plan)
+        fuel, at, cost = capacity, 0, 0.0
+        for index, position in enumerate(positions):
+            fuel -= position - at
+            at = position
+            self.assertGreaterEqual(fuel, -1e-9)
+            if index in bought:
+                fuel += bought[index]
+                self.assertLessEqual(fuel, capacity + 1e-9)
+                cost += bought[index] * prices[index]
+        self.assertGreaterEqual(fuel - (length - at), -1e-9)
+        return cost
+
+    def test_matches_exhaustive_search(self):
+        rng = random.Random(35)
+        for _ in range(300):
+            length = rng.randint(2, 30)
+            positions = sorted(rng.sample(range(1, length), rng.randint(0, min(7, length - 1))))
+            prices = [rng.randint(1, 9) for _ in positions]
+            capacity = rng.randint(3, 12)
+            stop_cost = rng.choice([0, 0, 2, 5])
+            case = (positions, prices, length, capacity, stop_cost)
+
+            plan = cheapest_refuelling(positions, prices, length, capacity, stop_cost)
+            expected = exhaustive_refuelling_cost(*case)
+            if math.isinf(expected):
+                self.assertIsNone(plan, case)
+                continue
+            self.assertIsNotNone(plan, case)
+            indexes = [index for index, _ in plan]
+            self.assertEqual(indexes, sorted(set(indexes)), case)
+            cost = self.check_plan(positions, prices, length, capacity, plan) + stop_cost * len(plan)
+            self.assertAlmostEqual(cost, expected, places=6, msg=case)
+
+    def test_no_stops_needed(self):
+        self.assertEqual(cheapest_refuelling([2, 4], [3, 1], 5, 10), [])
+
+    def test_gap_beyond_tank(self):
+        self.assertIsNone(cheapest_refuelling([4, 15], [3, 1], 18, 10))
+
+
+def random_road_graph(rng, nodes):
+    """A connected RoadGraph with one-way and two-way edges of random speeds"""
+    lats = [40 + rng.random() for _ in range(nodes)]
+    lons = [-90 + rng.random() for _ in range(nodes)]
+    edges = []
+
+    def add(u, v, both_ways):
+        distance = math.hypot(lats[u] - lats[v], lons[u] - lons[v]) * 111000 * rng.uniform(1.0, 1.5)
+        duration = distance / rng.uniform(15, 30)
+        geometry = [[lons[u], lats[u]], [lons[v], lats[v]]]
+        edges.append((u, v, duration, distance, geometry))
+        if both_ways:
+            edges.append((v, u, duration, distance, geometry[::-1]))
+
+    for node in range(1, nodes):
+        add(node, rng.randrange(node), True)
+    for _ in range(nodes * 2):
+        u, v = rng.sample(range(nodes), 2)
+        add(u, v, rng.random() < 0.5)
+    return RoadGraph(list(range(nodes)), lats, lons, edges)
+
+
+class ContractionHierarchyTests(SimpleTestCase):
+    def assert_same_routes(self, graph, pairs):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'graph.ch')
+            write_ch_file(build_contraction_hierarchy(graph), path)
+            ch = CHGraph(path)
+            for source, target in pairs:
+                expected = graph.shortest_path(source, target)
+                result = ch.shortest_path(source, target)
+                if expected is None:
+                    self.assertIsNone(result, (source, target))
+                    continue
+                self.assertIsNotNone(result, (source, target))
+                self.assertAlmostEqual(result[0], expected[0], places=3, msg=(source, target))
+                self.assertAlmostEqual(result[1], expected[1], places=3, msg=(source, target))
+                self.assertEqual(result[2], expected[2], (source, target))
+            # Release the memory map before the file is removed
+            del ch
+
+    def test_bundled_graph_matches_a_star(self):
+        graph = RoadGraph.load(HIGHWAYS_PATH)
+        nodes = range(len(graph.node_ids))
+        self.assert_same_routes(graph, [(source, target) for source in nodes for target in nodes])
+
+    def test_random_graphs_match_a_star(self):
+        rng = random.Random(30)
+        for _ in range(5):
+            graph = random_road_graph(rng, 60)
+            self.assert_same_routes(graph, [tuple(rng.sample(range(60), 2)) for _ in range(200)])
+
+
+class PlanDeltaTests(SimpleTestCase):
+    def stop(self, stop_id, stop_type, position, arrival='08:00'):
+        return {'id': stop_id, 'stop_type': stop_type, 'position_miles': position, 'arrival_time': arrival}
+
+    def test_inserted_stop_keeps_the_others_aligned(self):
+        old = [self.stop(1, 'pickup', 0), self.stop(2, 'rest', 200), self.stop(3, 'dropoff', 500)]
+        new = [self.stop(4, 'pickup', 0), self.stop(5, 'fuel', 100), self.stop(6, 'rest', 200), self.stop(7, 'dropoff', 500)]
+        delta = list_delta(old, new, stop_key)
+        self.assertEqual(delta['count'], 4)
+        self.assertEqual(delta['kept'], [[0, 0, 1], [2, 1, 2]])
+        self.assertEqual(delta['changed'], [])
+        self.assertEqual(delta['added'], [{'index': 1, 'item': new[1]}])
+
+    def test_changed_fields_only(self):
+        old = [self.stop(1, 'pickup', 0), self.stop(2, 'dropoff', 500, '18:00')]
+        new = [self.stop(3, 'pickup', 0), self.stop(4, 'dropoff', 500, '19:00')]
+        delta = list_delta(old, new, stop_key)
+        self.assertEqual(delta['changed'], [{'index': 1, 'fields': {'arrival_time': '19:00'}}])
+        self.assertEqual(delta['added'], [])
+
+    def test_unchanged_plan(self):
+        plan = {
+            'route': {'distance': 1}, 'fuel_plan': None,
+            'stops': [self.stop(1, 'pickup', 0)],
+            'daily_logs': [{'id': 1, 'date': '2025-01-06', 'entries': [{'id': 1, 'status': 'driving', 'location': 'A'}]}],
+        }
+        delta = diff_plans(plan, plan)
+        self.assertEqual(delta['stops']['changed'], [])
+        self.assertEqual(delta['stops']['added'], [])
+        self.assertEqual(delta['daily_logs'], {'changed': [], 'removed': []})
+        self.assertNotIn('route', delta)
+
+
+def apply_list_delta(old, delta):
+    """Rebuild the new list from the old one and a list_delta, ids aside"""
+    new = [None] * delta['count']
+    for new_start, old_start, length in delta['kept']:
+        new[new_start:new_start + length] = [dict(item) for item in old[old_start:old_start + length]]
+    for change in delta['changed']:
+        new[change['index']].update(change['fields'])
+    for addition in delta['added']:
+        new[addition['index']] = addition['item']
+    return new
+
+
+def without_ids(items):
+    return [{key: value for key, value in item.items() if key != 'id'} for item in items]
+
+
+class PlannedTripTestCase(TestCase):
+    """Plans benchmark trips through the API against recorded OSRM routes"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.osrm = recorded_osrm_server().__enter__()
+        cls.osrm_settings = override_settings(OSRM_BASE_URL=cls.osrm.base_url)
+        cls.osrm_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.osrm_settings.disable()
+        cls.osrm.__exit__(None, None, None)
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+
+    def create_trip(self, name, driver=None):
+        fixture = BENCHMARK_TRIPS[name]
+        current, pickup, dropoff = [
+            Location.objects.create(name=place, latitude=lat, longitude=lon)
+            for place, lat, lon in (fixture['current'], fixture['pickup'], fixture['dropoff'])
+        ]
+        return Trip.objects.create(
+            driver=driver or self.driver,
+            current_location=current,
+            pickup_location=pickup,
+            dropoff_location=dropoff,
+            current_cycle_hours=fixture['cycle_hours'],
+            client_timezone='America/Chicago',
+        )
+
+    def plan(self, trip, departure=DEPARTURE, **headers):
+        return self.client.get(
+            f'/api/trips/{trip.id}/calculate_route/', {'departure_time': departure.isoformat()}, **headers
+        )
+
+
+class PlanCachingTests(PlannedTripTestCase):
+    def test_etag_and_not_modified(self):
+        trip = self.create_trip('regional')
+        response = self.plan(trip)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(response['X-Plan-Version'], '1')
+
+        again = self.plan(trip, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], etag)
+        self.assertEqual(PlanSnapshot.objects.filter(trip=trip).count(), 1)
+
+        # Another departure is another plan
+        later = self.plan(trip, DEPARTURE + datetime.timedelta(hours=5), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(later.status_code, 200)
+        self.assertNotEqual(later['ETag'], etag)
+        self.assertEqual(later['X-Plan-Version'], '2')
+
+        # Only the current plan answers 304: the first plan's stops are gone
+        self.assertEqual(self.plan(trip, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_plan_delta_rebuilds_the_new_plan(self):
+        trip = self.create_trip('coast_to_coast')
+        old = self.plan(trip).json()
+        new = self.plan(trip, DEPARTURE + datetime.timedelta(hours=7)).json()
+
+        response = self.client.get(f'/api/trips/{trip.id}/plan_delta/', {'since': 1})
+        self.assertEqual(response.status_code, 200)
+        delta = response.json()
+        self.assertEqual((delta['since'], delta['version']), (1, 2))
+        self.assertEqual(without_ids(apply_list_delta(old['stops'], delta['stops'])), without_ids(new['stops']))
+
+        old_logs = {log['date']: log for log in old['daily_logs']}
+        changed = {log['date']: log for log in delta['daily_logs']['changed']}
+        for log in new['daily_logs']:
+            if log['date'] in changed:
+                entries = apply_list_delta(old_logs.get(log['date'], {'entries': []})['entries'],
+                                           changed[log['date']]['entries'])
+            else:
+                entries = old_logs[log['date']]['entries']
+            self.assertEqual(without_ids(entries), without_ids(log['entries']), log['date'])
+        self.assertEqual(
+            delta['daily_logs']['removed'],
+            sorted(set(old_logs) - {log['date'] for log in new['daily_logs']}),
+        )
+
+        cached = self.client.get(f'/api/trips/{trip.id}/plan_delta/', {'since': 1},
+                                 HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        missing = self.client.get(f'/api/trips/{trip.id}/plan_delta/', {'since': 9})
+        self.assertEqual(missing.status_code, 404)
+
+
+class PingIngestionTests(PlannedTripTestCase):
+    def ping(self, trip, lat, lon, timestamp):
+        return self.client.post('/api/trips/pings/', {'pings': [{
+            'trip': trip.id, 'latitude': lat, 'longitude': lon, 'timestamp': timestamp.isoformat(),
+        }]}, content_type='application/json')
+
+    def stop_times(self, trip):
+        return {
+            stop.id: (stop.position_miles, stop.arrival_time, stop.departure_time)
+            for stop in RouteStop.objects.filter(trip=trip)
+        }
+
+    def test_delay_shifts_the_stops_ahead(self):
+        trip = self.create_trip('regional')
+        self.plan(trip)
+        snapshot = PlanSnapshot.objects.for_trip(trip).first()
+        tracker = get_trackers([snapshot.id])[snapshot.id]
+        before = self.stop_times(trip)
+
+        # At the pickup, 45 minutes after it was due to end
+        pickup = RouteStop.objects.get(trip=trip, stop_type='pickup')
+        lat, lon = pickup.location.latitude, pickup.location.longitude
+        when = pickup.departure_time + datetime.timedelta(minutes=45)
+        miles, _, _ = tracker.match(lat, lon)
+        delay = round(tracker.delay_seconds(miles, when) / ETA_RESOLUTION_SECONDS) * ETA_RESOLUTION_SECONDS
+        self.assertGreater(delay, 0)
+
+        response = self.ping(trip, lat, lon, when)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['trips'][0]['delay_seconds'], delay)
+        trip.refresh_from_db()
+        self.assertEqual(trip.status, 'in_progress')
+
+        after = self.stop_times(trip)
+        shift = datetime.timedelta(seconds=delay)
+        ahead = [stop_id for stop_id, (position, _, _) in before.items() if position > miles + 1e-6]
+        self.assertTrue(ahead)
+        for stop_id, (position, arrival, departure) in before.items():
+            expected = shift if stop_id in ahead else datetime.timedelta()
+            self.assertEqual(after[stop_id][1] - arrival, expected)
+            self.assertEqual(after[stop_id][2] - departure, expected)
+
+        # An older ping changes nothing; a later one shifts by the change in delay only
+        self.ping(trip, lat, lon, when - datetime.timedelta(minutes=30))
+        self.assertEqual(self.stop_times(trip), after)
+        self.ping(trip, lat, lon, when + datetime.timedelta(minutes=30))
+        for stop_id in ahead:
+            self.assertEqual(self.stop_times(trip)[stop_id][1] - after[stop_id][1], datetime.timedelta(minutes=30))
+
+        # The plan served keeps the planned times
+        self.assertEqual(
+            [parse_datetime(stop['arrival_time']) for stop in self.plan(trip).json()['stops']],
+            [parse_datetime(stop['arrival_time']) for stop in snapshot.data['stops']],
+        )
+
+
+class RollupTests(PlannedTripTestCase):
+    def rollups(self):
+        trips = {
+            row.pop('trip_id'): row
+            for row in TripRollup.objects.values('trip_id', 'week', 'driver_id', 'pickup_location_id',
+                                                 'dropoff_location_id', 'departure_time', *TripRollup.FIELDS)
+        }
+        weeks = sorted(
+            (tuple(row.items()) for row in WeeklyRollup.objects.values(
+                'week', 'driver_id', 'pickup_location_id', 'dropoff_location_id', 'trips', *WeeklyRollup.FIELDS
+            ) if row['trips']),
+            key=lambda row: [str(value) for _, value in row],
+        )
+        return trips, weeks
+
+    def test_incremental_updates_match_rebuild(self):
+        other_driver = User.objects.create(username='other')
+        trips = [self.create_trip(name) for name in BENCHMARK_TRIPS]
+        trips.append(self.create_trip('regional', other_driver))
+        for trip in trips:
+            self.plan(trip)
+        # Replan one trip into the next week, move one along its route,
+        # change the driver of one and delete one
+        self.plan(trips[0], DEPARTURE + datetime.timedelta(days=7))
+        stop = RouteStop.objects.filter(trip=trips[1], stop_type='pickup').get()
+        self.client.post('/api/trips/pings/', {'pings': [{
+            'trip': trips[1].id, 'latitude': stop.location.latitude, 'longitude': stop.location.longitude,
+            'timestamp': (stop.departure_time + datetime.timedelta(hours=1)).isoformat(),
+        }]}, content_type='application/json')
+        self.client.patch(f'/api/trips/{trips[2].id}/', {'driver': other_driver.id}, content_type='application/json')
+        self.client.delete(f'/api/trips/{trips[3].id}/')
+
+        incremental = self.rollups()
+        self.assertEqual(len(incremental[0]), len(trips) - 1)
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        rebuilt = self.rollups()
+
+        self.assertEqual(incremental[0].keys(), rebuilt[0].keys())
+        for trip_id, row in incremental[0].items():
+            for field, value in row.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, rebuilt[0][trip_id][field], places=6, msg=(trip_id, field))
+                else:
+                    self.assertEqual(value, rebuilt[0][trip_id][field], (trip_id, field))
+        self.assertEqual(len(incremental[1]), len(rebuilt[1]))
+        for week, expected in zip(incremental[1], rebuilt[1]):
+            for (field, value), (_, rebuilt_value) in zip(week, expected):
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, rebuilt_value, places=6, msg=(week, field))
+                else:
+                    self.assertEqual(value, rebuilt_value, (week, field))
@@ -0,0 +1,209 @@
+"""
+Time-dependent travel times from hour-of-week traffic profiles
+
+A TrafficProfile covers a circle around a metro area or corridor and gives
+168 speed factors, one per local hour of the week (Monday 00:00 first),
+relative to the routing engine's free-flow speed. For a route, the stretches
+inside each profile are found once, as runs of route miles; the scheduler
+then asks a SegmentClock how long a stretch takes from a given time, or how
+far the truck gets in a given number of driving hours. Outside the runs the
+segment's free-flow speed applies, and segments no profile touches keep the
+plain proportional arithmetic.
+"""
+import bisect
+import datetime
+import math
+from array import array
+
+import pytz
+from django.db.models import Count, Max
+
+from .geo import METERS_PER_DEGREE_LAT, haversine_meters, route_polyline
+from .models import TrafficProfile
+
+HOURS_PER_WEEK = 168
+# Route points tested against the profiles are about this far apart
+TRAFFIC_SAMPLE_SPACING_METERS = 1609
+# Grid used to find the profiles near a route point, in degrees
+GRID_DEGREES = 0.5
+# UTC offsets are whole quarter hours, so local hours start on UTC quarter hours
+QUARTER_HOUR_SECONDS = 900
+
+
+def traffic_rule_set():
+    """Version of the traffic profile table, for the planning input hash"""
+    profiles = TrafficProfile.objects.aggregate(profiles=Count('id'), updated=Max('updated_at'))
+    return [profiles['profiles'], profiles['updated'].isoformat() if profiles['updated'] else None]
+
+
+class TrafficModel:
+    """
+    The runs of route miles inside traffic profiles, as sorted arrays of
+    start and end miles and the index of the run's profile
+    """
+
+    def __init__(self, profiles, runs):
+        # (speed factors, pytz timezone) per profile
+        self.profiles = profiles
+        self.starts = array('d', (start for start, _, _ in runs))
+        self.ends = array('d', (end for _, end, _ in runs))
+        self.run_profiles = [profile for _, _, profile in runs]
+        # (profile, UTC quarter hour) -> (speed factor, end of the local hour
+        # as a timestamp), filled as the scheduler asks; kept across plans of
+        # the same route
+        self._hours = {}
+
+    def speed_at(self, profile, timestamp):
+        """Speed factor of a profile at a UTC timestamp, and when it next changes"""
+        key = (profile, int(timestamp // QUARTER_HOUR_SECONDS))
+        hour = self._hours.get(key)
+        if hour is None:
+            factors, timezone = self.profiles[profile]
+            start = key[1] * QUARTER_HOUR_SECONDS
+            local = datetime.datetime.fromtimestamp(start, timezone)
+            hour = (factors[local.weekday() * 24 + local.hour], start + (60 - local.minute) * 60)
+            self._hours[key] = hour
+        return hour
+
+    def segment(self, start_position, total_distance, total_duration):
+        return SegmentClock(self, start_position, total_distance, total_duration)
+
+
+def traffic_model(route_data):
+    """
+    Build the TrafficModel of a calculate_route result, or return None when
+    no traffic profile touches the route
+    """
+    rows = list(TrafficProfile.objects.values_list('latitude', 'longitude', 'radius_meters', 'timezone', 'speed_factors'))
+    if not rows:
+        return None
+    lats, lons, miles = route_polyline(route_data, TRAFFIC_SAMPLE_SPACING_METERS)
+    if len(lats) < 2:
+        return None
+
+    # Profiles by the grid cells their circle's bounding box covers; smaller
+    # circles first, so the most specific profile wins where they overlap
+    rows.sort(key=lambda row: row[2])
+    grid = {}
+    for index, (lat, lon, radius, _, _) in enumerate(rows):
+        dlat = radius / METERS_PER_DEGREE_LAT
+        dlon = dlat / max(math.cos(math.radians(min(89.0, abs(lat) + dlat))), 1e-6)
+        for row in range(math.floor((lat - dlat) / GRID_DEGREES), math.floor((lat + dlat) / GRID_DEGREES) + 1):
+            for column in range(math.floor((lon - dlon) / GRID_DEGREES), math.floor((lon + dlon) / GRID_DEGREES) + 1):
+                grid.setdefault((row, column), []).append(index)
+    if not grid:
+        return None
+
+    # Profile of each route point, then runs of points sharing one, each
+    # reaching halfway to the neighbouring points
+    point_profiles = []
+    for lat, lon in zip(lats, lons):
+        found = None
+        for index in grid.get((math.floor(lat / GRID_DEGREES), math.floor(lon / GRID_DEGREES)), ()):
+            profile_lat, profile_lon, radius = rows[index][:3]
+            if haversine_meters(lat, lon, profile_lat, profile_lon) <= radius:
+                found = index
+                break
+        point_profiles.append(found)
+
+    runs = []
+    used = {}
+    last = len(miles) - 1
+    for point, index in enumerate(point_profiles):
+        if index is None:
+            continue
+        start = miles[point] if point == 0 else (miles[point - 1] + miles[point]) / 2
+        end = miles[point] if point == last else (miles[point] + miles[point + 1]) / 2
+        profile = used.setdefault(index, len(used))
+        if runs and runs[-1][2] == profile and runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], end, profile)
+        else:
+            runs.append((start, end, profile))
+    if not runs:
+        return None
+
+    profiles = [None] * len(used)
+    for index, profile in used.items():
+        timezone, factors = rows[index][3], rows[index][4]
+        profiles[profile] = (tuple(factors), pytz.timezone(timezone))
+    return TrafficModel(profiles, runs)
+
+
+class SegmentClock:
+    """
+    Travel times along one segment of the route (e.g. current location to
+    pickup), whose routed duration gives the free-flow speed
+
+    Positions are miles covered since the start of the segment. Without a
+    traffic model, or where it has no runs in the segment, times are
+    proportional to distance exactly as the scheduler always computed them.
+    """
+
+    def __init__(self, traffic, start_position, total_distance, total_duration):
+        self.start_position = start_position
+        self.total_distance = total_distance
+        self.total_duration = total_duration
+        self.runs = []
+        if traffic is not None and total_duration > 0:
+            end_position = start_position + total_distance
+            first = bisect.bisect_right(traffic.ends, start_position)
+            for run in range(first, len(traffic.starts)):
+                if traffic.starts[run] >= end_position:
+                    break
+                self.runs.append((traffic.starts[run], traffic.ends[run], traffic.run_profiles[run]))
+        self.traffic = traffic
+        self.free_flow_mph = total_distance / total_duration if total_duration > 0 else None
+
+    def hours(self, covered, miles, when):
+        """Driving hours to go `miles` further, starting at `when`"""
+        if not self.runs:
+            remaining_distance = self.total_distance - covered
+            remaining_duration = (remaining_distance / self.total_distance) * self.total_duration
+            return (miles / remaining_distance) * remaining_duration
+        hours, _ = self._drive(self.start_position + covered, when, miles=miles)
+        return hours
+
+    def miles(self, covered, hours, when):
+        """Miles covered in `hours` of driving, starting at `when`"""
+        if not self.runs:
+            remaining_distance = self.total_distance - covered
+            remaining_duration = (remaining_distance / self.total_distance) * self.total_duration
+            return (hours / remaining_duration) * remaining_distance
+        _, miles = self._drive(self.start_position + covered, when, hours=hours)
+        return miles
+
+    def _drive(self, position, when, miles=math.inf, hours=math.inf):
+        """
+        Drive from position at `when` until either `miles` are covered or
+        `hours` have passed; returns (hours, miles) driven
+        """
+        speed = self.free_flow_mph
+        timestamp = when.timestamp()
+        driven_hours = driven_miles = 0.0
+        run = 0
+        while run < len(self.runs) and self.runs[run][1] <= position:
+            run += 1
+
+        while driven_miles < miles and driven_hours < hours:
+            left_miles = miles - driven_miles
+            left_hours = hours - driven_hours
+            if run < len(self.runs) and self.runs[run][0] <= position:
+                # Inside a profile: constant speed until the next local hour
+                run_end = self.runs[run][1]
+                factor, hour_end = self.traffic.speed_at(self.runs[run][2], timestamp)
+                step_speed = speed * factor
+                step_hours = min((hour_end - timestamp) / 3600, left_hours,
+                                 min(run_end - position, left_miles) / step_speed)
+                step_miles = step_hours * step_speed
+                if position + step_miles >= run_end - 1e-9:
+                    run += 1
+            else:
+                # Free flow up to the next run
+                next_start = self.runs[run][0] if run < len(self.runs) else math.inf
+                step_miles = min(next_start - position, left_miles, left_hours * speed)
+                step_hours = step_miles / speed
+            position += step_miles
+            driven_miles += step_miles
+            driven_hours += step_hours
+            timestamp += step_hours * 3600
+        return driven_hours, driven_miles
@@ -1,44 +1,306 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import AllowAny
-from .models import Location, Trip, RouteStop
-from .serializers import LocationSerializer, TripSerializer, RouteStopSerializer
-from .route_planning import calculate_route, generate_stops
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from .models import Location, Trip, RouteStop, PlanSnapshot, WeeklyRollup
+from .serializers import (
+    LocationSerializer, TripSerializer, RouteStopSerializer, PlanRequestSerializer,
+    LocationSearchSerializer, NearbyLocationSerializer, TripPingBatchSerializer, DepartureSearchSerializer,
+    PlanDeltaSerializer, AnalyticsQuerySerializer, route_stop_dicts,
+)
+from .analytics import rollup_report, update_trip_rollup
+from .route_planning import calculate_route, generate_stops, planning_inputs_hash
+from .fuel import plan_fuel_stops
+from .departures import candidate_departures, pareto_options, sweep_departures, varies_by_departure
+from .plan_delta import diff_plans
+from .traffic import traffic_model
+from .progress import current_progress_event, ingest_pings
+from .streaming import broker
 from logs.log_generator import generate_daily_logs_for_trip
-from logs.serializers import DailyLogSerializer
+from logs.serializers import daily_log_dicts
+from trip_planner.instrumentation import span
+from trip_planner.response_cache import CachedRetrieveMixin, bump_versions
+
+def etag_matches(request, etag):
+    """Whether the request's If-None-Match header lists etag (weak comparison)"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = parse_etags(header)
+    return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+def plan_response(data, etag, version, status=status.HTTP_200_OK):
+    """Response for a stored plan or plan delta, with its ETag and plan version"""
+    return Response(data, status=status, headers={'ETag': etag, 'X-Plan-Version': str(version)})
+
+
+class LocationSearchPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class AnalyticsPagination(PageNumberPagination):
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
 
 class LocationViewSet(viewsets.ModelViewSet):
     queryset = Location.objects.all()
     serializer_class = LocationSerializer
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Generated stop positions are listed only on request; they stay
+        # reachable by id since route stops link to them
+        if self.action == 'list' and self.request.query_params.get('include_waypoints') not in ('1', 'true'):
+            queryset = queryset.filter(is_waypoint=False)
+        return queryset
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Locations within `radius` meters of `lat`/`lon` and/or inside `bbox`,
+        nearest first (to the point, else to the box center), paginated
+        """
+        params = LocationSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        search = params.validated_data
+        
+        queryset = Location.objects.all()
+        if not search['include_waypoints']:
+            queryset = queryset.filter(is_waypoint=False)
+        if 'bbox' in search:
+            queryset = queryset.within_bbox(*search['bbox'])
+        
+        if 'radius' in search:
+            queryset = queryset.within_radius(search['lat'], search['lon'], search['radius'])
+        elif 'lat' in search:
+            queryset = queryset.with_distance(search['lat'], search['lon'])
+        else:
+            min_lat, min_lon, max_lat, max_lon = search['bbox']
+            if min_lon > max_lon:
+                max_lon += 360
+            center_lon = ((min_lon + max_lon) / 2 + 180) % 360 - 180
+            queryset = queryset.with_distance((min_lat + max_lat) / 2, center_lon)
+        queryset = queryset.order_by('distance', 'id')
+        
+        paginator = LocationSearchPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        return paginator.get_paginated_response(NearbyLocationSerializer(page, many=True).data)
 
 
-class TripViewSet(viewsets.ModelViewSet):
+class TripViewSet(CachedRetrieveMixin, viewsets.ModelViewSet):
     queryset = Trip.objects.all()
     serializer_class = TripSerializer
+    cache_kind = 'trip'
     
     @action(detail=True, methods=['get'])
     def calculate_route(self, request, pk=None):
         trip = self.get_object()
         
-        # Calculate the route between locations
+        params = PlanRequestSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        # Default to the current minute so repeated requests share a snapshot
+        departure_time = params.validated_data.get('departure_time')
+        if departure_time is None:
+            departure_time = timezone.now().replace(second=0, microsecond=0)
+        
+        # Serve identical requests from the trip's current plan; the input
+        # hash identifies the plan, so it is also its ETag. A snapshot of an
+        # earlier plan is not served: its stops and logs have been replaced
+        input_hash = planning_inputs_hash(trip, departure_time)
+        etag = quote_etag(input_hash)
+        snapshots = PlanSnapshot.objects.for_trip(trip)
+        with span('snapshot_lookup'):
+            if etag_matches(request, etag):
+                # The client has this plan; skip loading it
+                plan = snapshots.values('version', 'input_hash').first()
+                if plan is not None and plan['input_hash'] == input_hash:
+                    return plan_response(None, etag, plan['version'], status.HTTP_304_NOT_MODIFIED)
+            snapshot = snapshots.first()
+        if snapshot is not None and snapshot.input_hash == input_hash:
+            return plan_response(snapshot.data, etag, snapshot.version)
+
+        # Plan holding a lock on the trip row, so a trip is planned by one
+        # request at a time and its stops, logs and snapshot are replaced
+        # together. Requests for the same plan wait for the first one and are
+        # served the snapshot it stored instead of planning again.
+        with transaction.atomic():
+            with span('plan_lock'):
+                trip = Trip.objects.select_for_update().get(pk=trip.pk)
+                # The trip may have changed while waiting
+                input_hash = planning_inputs_hash(trip, departure_time)
+                etag = quote_etag(input_hash)
+                snapshot = PlanSnapshot.objects.for_trip(trip).first()
+            if snapshot is not None and snapshot.input_hash == input_hash:
+                return plan_response(snapshot.data, etag, snapshot.version)
+
+            # Calculate the route between locations
+            route_data = calculate_route(
+                trip.current_location,
+                trip.pickup_location,
+                trip.dropoff_location,
+                trip.current_cycle_hours
+            )
+
+            # Choose fuel stops by price when the trip gives its tank capacity and MPG
+            with span('fuel_plan'):
+                fuel_plan = plan_fuel_stops(trip, route_data)
+
+            # Generate stops based on HOS regulations
+            stops = generate_stops(trip, route_data, departure_time, fuel_plan)
+            with span('daily_logs'):
+                daily_logs = generate_daily_logs_for_trip(trip)
+
+
+            # Return route data and stops
+            with span('serialize'):
+                data = {
+                    'route': route_data,
+                    'stops': route_stop_dicts(stops),
+                    'daily_logs': daily_log_dicts(daily_logs),
+                    'fuel_plan': fuel_plan
+                }
+            with span('persist_snapshot'):
+                # Returning to an earlier plan's inputs replans and stores the
+                # result as the next version, replacing the earlier snapshot
+                # (whose stop and log ids no longer exist) rather than
+                # rewriting it, so trackers cached by snapshot id start over
+                latest = PlanSnapshot.objects.filter(trip=trip).aggregate(version=Max('version'))['version']
+                PlanSnapshot.objects.filter(trip=trip, input_hash=input_hash).delete()
+                snapshot = PlanSnapshot.objects.create(
+                    trip=trip, input_hash=input_hash, departure_time=departure_time,
+                    data=data, version=(latest or 0) + 1,
+                )
+                # Each plan request at a new departure time stores a version;
+                # only the latest few are kept for plan deltas
+                pruned = PlanSnapshot.objects.for_trip(trip).values_list('id', flat=True)[settings.PLAN_SNAPSHOT_HISTORY:]
+                PlanSnapshot.objects.filter(id__in=list(pruned)).delete()
+            with span('rollup'):
+                update_trip_rollup(trip, stops)
+        return plan_response(data, etag, snapshot.version)
+    
+    @action(detail=True, methods=['get'])
+    def plan_delta(self, request, pk=None):
+        """
+        Stops and daily logs that changed from plan version `since` to
+        `version` (by default the trip's current plan, the one its stops
+        and logs hold), for clients holding the older plan
+        """
+        trip = self.get_object()
+        
+        params = PlanDeltaSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        since = params.validated_data['since']
+        
+        snapshots = PlanSnapshot.objects.for_trip(trip)
+        if 'version' in params.validated_data:
+            target = snapshots.filter(version=params.validated_data['version'])
+        else:
+            target = snapshots
+        target = target.values('version', 'input_hash').first()
+        if target is None:
+            return Response({'detail': "Plan version not found."}, status=status.HTTP_404_NOT_FOUND)
+        
+        # A plan's inputs can recur under a later version, with new stop ids
+        etag = quote_etag(f"{target['input_hash']}-{target['version']}-{since}")
+        if etag_matches(request, etag):
+            return plan_response(None, etag, target['version'], status.HTTP_304_NOT_MODIFIED)
+        
+        with span('snapshot_lookup'):
+            plans = dict(snapshots.filter(version__in=[since, target['version']]).values_list('version', 'data'))
+        if since not in plans:
+            return Response(
+                {'detail': f"Plan version {since} not found; fetch the full plan instead."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        
+        with span('diff'):
+            delta = diff_plans(plans[since], plans[target['version']])
+        return plan_response({'since': since, 'version': target['version'], **delta}, etag, target['version'])
+    
+    @action(detail=True, methods=['get'])
+    def departure_options(self, request, pk=None):
+        """
+        Simulate departures every `step_minutes` over `window_hours` from
+        `start` and return those that are best by arrival time and overnight
+        rests, or all of them when the departure time changes neither;
+        nothing is saved
+        """
+        trip = self.get_object()
+        
+        params = DepartureSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        search = params.validated_data
+        start = search.get('start')
+        if start is None:
+            start = timezone.now().replace(second=0, microsecond=0)
+        departures = candidate_departures(start, search['window_hours'], search['step_minutes'])
+        
+        # Route, fuel plan and traffic don't depend on the departure time
         route_data = calculate_route(
-            trip.current_location, 
+            trip.current_location,
             trip.pickup_location,
             trip.dropoff_location,
             trip.current_cycle_hours
         )
+        with span('fuel_plan'):
+            fuel_plan = plan_fuel_stops(trip, route_data)
+        with span('traffic'):
+            traffic = traffic_model(route_data)
         
-        # Generate stops based on HOS regulations
-        stops = generate_stops(trip, route_data)
-        daily_logs = generate_daily_logs_for_trip(trip)
-        
+        with span('sweep'):
+            sweep = sweep_departures(trip, route_data, departures, fuel_plan, traffic)
+        varies = varies_by_departure(sweep)
+        result = {
+            'candidates': len(departures),
+            'first_departure': departures[0],
+            'last_departure': departures[-1],
+            'varies_by_departure': varies,
+            'options': pareto_options(sweep) if varies else sweep,
+        }
+        if not varies:
+            result['note'] = (
+                "Every departure takes the same time and overnight stops (no traffic profile covers "
+                "this route), so all candidates are listed; they differ only in when they arrive."
+            )
+        return Response(result)
+    
+    @action(detail=True, methods=['get'])
+    def progress(self, request, pk=None):
+        """Latest progress and remaining stop ETAs; /events/ streams the same over SSE"""
+        trip = self.get_object()
+        event = current_progress_event(trip.pk)
+        if event is None:
+            return Response({'detail': "No progress reported for this trip yet."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(event)
+    
+    @action(detail=False, methods=['post'])
+    def pings(self, request):
+        """Ingest a batch of position reports for any number of trips"""
+        batch = TripPingBatchSerializer(data=request.data)
+        batch.is_valid(raise_exception=True)
         
-        # Return route data and stops
+        with span('ingest'):
+            events = ingest_pings(batch.validated_data['pings'])
+        for event in events:
+            broker.publish(event)
         return Response({
-            'route': route_data,
-            'stops': RouteStopSerializer(stops, many=True).data,
-            'daily_logs':  DailyLogSerializer(daily_logs, many=True).data
+            'received': len(batch.validated_data['pings']),
+            'updated_trips': len(events),
+            'trips': [
+                {'trip': event['trip'], 'position_miles': event['position_miles'], 'delay_seconds': event['delay_seconds']}
+                for event in events
+            ],
         })
         
         
@@ -46,3 +308,35 @@ class RouteStopViewSet(viewsets.ModelViewSet):
     queryset = RouteStop.objects.all()
     serializer_class = RouteStopSerializer
     permission_classes = [AllowAny]
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        # Stop deletes send no cache signals
+        bump_versions('trip', [instance.trip_id])
+
+
+class AnalyticsViewSet(viewsets.ViewSet):
+    def list(self, request):
+        """
+        Trip totals (planned and covered miles, rest, sleep and fuel stops,
+        driving per log day) summed from the weekly rollups by the `group_by`
+        dimensions, filtered by departure week, driver and lane, paginated
+        """
+        params = AnalyticsQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        query = params.validated_data
+        
+        rows = WeeklyRollup.objects.all()
+        if 'start' in query:
+            rows = rows.filter(week__gte=query['start'])
+        if 'end' in query:
+            rows = rows.filter(week__lte=query['end'])
+        for field in ('driver', 'pickup_location', 'dropoff_location'):
+            if field in query:
+                rows = rows.filter(**{f'{field}_id': query[field]})
+        with span('report'):
+            report = rollup_report(rows, query['group_by'])
+        
+        paginator = AnalyticsPagination()
+        page = paginator.paginate_queryset(report, request, view=self)
+        return paginator.get_paginated_response(page)
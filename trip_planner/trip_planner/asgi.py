@@ -3,14 +3,33 @@ ASGI config for trip_planner project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests for trip progress streams (/api/trips/{id}/events/) are served by a
+native ASGI handler so they can be held open without occupying a thread;
+everything else goes to Django.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
+import re
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trip_planner.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from routes.streaming import trip_events  # noqa: E402
+
+TRIP_EVENTS_PATH = re.compile(r'^/api/trips/(?P<trip_id>\d+)/events/?$')
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        match = TRIP_EVENTS_PATH.match(scope['path'])
+        if match:
+            await trip_events(scope, receive, send, int(match.group('trip_id')))
+            return
+    await django_application(scope, receive, send)
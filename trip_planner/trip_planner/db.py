@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.db import connection, connections
+
+
+def insert_all(objects):
+    """
+    Insert unsaved model instances of one model, in a single query where the
+    database returns the new primary keys (PostgreSQL) and row by row elsewhere
+    """
+    if not objects:
+        return
+    if connection.features.can_return_rows_from_bulk_insert:
+        type(objects[0]).objects.bulk_create(objects)
+    else:
+        # Rows need primary keys for foreign keys and API responses
+        for obj in objects:
+            obj.save()
+
+
+class ConnectionHealthMiddleware:
+    """
+    Reopen persistent database connections that went stale between requests
+
+    With CONN_MAX_AGE, a connection is kept across requests, but the server
+    or a pooler in front of it may have closed it while idle; the next query
+    would then fail. Before a request, connections idle for longer than
+    DB_HEALTH_CHECK_IDLE_SECONDS are checked and closed if unusable, so
+    Django opens a new one. (Django 4.1 has CONN_HEALTH_CHECKS for this.)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.idle_seconds = getattr(settings, 'DB_HEALTH_CHECK_IDLE_SECONDS', 30)
+
+    def __call__(self, request):
+        now = time.monotonic()
+        for db in connections.all():
+            idle_since = getattr(db, 'idle_since', None)
+            if db.connection is not None and (idle_since is None or now - idle_since > self.idle_seconds):
+                if not db.is_usable():
+                    db.close()
+        try:
+            return self.get_response(request)
+        finally:
+            finished = time.monotonic()
+            for db in connections.all():
+                db.idle_since = finished
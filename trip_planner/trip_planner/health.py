@@ -0,0 +1,33 @@
+"""
+Health check endpoints for load balancers and orchestrators
+
+/healthz answers as long as the process serves requests; /readyz also
+checks that the database and the shared cache answer, so a worker that
+can't reach them is taken out of rotation instead of failing requests.
+"""
+from django.core.cache import caches
+from django.db import DatabaseError, connection
+from django.http import JsonResponse
+
+
+def liveness_view(request):
+    return JsonResponse({'status': 'ok'})
+
+
+def readiness_view(request):
+    checks = {}
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        checks['database'] = 'ok'
+    except DatabaseError as error:
+        checks['database'] = str(error)
+    try:
+        caches['default'].get('readiness-check')
+        checks['cache'] = 'ok'
+    except Exception as error:
+        # Cache clients raise their own connection errors
+        checks['cache'] = str(error)
+
+    ready = all(result == 'ok' for result in checks.values())
+    return JsonResponse({'status': 'ok' if ready else 'unavailable', 'checks': checks}, status=200 if ready else 503)
@@ -0,0 +1,352 @@
+"""
+Request-level performance instrumentation
+
+Wrap expensive phases in ``span()`` to time them:
+
+    from trip_planner.instrumentation import span
+
+    with span('routing'):
+        response = requests.get(url)
+
+PerformanceMiddleware collects the spans and database queries of each request
+and exports them as a structured log line on the ``trip_planner.performance``
+logger, Prometheus metrics served by ``metrics_view`` and, with the
+SERVER_TIMING setting, a ``Server-Timing`` header. Metrics are kept per
+process; with the METRICS_DIR setting each process also writes them to a
+file in that directory, and ``metrics_view`` sums the files of every worker,
+so a scrape reaching any worker sees the whole server. Scrapers authenticate
+with the METRICS_TOKEN setting.
+"""
+import bisect
+import contextvars
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger('trip_planner.performance')
+
+_current_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Spans and database queries recorded while handling one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # span name -> {'duration': seconds, 'db': seconds, 'queries': int, 'count': int}
+        self.spans = {}
+        self.active = []
+        self.queries = 0
+        self.db_duration = 0.0
+
+    def _span(self, name):
+        if name not in self.spans:
+            self.spans[name] = {'duration': 0.0, 'db': 0.0, 'queries': 0, 'count': 0}
+        return self.spans[name]
+
+    def add_span(self, name, duration):
+        entry = self._span(name)
+        entry['duration'] += duration
+        entry['count'] += 1
+
+    def add_query(self, duration):
+        self.queries += 1
+        self.db_duration += duration
+        # Attribute the query to the innermost active span
+        if self.active:
+            entry = self._span(self.active[-1])
+            entry['queries'] += 1
+            entry['db'] += duration
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as the named span of the current request"""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+
+    timings.active.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_span(name, time.perf_counter() - start)
+        timings.active.pop()
+
+
+@contextmanager
+def collect_timings():
+    """Record spans and queries for the enclosed block and yield the RequestTimings"""
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+
+    def count_query(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timings.add_query(time.perf_counter() - start)
+
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count_query))
+            yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+# Upper bounds (seconds) shared by every duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds between writes of a process's metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = 1.0
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._flush_lock = threading.Lock()
+        self._flushed_at = 0.0
+        self._flush_pending = False
+        self._file_pid = None
+        self._file_name = None
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0
+                }
+            index = bisect.bisect_left(DURATION_BUCKETS, value)
+            if index < len(DURATION_BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """Copies of the counters and histograms, as {(name, labels): value}"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}
+                for key, h in self._histograms.items()
+            }
+        return counters, histograms
+
+    def flush(self, directory, force=False):
+        """
+        Write this process's metrics to a file in directory, at most every
+        METRICS_FLUSH_INTERVAL seconds unless forced; a skipped write is made
+        when the interval is up, so the file catches up with the last requests
+
+        Files are named by process id and a random suffix, so a worker
+        reusing a dead worker's pid doesn't overwrite its totals; files of
+        dead workers are kept, so the summed counters never go back.
+        """
+        now = time.monotonic()
+        if not force and now - self._flushed_at < METRICS_FLUSH_INTERVAL:
+            with self._flush_lock:
+                if not self._flush_pending:
+                    self._flush_pending = True
+                    timer = threading.Timer(
+                        METRICS_FLUSH_INTERVAL - (now - self._flushed_at), self.flush, (directory, True)
+                    )
+                    timer.daemon = True
+                    timer.start()
+            return
+        with self._flush_lock:
+            self._flushed_at = now
+            self._flush_pending = False
+            if self._file_pid != os.getpid():
+                self._file_pid = os.getpid()
+                self._file_name = f'{self._file_pid}-{uuid.uuid4().hex}.json'
+            counters, histograms = self.snapshot()
+            state = {
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, histogram] for (name, labels), histogram in histograms.items()],
+            }
+            path = os.path.join(directory, self._file_name)
+            with open(f'{path}.tmp', 'w') as output:
+                json.dump(state, output)
+            os.replace(f'{path}.tmp', path)
+
+    def render(self, directory=None):
+        """
+        Render this process's metrics, or with a directory, the sums of the
+        metrics every process wrote there
+        """
+        if directory is None:
+            return self._render(*self.snapshot())
+
+        self.flush(directory, force=True)
+        counters = defaultdict(float)
+        histograms = {}
+        for file_name in os.listdir(directory):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, file_name)) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                # Removed or replaced while listing
+                continue
+            for name, labels, value in state['counters']:
+                counters[name, tuple(map(tuple, labels))] += value
+            for name, labels, histogram in state['histograms']:
+                total = histograms.setdefault(
+                    (name, tuple(map(tuple, labels))), {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0}
+                )
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+        return self._render(counters, histograms)
+
+    def _render(self, counters, histograms):
+        by_name = defaultdict(list)
+        for (name, labels), value in counters.items():
+            by_name[name].append(f"{name}{_format_labels(labels)} {value:.15g}")
+        for (name, labels), histogram in histograms.items():
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                cumulative += count
+                bucket_labels = labels + (('le', f"{bound:g}"),)
+                by_name[name].append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            by_name[name].append(
+                f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}"
+            )
+            by_name[name].append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+            by_name[name].append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+        lines = []
+        for name in sorted(by_name):
+            if name in self._help:
+                kind, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.extend(by_name[name])
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    formatted = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append(f'{key}="{value}"')
+    return '{' + ','.join(formatted) + '}'
+
+
+metrics = MetricsRegistry()
+metrics.describe('trip_planner_requests_total', 'counter', 'HTTP requests handled')
+metrics.describe('trip_planner_request_duration_seconds', 'histogram', 'HTTP request duration')
+metrics.describe('trip_planner_db_queries_total', 'counter', 'Database queries executed by requests')
+metrics.describe('trip_planner_db_duration_seconds_total', 'counter', 'Time spent in database queries')
+metrics.describe('trip_planner_span_duration_seconds', 'histogram', 'Duration of instrumented phases')
+
+
+class PerformanceMiddleware:
+    """Time every request and export its spans and query counts"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect_timings() as timings:
+            response = self.get_response(request)
+        duration = timings.elapsed
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = server_timing_header(timings, duration)
+        self.record_metrics(request.method, view, response.status_code, timings, duration)
+        if settings.METRICS_DIR:
+            metrics.flush(settings.METRICS_DIR)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 2),
+            'queries': timings.queries,
+            'db_ms': round(timings.db_duration * 1000, 2),
+            'spans': {
+                name: {
+                    'duration_ms': round(entry['duration'] * 1000, 2),
+                    'db_ms': round(entry['db'] * 1000, 2),
+                    'queries': entry['queries'],
+                    'count': entry['count'],
+                }
+                for name, entry in timings.spans.items()
+            },
+        }))
+        return response
+
+    def record_metrics(self, method, view, status, timings, duration):
+        labels = {'method': method, 'view': view}
+        metrics.inc('trip_planner_requests_total', dict(labels, status=status))
+        metrics.observe('trip_planner_request_duration_seconds', labels, duration)
+        metrics.inc('trip_planner_db_queries_total', {'view': view}, timings.queries)
+        metrics.inc('trip_planner_db_duration_seconds_total', {'view': view}, timings.db_duration)
+        for name, entry in timings.spans.items():
+            metrics.observe('trip_planner_span_duration_seconds', {'span': name}, entry['duration'])
+
+
+def server_timing_header(timings, duration):
+    """Format spans as a Server-Timing header value (durations in milliseconds)"""
+    parts = [
+        f'{name};dur={entry["duration"] * 1000:.1f};desc="{entry["queries"]} queries"'
+        for name, entry in timings.spans.items()
+    ]
+    parts.append(f'db;dur={timings.db_duration * 1000:.1f};desc="{timings.queries} queries"')
+    parts.append(f'total;dur={duration * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def metrics_view(request):
+    """
+    Expose metrics in the Prometheus text format to requests with an
+    ``Authorization: Bearer <METRICS_TOKEN>`` header (any request with DEBUG
+    and no token set): the sums of every worker's with METRICS_DIR, else
+    those of the serving process
+    """
+    if settings.METRICS_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+            return HttpResponseForbidden("Metrics require the metrics token.")
+    elif not settings.DEBUG:
+        return HttpResponseForbidden("Set METRICS_TOKEN to serve metrics.")
+    return HttpResponse(metrics.render(settings.METRICS_DIR), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,36 @@
+"""
+Loading before worker processes fork
+
+Gunicorn with preload_app loads the application once in the master process;
+workers are forked from it and share its memory copy-on-write. Django itself
+only imports the URLconf, and with it the views, serializers and planner
+modules, on the first request, and the routing graph is opened on the first
+route; preload() does both up front, so every worker shares them instead of
+loading its own copy.
+"""
+import gc
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+from rest_framework.settings import api_settings
+
+
+def preload():
+    # Views, serializers and everything they import
+    get_resolver().url_patterns
+    api_settings.DEFAULT_RENDERER_CLASSES
+    api_settings.DEFAULT_PARSER_CLASSES
+
+    # The contraction hierarchy is memory-mapped, so workers share its pages
+    if settings.ROUTING_BACKEND == 'ch' and settings.ROUTING_GRAPH_PATH:
+        from routes.ch_router import load_ch_router
+        load_ch_router(settings.ROUTING_GRAPH_PATH)
+
+    # Workers must open their own database connections
+    connections.close_all()
+
+    # Move everything loaded so far out of the collector's reach: collections
+    # in a worker would otherwise write to these objects and unshare the pages
+    gc.collect()
+    gc.freeze()
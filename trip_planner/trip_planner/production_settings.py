@@ -0,0 +1,37 @@
+"""
+Production settings
+
+Select with DJANGO_SETTINGS_MODULE=trip_planner.production_settings (the
+Docker image does). Database connections are kept open between requests
+and checked before reuse, instead of opening a new connection to the
+database pooler for every request.
+"""
+import os
+
+import dj_database_url
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES, MIDDLEWARE
+
+DEBUG = False
+# Span breakdowns only on request
+SERVER_TIMING = bool(int(os.environ.get('SERVER_TIMING', 0)))
+
+# settings.py allows every origin when DEBUG isn't set in the environment
+CORS_ALLOW_ALL_ORIGINS = False
+CORS_ALLOWED_ORIGINS = [
+    "https://frontend-git-main-mumojs-projects.vercel.app",
+]
+
+if os.environ.get('DATABASE_URL'):
+    DATABASES = {'default': dj_database_url.parse(os.environ['DATABASE_URL'])}
+
+# Seconds a connection is kept open after a request
+DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('CONN_MAX_AGE', 600))
+# The Neon pooler (PgBouncer in transaction mode) may hand each transaction
+# a different server connection, so server-side cursors can't be used
+DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Connections idle for longer than this are checked before a request uses them
+DB_HEALTH_CHECK_IDLE_SECONDS = int(os.environ.get('DB_HEALTH_CHECK_IDLE_SECONDS', 30))
+MIDDLEWARE = ['trip_planner.db.ConnectionHealthMiddleware', *MIDDLEWARE]
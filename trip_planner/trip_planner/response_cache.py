@@ -0,0 +1,111 @@
+"""
+Cache of rendered API responses for single objects
+
+Responses are stored per object under a version counter kept in the shared
+cache ('default'); any change to the object or to what its response nests
+bumps the counter, so stale responses are simply never looked up again.
+Rendered bodies are kept in this process's memory ('local') in front of
+the shared cache, so a hit costs one version read and a dictionary lookup.
+
+Counters are bumped from model signals (see the apps' signals modules) once
+the writing transaction commits; code that writes with update() or
+bulk_create() calls bump_versions itself.
+"""
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+
+RESPONSE_CACHE_TIMEOUT = 300  # Seconds a rendered response is kept
+
+
+def _version_key(kind, object_id):
+    return f'response-version:{kind}:{object_id}'
+
+
+def _response_key(kind, object_id, version):
+    return f'response:{kind}:{object_id}:{version}'
+
+
+def current_version(kind, object_id):
+    """Version counter of an object's cached responses, created if missing"""
+    shared = caches['default']
+    key = _version_key(kind, object_id)
+    version = shared.get(key)
+    if version is None:
+        # A counter that was evicted must not restart at a number it had
+        # before, or responses cached under that number would come back
+        shared.add(key, time.time_ns(), timeout=None)
+        version = shared.get(key)
+    return version
+
+
+def bump_versions(kind, object_ids):
+    """Invalidate the cached responses of objects, once the current transaction commits"""
+    object_ids = {object_id for object_id in object_ids if object_id is not None}
+    if not object_ids:
+        return
+
+    def bump():
+        shared = caches['default']
+        for object_id in object_ids:
+            try:
+                shared.incr(_version_key(kind, object_id))
+            except ValueError:
+                # No counter yet; the first read starts one
+                pass
+
+    transaction.on_commit(bump)
+
+
+def get_response(kind, object_id, version):
+    """Rendered body cached for an object's version, or None"""
+    key = _response_key(kind, object_id, version)
+    local = caches['local']
+    body = local.get(key)
+    if body is None:
+        body = caches['default'].get(key)
+        if body is not None:
+            local.set(key, body, RESPONSE_CACHE_TIMEOUT)
+    return body
+
+
+def set_response(kind, object_id, version, body):
+    key = _response_key(kind, object_id, version)
+    caches['local'].set(key, body, RESPONSE_CACHE_TIMEOUT)
+    caches['default'].set(key, body, RESPONSE_CACHE_TIMEOUT)
+
+
+class CachedRetrieveMixin:
+    """
+    Serve a viewset's retrieve action from the response cache
+
+    Only plain JSON responses are cached; the browsable API renders as usual.
+    Cache hits skip get_object, so they bypass object-level permission
+    checks and queryset filtering: use it on viewsets that have none.
+    """
+    cache_kind = None
+
+    def retrieve(self, request, *args, **kwargs):
+        renderer = request.accepted_renderer
+        try:
+            object_id = int(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except ValueError:
+            object_id = None
+        # Media type parameters (e.g. indent) change the body; render those as usual
+        if renderer.format != 'json' or request.accepted_media_type != renderer.media_type or object_id is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        version = current_version(self.cache_kind, object_id)
+        body = get_response(self.cache_kind, object_id, version)
+        if body is None:
+            data = self.retrieve_data(request, *args, **kwargs)
+            body = renderer.render(data, request.accepted_media_type, self.get_renderer_context())
+            set_response(self.cache_kind, object_id, version, body)
+        content_type = f'{renderer.media_type}; charset={renderer.charset}' if renderer.charset else renderer.media_type
+        return HttpResponse(body, content_type=content_type)
+
+    def retrieve_data(self, request, *args, **kwargs):
+        """Response data of the object on a cache miss"""
+        return super().retrieve(request, *args, **kwargs).data
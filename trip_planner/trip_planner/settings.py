@@ -11,7 +11,6 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
 from pathlib import Path
-import dj_database_url
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'trip_planner.instrumentation.PerformanceMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -57,7 +57,6 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
 ROOT_URLCONF = 'trip_planner.urls'
@@ -107,6 +106,33 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'trip_planner.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+
+# Caches
+# 'default' is shared between processes: memcached at CACHE_LOCATION
+# (host:port) when set, else this process's memory. It holds the version
+# counters of cached API responses (trip_planner.response_cache), so with
+# several worker processes it must be shared. 'local' keeps rendered
+# responses in each process in front of it.
+CACHE_LOCATION = os.environ.get('CACHE_LOCATION')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': CACHE_LOCATION,
+    } if CACHE_LOCATION else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shared',
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
 }
 
 
@@ -143,6 +169,50 @@ MEDIA_URL = 'media/'
 MEDIA_ROOT =  BASE_DIR / MEDIA_URL
 
 
+# Logging
+# Per-request timing lines from trip_planner.instrumentation are emitted as JSON
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'trip_planner.performance': {
+            'handlers': ['console'],
+            'level': os.environ.get('PERFORMANCE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Server-Timing headers with each response's span breakdown; off unless
+# DEBUG by default, as they reveal how requests are processed
+SERVER_TIMING = bool(int(os.environ.get('SERVER_TIMING', DEBUG)))
+# Bearer token /metrics requires; without one it is served only with DEBUG
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Directory where each worker process writes its metrics, for /metrics to
+# sum; needed with several workers, and emptied by gunicorn at startup
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+
+# Routing
+# 'osrm' routes over HTTP with the OSRM server at OSRM_BASE_URL; 'ch' routes
+# in-process with a contraction hierarchy file built by
+# `manage.py build_routing_graph` and located at ROUTING_GRAPH_PATH
+ROUTING_BACKEND = os.environ.get('ROUTING_BACKEND', 'osrm')
+ROUTING_GRAPH_PATH = os.environ.get('ROUTING_GRAPH_PATH')
+OSRM_BASE_URL = os.environ.get('OSRM_BASE_URL', 'http://router.project-osrm.org')
+
+# Generated stops reuse an existing waypoint location within this many meters
+STOP_DEDUP_RADIUS_METERS = float(os.environ.get('STOP_DEDUP_RADIUS_METERS', 250))
+# Plan versions kept per trip, the current one included; plan deltas can be
+# computed from the older ones still kept
+PLAN_SNAPSHOT_HISTORY = max(1, int(os.environ.get('PLAN_SNAPSHOT_HISTORY', 10)))
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 
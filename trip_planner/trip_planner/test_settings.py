@@ -0,0 +1,34 @@
+"""
+Test settings
+
+Select with DJANGO_SETTINGS_MODULE=trip_planner.test_settings. Tests run
+against a local SQLite database instead of the shared Postgres one, and
+the routing tests replay recorded routes instead of calling OSRM.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import LOGGING
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+# Every process's caches are its own memory
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shared',
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+}
+
+ROUTING_BACKEND = 'osrm'
+METRICS_DIR = None
+
+# Keep request timings out of the test output
+LOGGING['loggers']['trip_planner.performance']['level'] = 'WARNING'
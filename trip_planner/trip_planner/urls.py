@@ -19,9 +19,11 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.routers import DefaultRouter
-from routes.views import LocationViewSet, TripViewSet, RouteStopViewSet
+from routes.views import LocationViewSet, TripViewSet, RouteStopViewSet, AnalyticsViewSet
 from logs.views import DailyLogViewSet, LogEntryViewSet
 from django.views.decorators.csrf import csrf_exempt
+from trip_planner.instrumentation import metrics_view
+from trip_planner.health import liveness_view, readiness_view
 
 # Create a router and register viewsets
 router = DefaultRouter()
@@ -30,11 +32,15 @@ router.register(r'trips', TripViewSet)
 router.register(r'stops', RouteStopViewSet)
 router.register(r'daily-logs', DailyLogViewSet)
 router.register(r'log-entries', LogEntryViewSet)
+router.register(r'analytics', AnalyticsViewSet, basename='analytics')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
     path('api-auth/', include('rest_framework.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    path('healthz', liveness_view, name='healthz'),
+    path('readyz', readiness_view, name='readyz'),
 ]
 
 # Add media URL if using media files (for log images)